@@ -0,0 +1,215 @@
+"""
+Micro-benchmarks for the performance sensitive parts of utils.
+
+Usage:
+    python3 benchmarks.py            # run every benchmark
+    python3 benchmarks.py color_lut  # run only the named benchmarks
+"""
+
+import math
+import os
+import random
+import sys
+import tempfile
+import time
+
+from utils.color_detector import ColorCalibrator, ColorDetector, ColorLUT
+from utils.dummy import _MotorBank
+from utils.filters import (CircularList, IntegrationTracker, MeanWindow, MedianWindow,
+                           PercentileWindow, RingBuffer, SumWindow)
+from utils.simulator import Simulator, WorldMap
+from utils.trace import TraceRecorder, read_trace
+
+
+def _timeit(func, repeat=5):
+    """Returns the best time, in seconds, of repeat calls to func."""
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def _report(name, count, seconds):
+    print(f"  {name:<36} {count / seconds:>14,.0f} /s  ({seconds * 1000:8.2f} ms)")
+
+
+def bench_color_lut(n=20000):
+    """Distance-based ColorDetector vs. a baked ColorLUT, per sample and batched."""
+    print(f"color classification, {n} samples")
+    rng = random.Random(0)
+    samples = [[rng.uniform(0, 300) for _ in range(3)] for _ in range(n)]
+    detector = ColorDetector()
+
+    start = time.perf_counter()
+    lut = ColorLUT.bake(detector)
+    print(f"  baked {lut.bins}^3 table in {(time.perf_counter() - start) * 1000:.0f} ms")
+
+    _report("ColorDetector.detect_color", n,
+            _timeit(lambda: [detector.detect_color(s) for s in samples]))
+    _report("ColorDetector.classify_batch", n,
+            _timeit(lambda: detector.classify_batch(samples)))
+
+    calibrator = ColorCalibrator()
+    for label, rgb in detector.REFERENCE_COLORS.items():
+        for _ in range(50):
+            calibrator.add_sample(label, [v + rng.gauss(0, 5) for v in rgb])
+    model = calibrator.fit()
+    _report("ColorModel.classify_batch", n,
+            _timeit(lambda: model.classify_batch(samples)))
+    model_lut = ColorLUT.bake(model)
+    _report("ColorLUT(ColorModel).detect_colors", n,
+            _timeit(lambda: model_lut.detect_colors(samples)))
+
+    _report("ColorLUT.detect_color", n,
+            _timeit(lambda: [lut.detect_color(s) for s in samples]))
+    _report("ColorLUT.detect_colors", n,
+            _timeit(lambda: lut.detect_colors(samples)))
+
+    exact = [detector.detect_color(s) for s in samples]
+    agree = sum(a == b for a, b in zip(exact, lut.detect_colors(samples)))
+    print(f"  LUT agrees with ColorDetector on {agree / n:.1%} of samples")
+
+
+def bench_ring_buffer(n=100000, size=15):
+    """Lock-based CircularList vs. array-backed RingBuffer."""
+    print(f"ring buffers of size {size}, {n} appends")
+    values = [float(i % 250) for i in range(n)]
+    for buffer_type in (CircularList, RingBuffer):
+        name = buffer_type.__name__
+
+        def append_all():
+            buffer = buffer_type(size)
+            for v in values:
+                buffer.append(v)
+        _report(f"{name}.append", n, _timeit(append_all))
+
+        buffer = buffer_type(size)
+        buffer.update(values[:size])
+        _report(f"{name}.to_list", n // 10,
+                _timeit(lambda: [buffer.to_list() for _ in range(n // 10)]))
+
+        def mean_window():
+            window = MeanWindow(size, buffer_type)
+            for v in values:
+                window.append(v)
+        _report(f"MeanWindow({name}).append", n, _timeit(mean_window))
+
+
+def bench_median_window(n=100000):
+    """Streaming MedianWindow and PercentileWindow over ultrasonic-like readings."""
+    print(f"median windows, {n} appends")
+    rng = random.Random(0)
+    values = [rng.uniform(0, 255) for _ in range(n)]
+    for size in (5, 15, 51):
+        def median_all():
+            window = MedianWindow(size, RingBuffer)
+            for v in values:
+                window.append(v)
+        _report(f"MedianWindow({size}).append", n, _timeit(median_all, repeat=3))
+
+    def percentile_all():
+        window = PercentileWindow(15, 90, RingBuffer)
+        for v in values:
+            window.append(v)
+    _report("PercentileWindow(15, 90).append", n, _timeit(percentile_all, repeat=3))
+
+
+def bench_window_extend(n=100000):
+    """Replaying a recorded log through windowed filters, append vs. extend."""
+    print(f"windowed filter replay, {n} samples")
+    rng = random.Random(0)
+    values = [rng.uniform(0, 255) for _ in range(n)]
+    for name, make in (("MeanWindow(15)", lambda: MeanWindow(15)),
+                       ("SumWindow(15)", lambda: SumWindow(15)),
+                       ("MedianWindow(15)", lambda: MedianWindow(15)),
+                       ("IntegrationTracker", lambda: IntegrationTracker(0.05))):
+        def streamed():
+            window = make()
+            for v in values:
+                window.append(v)
+        _report(f"{name}.append", n, _timeit(streamed, repeat=3))
+        _report(f"{name}.extend", n, _timeit(lambda: make().extend(values), repeat=3))
+
+
+def bench_simulator(seconds=60):
+    """Virtual seconds simulated per real second, for a 20 Hz wall-following style loop."""
+    print(f"simulator, {seconds} virtual seconds")
+    world = WorldMap(1200, 120)
+    world.paint(0, 100, 1200, 5, "black")
+
+    def run():
+        sim = Simulator(world, x=10, y=60, ultrasonic_angle=math.pi / 2)
+        bp = sim.bp
+        bp.set_sensor_type(bp.PORT_3, bp.SENSOR_TYPE.EV3_ULTRASONIC_CM)
+        while sim.time() < seconds:
+            drift = 10 if bp.get_sensor(bp.PORT_3) > 60 else -10
+            bp.set_motor_dps(bp.PORT_A, 180 + drift)
+            bp.set_motor_dps(bp.PORT_D, 180 - drift)
+            sim.sleep(0.05)
+    elapsed = _timeit(run, repeat=3)
+    print(f"  {'Simulator.sleep loop':<36} {seconds / elapsed:>14,.0f} x real time")
+
+
+def bench_motor_bank(n=100000):
+    """Ticks per second of the dummy motor engine, for the four motors of a brick."""
+    print(f"motor bank, {n} ticks")
+    bank = _MotorBank()
+    for i, motor in enumerate(bank.motors):
+        motor.set_speed(100 * (i + 1))
+
+    def speeds():
+        for _ in range(n):
+            bank.step(0.001)
+
+    def positions():
+        for motor in bank.motors:
+            motor.set_position(0)
+            motor.set_limits(speed=100)  # never reaches the goal during the run
+            motor.go_position(bank.MAX_POS)
+        for _ in range(n):
+            bank.step(0.001)
+    _report("step, dps", n, _timeit(speeds, repeat=3))
+    _report("step, position", n, _timeit(positions, repeat=3))
+
+
+def bench_trace(n=100000):
+    """Cost of recording sensor reads and motor commands, and size of the trace file."""
+    print(f"trace, {n} sensor reads and motor commands")
+    from utils.brick import EV3UltrasonicSensor, Motor
+    sensor = EV3UltrasonicSensor(3)
+    motor = Motor("A")
+    path = os.path.join(tempfile.mkdtemp(), "bench.trace")
+
+    def loop():
+        for i in range(n):
+            sensor.get_value()
+            motor.set_dps(i)
+
+    _report("get_value + set_dps", n, _timeit(loop, repeat=3))
+    with TraceRecorder(path):
+        _report("recorded", n, _timeit(loop, repeat=3))
+    size = os.path.getsize(path)
+    start = time.perf_counter()
+    trace = read_trace(path)
+    _report("read_trace", len(trace.events), time.perf_counter() - start)
+    print(f"  {size / len(trace.events):.1f} bytes per sample")
+    motor.set_dps(0)
+
+
+BENCHMARKS = {
+    "color_lut": bench_color_lut,
+    "ring_buffer": bench_ring_buffer,
+    "median_window": bench_median_window,
+    "window_extend": bench_window_extend,
+    "simulator": bench_simulator,
+    "motor_bank": bench_motor_bank,
+    "trace": bench_trace,
+}
+
+
+if __name__ == '__main__':
+    names = sys.argv[1:] or list(BENCHMARKS.keys())
+    for name in names:
+        BENCHMARKS[name]()
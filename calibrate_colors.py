@@ -0,0 +1,41 @@
+"""
+Color calibration tool.
+
+Place the color sensor over each colored tile when prompted. Samples are recorded
+for every color, a per-color mean and covariance model is fitted, and the profile
+is saved so the robot can load it with ColorModel.load(PROFILE_PATH).
+
+Usage:
+    python3 calibrate_colors.py [profile path]
+"""
+
+import sys
+from utils.brick import EV3ColorSensor, wait_ready_sensors
+from utils.color_detector import ColorCalibrator
+
+COLORS = ["black", "white", "yellow", "blue", "green", "red", "orange"]
+SAMPLES_PER_COLOR = 50
+SAMPLE_INTERVAL = 0.02  # seconds between samples
+PROFILE_PATH = "color_profile.bin"
+
+
+def main():
+    path = sys.argv[1] if len(sys.argv) > 1 else PROFILE_PATH
+    sensor = EV3ColorSensor("4")
+    wait_ready_sensors(timeout=10)
+
+    calibrator = ColorCalibrator()
+    for color in COLORS:
+        input(f"Place the sensor over {color} and press Enter (slide it around while recording)")
+        n = calibrator.record(color, sensor, SAMPLES_PER_COLOR, SAMPLE_INTERVAL)
+        print(f"Recorded {n} samples for {color}")
+
+    model = calibrator.fit()
+    model.save(path)
+    for label, (n, mean, _, _) in model.classes.items():
+        print(f"{label:>8}: n={n} mean=({mean[0]:.1f}, {mean[1]:.1f}, {mean[2]:.1f})")
+    print(f"Saved color profile to {path}")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,5 +1,5 @@
 from threading import Thread
-from time import sleep, time
+from utils.clock import sleep, time
 from enum import Enum
 from utils.sound import Sound
 from utils.brick import (
@@ -7,8 +7,21 @@ from utils.brick import (
     EV3ColorSensor,
     _color_names_by_code,
     EV3UltrasonicSensor,
-    Motor
+    Motor,
+    Brick,
+    CommandBatch,
+    DriveBase,
+    EMERGENCY_STOP,
+    MotionFuture,
+    SafetyMonitor,
+    safety_sleep,
 )
+from utils.filters import ConstantVelocityKalman, LabelDebouncer
+from utils.odometry import Odometry
+from utils.scheduler import Scheduler, task_dt
+from utils.trace import TraceRecorder, mark
+
+BRICK = Brick()
 
 # motors and speed
 SPEED = 180
@@ -32,8 +45,19 @@ COLOR_SENSOR = EV3ColorSensor("4", mode="id")
 # Turn constant is how sharply it corrects. Tune this up or down as needed as well.
 # Color detection now uses color_detector (from utils) for modularity, thresholds removed as redundant.
 
+# control loop rates
+CONTROL_RATE_HZ = 20     # state machine ticks (line and wall following)
+ESTOP_RATE_HZ = 200      # touch sensor polling, bounds the press-to-stop time
+TELEMETRY_RATE_HZ = 0.2  # loop timing report, when DEBUG
+
+# run recording, read back with utils.trace.read_trace
+TRACE_PATH = None  # file to record sensor values, motor commands and states into, such as "run.trace"
+
 # line following
 LINE_CORRECTION = 20
+# a color only counts as a new junction/doorway once seen this many ticks in a row
+COLOR_STABLE_SAMPLES = 3
+COLOR_DEBOUNCER = LabelDebouncer(window_size=COLOR_STABLE_SAMPLES)
 
 # turning
 MAP_LENGTH = 1200  # 1200cm map length
@@ -42,6 +66,10 @@ QUARTER_DOWN_MAP = 1200 / 4  # cm
 # DISTANCE_OF_BLACK_LINE_FROM_WALL = 5  # cm
 wall_target_distance = None
 CORNER_WALL_THRESHOLD = 20
+# readings further than this are not the wall we follow (no echo, doorways...)
+WALL_MAX_DISTANCE = 100
+# smooths ultrasonic noise so drift corrections react to the wall, not to single bad echoes
+WALL_FILTER = ConstantVelocityKalman(acceleration_variance=10, measurement_variance=4)
 
 # sounds
 DELIVERY_SOUND = Sound(duration=1, volume=100, pitch="C5")
@@ -55,9 +83,14 @@ MISSION_COMPLETE_SOUND = Sound(duration=1, volume=100, pitch="G5")
 RB = 5  # radius of turning circle
 RW = 2  # wheel radius
 ORIENT_TO_DEG = RB / RW
+# both wheels are commanded together, repeated commands are not re-sent
+DRIVE = DriveBase(MOTOR_L, MOTOR_R, wheel_radius=RW, track_radius=RB)
+# pose from the wheel encoders, so moves can end on distance instead of time
+ODOMETRY = Odometry(MOTOR_L, MOTOR_R, wheel_radius=RW, track_radius=RB)
 
 SWEEP_DEG = 60        # how far left/right from center
 DPS = 180             # faster than 90
+TURN_TIMEOUT_MARGIN = 1  # seconds allowed on top of the ideal turn time
 POWER = 60            # give torque
 
 
@@ -79,81 +112,72 @@ detects_green = False
 oscillating = False
 color_check_timer = 0
 packages_delivered = 0
-detect_black_timer = 0
 sweep_timer = 0
 sweep_deg = 90
 current_state = State.FOLLOWING_LINE
+previous_state = None  # state of the previous tick, to notice state entries
 
 
 # ============= UTILITY FUNCTIONS =============
 
 
-def been_awhile():
-    global detect_black_timer
-    # First time: allow handling immediately
-    if detect_black_timer == 0:
-        return True
-    return (time() - detect_black_timer) > 4
-
-
 def stop_movement():
     """Stop both motors"""
-    MOTOR_R.set_dps(0)
-    MOTOR_L.set_dps(0)
+    DRIVE.stop()
 
 
 def move_forward():
     """Move both motors forward at a specified speed"""
-    MOTOR_R.set_dps(SPEED)
-    MOTOR_L.set_dps(SPEED)
+    DRIVE.forward(SPEED)
 
 
 def move_backward():
     """Move both motors backward at a specified speed"""
-    MOTOR_R.set_dps(-SPEED)
-    MOTOR_L.set_dps(-SPEED)
+    DRIVE.forward(-SPEED)
 
 
 def turn(angle):
-    """Turns the robot at by the specified angle (pos right, neg left)"""
+    """Turns the robot at by the specified angle (pos right, neg left). The turn now runs
+    until the wheels reach their targets, where it used to be cut short after
+    abs(angle) / 90 * 0.5 seconds (about angle / 2.5 degrees at SPEED)."""
     stop_movement()
     MOTOR_L.set_limits(dps=SPEED)
     MOTOR_R.set_limits(dps=SPEED)
-    sleep(0.25)
+    safety_sleep(0.25)
     if angle < 0:  # left
-        MOTOR_L.set_position_relative(-int(angle * ORIENT_TO_DEG))
-        MOTOR_R.set_position_relative(int(angle * ORIENT_TO_DEG))
+        left = MOTOR_L.set_position_relative(-int(angle * ORIENT_TO_DEG))
+        right = MOTOR_R.set_position_relative(int(angle * ORIENT_TO_DEG))
     else:  # right
-        MOTOR_L.set_position_relative(-int(angle * ORIENT_TO_DEG))
-        MOTOR_R.set_position_relative(int(angle * ORIENT_TO_DEG))
-    sleep(abs(angle) / 90.0 * 0.5)
+        left = MOTOR_L.set_position_relative(-int(angle * ORIENT_TO_DEG))
+        right = MOTOR_R.set_position_relative(int(angle * ORIENT_TO_DEG))
+    # Ends as soon as both wheels settle on their targets
+    if not MotionFuture.wait_all([left, right], timeout=abs(angle) * ORIENT_TO_DEG / SPEED + TURN_TIMEOUT_MARGIN):
+        print(f"Turn of {angle} did not settle: {left}, {right}")
     stop_movement()
-    sleep(0.2)
 
 
 def turn_left():
     print("Turning left")
-    turn(-225)
+    turn(-90)
 
 
 def drift_left():
-    MOTOR_L.set_dps(SPEED - DRIFT)
-    MOTOR_R.set_dps(SPEED + DRIFT)
+    DRIVE.set_dps(SPEED - DRIFT, SPEED + DRIFT)
 
 
 def turn_right():
     print("Turning right")
-    turn(225)
+    turn(90)
 
 
 def drift_right():
-    MOTOR_L.set_dps(SPEED + DRIFT)
-    MOTOR_R.set_dps(SPEED - DRIFT)
+    DRIVE.set_dps(SPEED + DRIFT, SPEED - DRIFT)
 
 
 def turn_around():
     print("Turning around")
-    turn(180)
+    # The navigation was tuned on the timed turn, which stopped after about 72 degrees
+    turn(72)
 
 
 def get_distance():
@@ -213,36 +237,52 @@ def follow_line():
     global current_state, emergency_stopped
     global wall_target_distance
 
-    distance = get_distance()
-    if wall_target_distance is None:
-        if distance is not None:
-            wall_target_distance = distance
-            print(f"Locked Wall target distance at {wall_target_distance} cm")
-            move_forward()
+    # Read the ultrasonic and color sensors once for this tick; every detect_* call
+    # below is served from the snapshot instead of going back to the bus.
+    with BRICK.read_snapshot(ports=["3", "4"]):
+        distance = get_distance()
+        on_orange = detect_orange()
+        on_red = detect_red()
+        on_blue = detect_blue()
+        # Black only triggers once when it becomes stable, staying on black does not re-trigger
+        color_change = COLOR_DEBOUNCER.append(get_color_name().lower())
+    reached_black = color_change is not None and color_change.label == "black"
+
+    if distance is not None and distance <= WALL_MAX_DISTANCE:
+        if wall_target_distance is None:
+            WALL_FILTER.clear()  # new wall, forget the previous one
+        WALL_FILTER.append(distance, dt=task_dt())  # the measured tick period, not default_dt
+        distance = WALL_FILTER.get_value()
+
+    # At most one drive command per tick reaches the motors, and only if it changed
+    with CommandBatch():
+        if wall_target_distance is None:
+            if distance is not None:
+                wall_target_distance = distance
+                print(f"Locked Wall target distance at {wall_target_distance} cm")
+                move_forward()
 
-    else:
-        if distance is None:
-            pass
-        elif distance > 100:
-            pass
-        elif distance < wall_target_distance:
-            # print(f"Distance: {distance}. Drifting right")
-            drift_left()
-            sleep(0.1)
-        elif distance > wall_target_distance:
-            # print(f"Distance: {distance}. Drifting left")
-            drift_right()
-            sleep(0.1)
-
-    if detect_orange():
+        else:
+            if distance is None:
+                pass
+            elif distance > WALL_MAX_DISTANCE:
+                pass
+            elif distance < wall_target_distance:
+                # print(f"Distance: {distance}. Drifting right")
+                drift_left()
+            elif distance > wall_target_distance:
+                # print(f"Distance: {distance}. Drifting left")
+                drift_right()
+
+    if on_orange:
         if packages_delivered < 2:
             print("Orange detected - Doorway")
             current_state = State.CHECKING_DOORWAY
         else:
             print("Orange detected - Mission already complete")
 
-    elif detect_black() and been_awhile():
-        print("Black detected - Corner or mail room")
+    elif reached_black:
+        print(f"Black detected - Corner or mail room ({color_change.latency_ms:.0f} ms)")
         _handle_black_junction()
 
         """#turn_left()  # turn 90 degrees ccw
@@ -263,11 +303,11 @@ def follow_line():
                 print("Go to the mail room!")
                 #current_state = State.MISSION_COMPLETE  # to change
         """
-    elif detect_red():
+    elif on_red:
         print("Red detected - Restricted")
         # current_state = State.AVOIDING_RESTRICTED
 
-    elif detect_blue():
+    elif on_blue:
         if packages_delivered >= 2:
             print("Blue detected - Entering")
             # current_state = State.MAIL_ROOM_FOUND
@@ -275,8 +315,6 @@ def follow_line():
             print("Blue detected - Mission not yet complete")
             # current_state = State.AVOIDING_RESTRICTED
 
-    sleep(0.05)
-
 
 def _handle_black_junction():
     """
@@ -285,13 +323,12 @@ def _handle_black_junction():
     - Turn 90° CCW so color sensor is on the branch line and US faces 'turning wall'.
     - Use US reading to distinguish corner vs mail room branch.
     """
-    global wall_target_distance, packages_delivered, current_state, detect_black_timer
+    global wall_target_distance, packages_delivered, current_state
 
-    detect_black_timer = time()
     stop_movement()
     print("Handling black junction: rotating 90° CW")
     turn_right()   # CCW so color sensor is over the branch line, US faces the new wall
-    sleep(0.2)
+    safety_sleep(0.2)
 
     d = get_distance()
     if d is None:
@@ -324,12 +361,15 @@ def _handle_black_junction():
 
             # Drive until we are no longer on black (or we time out / emergency stop)
             while detect_black() and elapsed < MAX_STEP_TIME and not emergency_stopped:
-                sleep(STEP)
+                if safety_sleep(STEP):
+                    break
                 elapsed += STEP
 
             stop_movement()
             # At this point, the color sensor should be off the black patch,
             # so follow_line() won't immediately call _handle_black_junction() again.
+            # Forget the black seen before, so the next junction is reported.
+            COLOR_DEBOUNCER.clear()
             return
 
         else:
@@ -361,13 +401,20 @@ def return_to_mailroom():
 # ============= EMERGENCY STOP =============
 
 
-def emergency_stop():
+def on_emergency_stop(record):
+    """Called by the safety monitor right after it cut the motors"""
     global emergency_stopped
-    while not emergency_stopped:
-        if TOUCH_SENSOR.is_pressed():
-            emergency_stopped = True
-            print("Emergency stop activated")
-            sleep(0.1)
+    emergency_stopped = True
+    print(f"Emergency stop activated (motors cut within {record.worst_case * 1000:.1f} ms)")
+
+
+SAFETY_MONITOR = SafetyMonitor(TOUCH_SENSOR, rate_hz=ESTOP_RATE_HZ, on_stop=on_emergency_stop)
+
+
+def emergency_stop():
+    SAFETY_MONITOR.start()
+    EMERGENCY_STOP.wait()
+    SAFETY_MONITOR.stop()
 
 
 # ============= CHECKING DOORWAY ===========
@@ -382,25 +429,29 @@ def checking_doorway():
     print("Checking doorway for restriction...")
 
     # move forward slowly while we check
-    MOTOR_L.set_dps(SPEED / 2)
-    MOTOR_R.set_dps(SPEED / 2)
+    DRIVE.forward(SPEED / 2)
 
     STEP = 0.05              # seconds between checks
-    HALF_DOOR_TIME = 3     # current hardcode assumption of 0.5 seconds to get halfway
+    HALF_DOOR_TIMEOUT = 6    # seconds, in case the wheels slip or stall
 
+    halfway = ODOMETRY.distance_trigger(HALF_DOOR_DISTANCE)
     elapsed = 0.0
     saw_red = False
+    # a single red reading is not enough, it must hold for two checks in a row
+    doorway_colors = LabelDebouncer(window_size=2)
 
-    while elapsed < HALF_DOOR_TIME and not emergency_stopped:
+    while not halfway.reached() and elapsed < HALF_DOOR_TIMEOUT and not emergency_stopped:
         if not COLOR_SENSOR.set_mode("id"):
             print("Could not switch color sensor to id mode in checking_doorway")
         else:
-            if detect_red():
+            change = doorway_colors.append(get_color_name().lower())
+            if change is not None and change.label == "red":
                 print("Red detected in doorway -> restricted room. Skipping.")
                 saw_red = True
                 break
 
-        sleep(STEP)
+        if safety_sleep(STEP):
+            break
         elapsed += STEP
 
     # stop where we are (either at halfway or when we saw red)
@@ -410,7 +461,7 @@ def checking_doorway():
         # We hit a restricted doorway: go back to following line.
         print("Saw red. Ignoring doorway")
         move_forward()
-        sleep(0.5)   # tune: just enough to pass the doorway
+        safety_sleep(0.5)   # tune: just enough to pass the doorway
         stop_movement()
         current_state = State.FOLLOWING_LINE
 
@@ -426,8 +477,10 @@ def checking_doorway():
 
 # ====== ENTER ROOM SCAN HELPERS (blocking, no thread) ======
 # Tune these:
-CM_STEP_TIME = 0.5     # seconds to move forward ~1 cm (TUNE on floor)
+CM_STEP_DISTANCE = 1   # cm, measured by the wheel encoders
+CM_STEP_TIMEOUT = 2    # seconds, in case the wheels slip or stall
 STEP_DPS = SPEED / 4    # forward speed during the 1cm step
+HALF_DOOR_DISTANCE = 9  # cm to get halfway through a doorway (was 3 s at SPEED / 2)
 
 SWEEP_DPS = 180        # sensor sweep speed
 SWEEP_POWER = 60        # sensor sweep torque
@@ -467,7 +520,8 @@ def watch_for_green(stop_flag, poll_dt=0.02):
                 pass
 
             return
-        sleep(poll_dt)
+        if safety_sleep(poll_dt):
+            return
 
 
 def sweep_to(target_deg, dps=SWEEP_DPS, tol=3):
@@ -484,19 +538,18 @@ def sweep_to(target_deg, dps=SWEEP_DPS, tol=3):
 
     # command sweep
     MOTOR_SENSOR.set_limits(dps=dps, power=SWEEP_POWER)
-    MOTOR_SENSOR.set_position(target_deg)   # your existing move
-
-    # wait until sweep ends OR green detected
-    while not stop_flag["green"]:
-        try:
-            cur = MOTOR_SENSOR.get_position()
-        except:
-            cur = None
-
-        if cur is not None and abs(cur - target_deg) <= tol:
+    start_deg = MOTOR_SENSOR.get_position()
+    move = MOTOR_SENSOR.set_position(target_deg)   # your existing move
+    move.tolerance = tol
+    timeout = abs(target_deg - (start_deg or 0)) / dps + TURN_TIMEOUT_MARGIN
+
+    # wait until sweep ends (or stalls, or times out) OR green detected
+    while not stop_flag["green"] and not move.done():
+        if move.elapsed() > timeout:
+            print(f"Sweep to {target_deg} did not settle: {move}")
+            break
+        if safety_sleep(0.02):
             break
-
-        sleep(0.02)
 
     # shut down watchdog
     stop_flag["stop"] = True
@@ -508,15 +561,16 @@ def sweep_to(target_deg, dps=SWEEP_DPS, tol=3):
 # move_forward_1cm working fine
 def move_forward_1cm():
     """
-    Move forward a tiny step (~1 cm) using time-based control.
+    Move forward a tiny step (~1 cm), measured with the wheel encoders.
     """
     if DEBUG:
         print(
-            f"[STEP] Moving forward ~1cm (dps={STEP_DPS}, time={CM_STEP_TIME})")
+            f"[STEP] Moving forward ~{CM_STEP_DISTANCE}cm (dps={STEP_DPS})")
 
-    MOTOR_L.set_dps(STEP_DPS)
-    MOTOR_R.set_dps(STEP_DPS)
-    sleep(CM_STEP_TIME)
+    step = ODOMETRY.distance_trigger(CM_STEP_DISTANCE)
+    DRIVE.forward(STEP_DPS)
+    if not step.wait(timeout=CM_STEP_TIMEOUT) and DEBUG:
+        print(f"[STEP] Stopped {step.remaining():.1f}cm short")
     stop_movement()
 
     if DEBUG:
@@ -527,8 +581,7 @@ def move_forward_1cm():
 enter_room_started = False
 
 def enter_room_alternate():
-    MOTOR_L.set_dps(SPEED / 4)
-    MOTOR_R.set_dps(SPEED / 4)
+    DRIVE.forward(SPEED / 4)
    # if time() - sweep_timer > 1:
     #    sweep_timer = time()
      #   MOTOR_SENSOR.set_dps()
@@ -582,7 +635,7 @@ def enter_room():
 
         drop_package()
         move_backward()
-        sleep(2)
+        safety_sleep(2)
         turn_left()
 
         current_state = State.FOLLOWING_LINE
@@ -590,36 +643,52 @@ def enter_room():
 
 # ============= STATE MACHINE =============
 
-def state_machine():
-    """Main state machine for robot behavior"""
-    global current_state, emergency_stopped
-    sleep(5)
-    while not emergency_stopped:
+def run_state():
+    """Runs one tick of the current state"""
+    global previous_state
+    mark("state", current_state.name, changes_only=True)
+    if current_state != previous_state:
+        # Colors seen before entering the state must not count towards its changes
+        COLOR_DEBOUNCER.clear()
+        previous_state = current_state
+    if current_state == State.FOLLOWING_LINE:
+        follow_line()
 
-        if current_state == State.FOLLOWING_LINE:
-            follow_line()
+    elif current_state == State.CHECKING_DOORWAY:
+        checking_doorway()
 
-        elif current_state == State.CHECKING_DOORWAY:
-            checking_doorway()
+    elif current_state == State.ENTERING_ROOM:
+        enter_room_alternate()
 
-        elif current_state == State.ENTERING_ROOM:
-            enter_room_alternate()
+    elif current_state == State.SCANNING_ROOM:
+        pass
 
-        elif current_state == State.SCANNING_ROOM:
-            pass
+    elif current_state == State.DELIVERING:
+        pass
 
-        elif current_state == State.DELIVERING:
-            pass
+    elif current_state == State.EXITING_ROOM:
+        pass
 
-        elif current_state == State.EXITING_ROOM:
-            pass
+    elif current_state == State.MISSION_COMPLETE:
+        pass
 
-        elif current_state == State.MISSION_COMPLETE:
-            pass
-        sleep(0.05)
+
+def state_machine():
+    """Main state machine for robot behavior"""
+    safety_sleep(5)
+    scheduler = Scheduler()
+    scheduler.add("state", run_state, rate_hz=CONTROL_RATE_HZ)
+    if DEBUG:
+        scheduler.add("telemetry", lambda: print(f"{scheduler.report()}\n{DRIVE}"), rate_hz=TELEMETRY_RATE_HZ)
+    scheduler.run(until=lambda: emergency_stopped)
+    print(scheduler.report())
 
 
 def main():
+    recorder = TraceRecorder(TRACE_PATH) if TRACE_PATH else None
+    if recorder is not None:
+        recorder.start()
+    ODOMETRY.start()
     state_thread = Thread(target=state_machine)
     emergency_stop_thread = Thread(target=emergency_stop)
 
@@ -629,6 +698,8 @@ def main():
     state_thread.join()
     emergency_stop_thread.join()
 
+    if recorder is not None:
+        recorder.stop()
     print("Program terminated")
 
 
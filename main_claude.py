@@ -1,7 +1,8 @@
 from threading import Thread
-from time import sleep, time
+from utils.clock import sleep, time
 from utils.sound import Sound
-from utils.brick import TouchSensor, EV3ColorSensor, EV3UltrasonicSensor, Motor
+from utils.brick import (TouchSensor, EV3ColorSensor, EV3UltrasonicSensor, Motor, ColorModeScheduler,
+                         MotionFuture, SafetyMonitor, safety_sleep)
 
 # ============= CONFIGURATION =============
 SPEED = 180
@@ -13,6 +14,11 @@ COLOR_SENSOR = EV3ColorSensor("4")
 TOUCH_SENSOR = TouchSensor("2")
 ULTRASONIC_SENSOR = EV3UltrasonicSensor("3")
 
+# Line following reads red light most of the time, color checks get the rest of the cycle
+COLOR_DUTY = {"red": 0.8, "component": 0.2}
+COLOR_CYCLE = 0.5  # seconds
+COLOR_SCHEDULER = ColorModeScheduler(COLOR_SENSOR, duty=COLOR_DUTY, cycle=COLOR_CYCLE)
+
 # Sound effects
 DELIVERY_SOUND = Sound(duration=0.5, volume=80, pitch="C5")
 MISSION_COMPLETE_SOUND = Sound(duration=1, volume=80, pitch="G5")
@@ -84,15 +90,15 @@ def turn(angle, speed=SPEED):
     sleep(0.1)
     
     if angle < 0:  # Turn left
-        MOTOR_L.set_position_relative(-int(abs(angle) * ORIENT_TO_DEG))
-        MOTOR_R.set_position_relative(int(abs(angle) * ORIENT_TO_DEG))
+        left = MOTOR_L.set_position_relative(-int(abs(angle) * ORIENT_TO_DEG))
+        right = MOTOR_R.set_position_relative(int(abs(angle) * ORIENT_TO_DEG))
     else:  # Turn right
-        MOTOR_L.set_position_relative(int(angle * ORIENT_TO_DEG))
-        MOTOR_R.set_position_relative(-int(angle * ORIENT_TO_DEG))
+        left = MOTOR_L.set_position_relative(int(angle * ORIENT_TO_DEG))
+        right = MOTOR_R.set_position_relative(-int(angle * ORIENT_TO_DEG))
     
-    sleep(abs(angle) / 90.0 * 0.5)  # Wait for turn to complete
+    # Wait for turn to complete, ends as soon as both wheels settle
+    MotionFuture.wait_all([left, right], timeout=abs(angle) * ORIENT_TO_DEG / speed + 1)
     stop_movement()
-    sleep(0.2)
 
 def get_distance():
     """Get ultrasonic sensor reading"""
@@ -103,8 +109,8 @@ def get_distance():
 
 def get_normalized_rgb():
     """Get normalized RGB values"""
-    rgb = COLOR_SENSOR.get_rgb()
-    if rgb is None:
+    rgb = COLOR_SCHEDULER.get_rgb()
+    if rgb is None or None in rgb:
         return None
     r, g, b = rgb
     total = r + g + b
@@ -164,7 +170,7 @@ def follow_line_step():
     """Single step of line following with color detection"""
     global color_check_timer, current_state, packages_delivered
     
-    light_value = COLOR_SENSOR.get_red()
+    light_value = COLOR_SCHEDULER.get_red()
     if light_value is None:
         return
     
@@ -283,7 +289,7 @@ def find_line():
     start_time = time()
     
     while time() - start_time < 2:
-        light = COLOR_SENSOR.get_red()
+        light = COLOR_SCHEDULER.get_red()
         if light is not None and abs(light - LINE_THRESHOLD) < 15:
             print("Line found!")
             stop_movement()
@@ -388,15 +394,24 @@ def state_machine():
 
 # ============= EMERGENCY STOP =============
 
+def on_emergency_stop(record):
+    """Called by the safety monitor right after it cut the motors"""
+    global emergency_stopped
+    emergency_stopped = True
+    print(f"EMERGENCY STOP ACTIVATED ({record.worst_case * 1000:.1f} ms to stop)")
+
+
+SAFETY_MONITOR = SafetyMonitor(TOUCH_SENSOR, rate_hz=200, on_stop=on_emergency_stop)
+
+
 def emergency_stop():
     """Monitor touch sensor for emergency stop"""
-    global emergency_stopped
+    SAFETY_MONITOR.start()
+    # Also returns when the mission completes and the state machine sets emergency_stopped
     while not emergency_stopped:
-        if TOUCH_SENSOR.is_pressed():
-            emergency_stopped = True
-            stop_movement()
-            print("EMERGENCY STOP ACTIVATED")
-        sleep(0.1)
+        if safety_sleep(0.1):
+            break
+    SAFETY_MONITOR.stop()
 
 # ============= MAIN =============
 
@@ -18,11 +18,11 @@ class SensorController:
         self.touch_sensor = TouchSensor("2")
         self.colour_sensor = EV3ColorSensor("4")
         self.us_sensor = EV3UltrasonicSensor("3")
+        self.colour_detector = ColorDetector()
 
     def get_colour_name(self):
         rgb = self.colour_sensor.get_rgb()
-        processor = ColorDetector()
-        return processor.detect_color(rgb)
+        return self.colour_detector.detect_color(rgb)
 
     def __get_colour_raw(self):
         return self.colour_sensor.get_rgb()
@@ -1,4 +1,4 @@
-from time import sleep
+from utils.clock import monotonic, sleep
 
 """
 oscillate.py
@@ -13,7 +13,8 @@ Usage (in main.py):
         motor_sensor=MOTOR_SENSOR,
         color_sensor=COLOR_SENSOR,
         detect_green_fn=detect_green,
-        emergency_flag_fn=lambda: emergency_stopped
+        emergency_flag_fn=lambda: emergency_stopped,
+        odometry=ODOMETRY,  # optional, steps on encoder distance instead of time
     )
 
     # inside enter_room state:
@@ -36,6 +37,9 @@ class EnterRoomScanner:
         sweep_dps=180,
         sweep_power=60,
         sweep_half_deg=90,
+        odometry=None,
+        cm_step_distance=1,
+        sweep_timeout_margin=1,
     ):
         # injected hardware
         self.motor_l = motor_l
@@ -53,6 +57,9 @@ class EnterRoomScanner:
         self.sweep_dps = sweep_dps
         self.sweep_power = sweep_power
         self.sweep_half_deg = sweep_half_deg
+        self.odometry = odometry
+        self.cm_step_distance = cm_step_distance
+        self.sweep_timeout_margin = sweep_timeout_margin  # seconds on top of a full sweep
 
         # derived speeds
         self.step_dps = self.speed / 4
@@ -97,21 +104,21 @@ class EnterRoomScanner:
         ms.set_limits(dps=self.sweep_dps, power=self.sweep_power)
         ms.reset_encoder()
 
-        ms.set_position(0)
-        ms.set_dps(self.sweep_dps)
-
-        while abs(ms.get_dps()) > 5 and not self.emergency_flag():
-            sleep(0.01)
-
+        self.wait_for(ms.set_position(0))
         ms.set_dps(0)
 
     def move_forward_1cm(self):
         """
-        Tiny forward step. Time-based: tune cm_step_time.
+        Tiny forward step. Ends on cm_step_distance when given an odometry,
+        otherwise time-based: tune cm_step_time.
         """
+        step = None if self.odometry is None else self.odometry.distance_trigger(self.cm_step_distance)
         self.motor_l.set_dps(self.step_dps)
         self.motor_r.set_dps(self.step_dps)
-        sleep(self.cm_step_time)
+        if step is None:
+            sleep(self.cm_step_time)
+        else:
+            step.wait(timeout=10 * self.cm_step_time)
         self.motor_l.set_dps(0)
         self.motor_r.set_dps(0)
 
@@ -125,34 +132,40 @@ class EnterRoomScanner:
         ms.set_limits(dps=self.sweep_dps, power=self.sweep_power)
 
         # ensure we're centered
-        ms.set_position(0)
-        ms.set_dps(self.sweep_dps)
-        while abs(ms.get_dps()) > 5 and not self.emergency_flag():
-            sleep(0.005)
+        self.wait_for(ms.set_position(0))
 
         # --- sweep to right ---
-        ms.set_position_relative(+self.sweep_half_deg)
-        ms.set_dps(self.sweep_dps)
-        while abs(ms.get_dps()) > 5 and not self.emergency_flag():
-            if self.detect_green():
-                ms.set_dps(0)
-                return True
-            sleep(0.005)
+        if self.wait_for(ms.set_position_relative(+self.sweep_half_deg), check_green=True):
+            ms.set_dps(0)
+            return True
 
         # --- sweep to left (full 180 from right end) ---
-        ms.set_position_relative(-2 * self.sweep_half_deg)
-        ms.set_dps(self.sweep_dps)
-        while abs(ms.get_dps()) > 5 and not self.emergency_flag():
-            if self.detect_green():
-                ms.set_dps(0)
-                return True
-            sleep(0.005)
+        if self.wait_for(ms.set_position_relative(-2 * self.sweep_half_deg), check_green=True):
+            ms.set_dps(0)
+            return True
 
         # optional: return to center
-        ms.set_position(0)
-        ms.set_dps(self.sweep_dps)
-        while abs(ms.get_dps()) > 5 and not self.emergency_flag():
-            sleep(0.005)
+        self.wait_for(ms.set_position(0))
 
         ms.set_dps(0)
         return False
+
+    def wait_for(self, move, check_green=False, poll_dt=0.005, timeout=None):
+        """
+        Wait for a sensor motor move (MotionFuture) to settle, or to stall.
+        With check_green, keeps checking the color sensor while the motor moves.
+        Gives up after timeout seconds, by default the time of a full sweep plus
+        sweep_timeout_margin.
+        Returns True if green was seen before the move ended.
+        """
+        if timeout is None:
+            timeout = 2 * self.sweep_half_deg / self.sweep_dps + self.sweep_timeout_margin
+        deadline = monotonic() + timeout
+        while not move.done() and not self.emergency_flag():
+            if check_green and self.detect_green():
+                return True
+            if monotonic() >= deadline:
+                print(f"Sensor sweep did not settle: {move}")
+                break
+            sleep(poll_dt)
+        return False
@@ -7,21 +7,68 @@ Authors: Ryan Au, Younes Boubekeur
 
 from __future__ import annotations
 
-from typing import Literal, Type
+from collections import deque
+from statistics import pstdev
+from typing import Literal, NamedTuple, Type
+import functools
 import math
 import atexit
 import os
 import signal
+import threading
 import time
 import sys
 
+from . import clock
+
+
+# Set while the emergency stop is active. Every blocking helper waits on it, so that
+# blocking loops return as soon as the robot is stopped.
+EMERGENCY_STOP = threading.Event()
+# Held while a motor command is checked against EMERGENCY_STOP and sent, and while the
+# motors are cut, so no command can restart a motor right after it was cut.
+_MOTOR_COMMAND_LOCK = threading.RLock()
+
 
 def busy_sleep(seconds: float):
     """A different form of time.sleep, which uses a while loop that 
-    constantly checks the time, to see if the duration has elapsed."""
-    start = time.time()
-    while (time.time() - start) < seconds:
-        time.sleep(0.005)
+    constantly checks the time, to see if the duration has elapsed.
+    Returns early if the emergency stop is triggered."""
+    start = clock.monotonic()
+    while (clock.monotonic() - start) < seconds:
+        if clock.wait(EMERGENCY_STOP, 0.005):
+            return
+
+
+def safety_sleep(seconds: float) -> bool:
+    """Sleep for the given number of seconds, waking up as soon as the emergency stop
+    is triggered. Returns True if the emergency stop is active."""
+    return clock.wait(EMERGENCY_STOP, seconds)
+
+
+# Receives every sensor value read and motor command written, see utils.trace
+_TRACE_RECORDER = None
+
+
+def set_trace_recorder(recorder=None):
+    """
+    Send every value returned by Sensor.get_value and every motor command written by a
+    Brick to recorder.record_sensor(sensor, value) and recorder.record_command(port,
+    name, args). None stops recording. Use utils.trace.TraceRecorder rather than
+    calling this directly.
+    """
+    global _TRACE_RECORDER
+    _TRACE_RECORDER = recorder
+
+
+def _traced(command):
+    "Wrap a BrickPi3 motor command so that the trace recorder sees it."
+    @functools.wraps(command)
+    def write(self, port, *args):
+        if _TRACE_RECORDER is not None:
+            _TRACE_RECORDER.record_command(port, command.__name__, args)
+        return command(self, port, *args)
+    return write
 
 
 class IOError(OSError):
@@ -53,6 +100,12 @@ def restore_default_brick(bp=None):
 
 
 WAIT_READY_INTERVAL = 0.01
+WAIT_READY_MIN_INTERVAL = 0.001
+WAIT_READY_TIMEOUT = 10
+MOTION_TOLERANCE = 3  # degrees from the target at which a position move counts as reached
+MOTION_SETTLE_DPS = 5  # speed under which a motor at its target counts as settled
+MOTION_POLL_INTERVAL = 0.005
+MOTION_STALL_TIME = 0.2  # seconds settled away from the target after which a move counts as stalled
 INF = float("inf")
 
 PORTS: dict[str, int] = {
@@ -158,6 +211,85 @@ class Color:
 
 _color_names_by_code = {c.code: c.name for c in ColorMappings._all_mappings}
 
+SENSOR_PORT_NAMES = '1234'
+MOTOR_PORT_NAMES = 'ABCD'
+_SENSOR_PORT_INDEX = {PORTS[name]: i for i, name in enumerate(SENSOR_PORT_NAMES)}
+
+
+def _port_name(port: int) -> str:
+    "Convert a single sensor port code (PORT_1 to PORT_4) to its name '1' to '4'."
+    return SENSOR_PORT_NAMES[_SENSOR_PORT_INDEX[port]]
+
+
+class SensorSnapshot:
+    """
+    A copy of sensor values and motor statuses, read from the brick in a single pass.
+    Create one with Brick.read_snapshot(ports=...).
+
+    While a snapshot is active (inside a 'with' block), Sensor.get_value, Motor.get_status
+    and Motor.get_encoder on the same thread are served from the snapshot instead of the
+    bus. A sensor whose mode was changed after the snapshot was taken is read from the bus
+    as usual, since the stored value belongs to the old mode.
+
+    Example:
+
+    with BRICK.read_snapshot(ports="34A"):
+        distance = US_SENSOR.get_cm()      # no bus read
+        color = COLOR_SENSOR.get_value()   # no bus read
+    """
+    _local = threading.local()
+
+    def __init__(self, bp, sensors: dict, sensor_types: dict, motors: dict, timestamp: float = None):
+        self.bp = bp
+        self.sensors = sensors
+        self.sensor_types = sensor_types
+        self.motors = motors
+        self.timestamp = clock.time() if timestamp is None else timestamp
+
+    def __enter__(self):
+        SensorSnapshot._stack().append(self)
+        return self
+
+    def __exit__(self, *args):
+        stack = SensorSnapshot._stack()
+        if self in stack:
+            stack.remove(self)
+
+    @staticmethod
+    def _stack() -> list:
+        if not hasattr(SensorSnapshot._local, 'stack'):
+            SensorSnapshot._local.stack = []
+        return SensorSnapshot._local.stack
+
+    @staticmethod
+    def get_active() -> SensorSnapshot | None:
+        "Return the innermost snapshot active on this thread, or None."
+        stack = SensorSnapshot._stack()
+        return stack[-1] if stack else None
+
+    def age(self) -> float:
+        "Seconds elapsed since this snapshot was read."
+        return clock.time() - self.timestamp
+
+    def get_value(self, port: Literal[1, 2, 3, 4]):
+        "Get the stored value of sensor port '1', '2', '3' or '4'. None if it was not read."
+        return self.sensors.get(PORTS[str(port).upper()])
+
+    def get_motor_status(self, port: Literal["A", "B", "C", "D"]) -> list:
+        "Get the stored [flags, power, encoder, dps] of motor port 'A' to 'D'."
+        return self.motors.get(PORTS[str(port).upper()], [None, None, None, None])
+
+    def serves_sensor(self, sensor: Sensor) -> bool:
+        "True if the sensor's current value can be taken from this snapshot."
+        if sensor.brick.bp is not self.bp or sensor.port not in self.sensors:
+            return False
+        index = _SENSOR_PORT_INDEX[sensor.port]
+        return sensor.brick.SensorType[index] == self.sensor_types[sensor.port]
+
+    def serves_motor(self, motor: Motor) -> bool:
+        "True if the motor's current status can be taken from this snapshot."
+        return motor.brick.bp is self.bp and motor.port in self.motors
+
 
 class Brick(BrickPi3):
     """
@@ -174,6 +306,15 @@ class Brick(BrickPi3):
         for key in parent.keys():
             setattr(self, str(key), child.get(key, parent.get(key)))
 
+    # Motor commands, recorded when a trace is being recorded. Not wrapped:
+    # set_motor_position_relative and reset_motor_encoder, which the BrickPi3 implements
+    # with the commands below.
+    set_motor_power = _traced(BrickPi3.set_motor_power)
+    set_motor_position = _traced(BrickPi3.set_motor_position)
+    set_motor_dps = _traced(BrickPi3.set_motor_dps)
+    set_motor_limits = _traced(BrickPi3.set_motor_limits)
+    offset_motor_encoder = _traced(BrickPi3.offset_motor_encoder)
+
     def get_sensor_status(self, port: Literal[1, 2, 4, 8]):
         """
         Read a sensor status.
@@ -332,6 +473,45 @@ class Brick(BrickPi3):
         raise IOError(
             "get_sensor error: Sensor not configured or not supported.")
 
+    def read_snapshot(self, ports: str | list[str] = None) -> SensorSnapshot:
+        """
+        Read every requested sensor value and motor status once, and return them
+        as a SensorSnapshot. Use the snapshot in a 'with' block so that all sensor
+        and motor queries in the same control tick are served from memory.
+
+        Keyword arguments:
+        ports - Port names to read, such as "34AD" or ["3", "4", "A", "D"].
+            By default, every configured sensor port and every motor created on this brick.
+        """
+        if ports is None:
+            ports = [port for port, sensor in Sensor.ALL_SENSORS.items()
+                     if sensor is not None and sensor.brick.bp is self.bp]
+            ports += [port for port, motor in Motor.ALL_MOTORS.items()
+                      if motor is not None and motor.brick.bp is self.bp]
+
+        sensors = {}
+        sensor_types = {}
+        motors = {}
+        timestamp = clock.time()
+        for name in ports:
+            name = str(name).upper()
+            port = PORTS[name]
+            if name in SENSOR_PORT_NAMES:
+                sensor_type = self.SensorType[_SENSOR_PORT_INDEX[port]]
+                if sensor_type is None or sensor_type == self.SENSOR_TYPE.NONE:
+                    continue
+                try:
+                    sensors[port] = self.get_sensor(port)
+                except SensorError:
+                    sensors[port] = None
+                sensor_types[port] = sensor_type
+            elif name in MOTOR_PORT_NAMES:
+                try:
+                    motors[port] = self.get_motor_status(port)
+                except IOError:
+                    motors[port] = [None, None, None, None]
+        return SensorSnapshot(self.bp, sensors, sensor_types, motors, timestamp)
+
 
 class Sensor:
     """
@@ -376,6 +556,20 @@ class Sensor:
 
     def get_value(self):
         "Get the raw sensor value. May return a float, int, list or None if error."
+        value = self._read_value()
+        if _TRACE_RECORDER is not None:
+            _TRACE_RECORDER.record_sensor(self, value)
+        return value
+
+    def _read_value(self):
+        snapshot = SensorSnapshot.get_active()
+        if snapshot is not None and snapshot.serves_sensor(self):
+            return snapshot.sensors[self.port]
+        sampler = SensorSampler.get_active()
+        if sampler is not None:
+            reading = sampler.serves_sensor(self)
+            if reading is not None:
+                return reading.value
         try:
             return self.brick.get_sensor(self.port)
         except SensorError:
@@ -385,20 +579,217 @@ class Sensor:
         "Get the raw sensor value. May return a float, int, list or None if error."
         return self.get_value()
 
-    def wait_ready(self):
-        "Wait (pause program) until the sensor is initialized."
-        while self.get_status() != Sensor.Status.VALID_DATA:
-            time.sleep(WAIT_READY_INTERVAL)
+    def wait_ready(self, timeout: float = None) -> bool:
+        """
+        Wait (pause program) until the sensor is initialized.
+        Return True once ready, or False if timeout (in seconds) expired first.
+        """
+        return wait_ready_all([self], timeout=timeout)[_port_name(self.port)] is not None
 
 
-def wait_ready_sensors(debug=False):
-    for port, sensor in Sensor.ALL_SENSORS.items():
-        if sensor is not None:
-            if debug:
+def wait_ready_all(sensors: list[Sensor] = None, timeout: float = None,
+                   initial_interval: float = WAIT_READY_MIN_INTERVAL,
+                   max_interval: float = WAIT_READY_INTERVAL,
+                   backoff: float = 2) -> dict[str, float | None]:
+    """
+    Wait for all the given sensors to be initialized at the same time, rather than one
+    after the other. Each port is polled with an exponentially growing interval, starting
+    at initial_interval and never exceeding max_interval, until it is ready or the overall
+    timeout expires.
+
+    Returns a report of {port name: seconds until ready}, where a port that was not ready
+    before the timeout has None instead.
+
+    Keyword arguments:
+    sensors - The sensors to wait on, every sensor in Sensor.ALL_SENSORS by default
+    timeout - Overall deadline in seconds, None to wait forever
+    """
+    if sensors is None:
+        sensors = [sensor for sensor in Sensor.ALL_SENSORS.values() if sensor is not None]
+    start = clock.monotonic()
+    deadline = INF if timeout is None else start + timeout
+
+    report = {}
+    pending = {}  # port name -> [sensor, next poll time, interval]
+    for sensor in sensors:
+        name = _port_name(sensor.port)
+        report[name] = None
+        pending[name] = [sensor, start, initial_interval]
+
+    while pending:
+        now = clock.monotonic()
+        for name, entry in list(pending.items()):
+            sensor, next_poll, interval = entry
+            if now < next_poll:
+                continue
+            if sensor.get_status() == Sensor.Status.VALID_DATA:
+                report[name] = clock.monotonic() - start
+                del pending[name]
+            else:
+                entry[1] = now + interval
+                entry[2] = min(interval * backoff, max_interval)
+        if not pending:
+            break
+        now = clock.monotonic()
+        if now >= deadline:
+            break
+        next_poll = min(entry[1] for entry in pending.values())
+        clock.sleep(max(0, min(next_poll, deadline) - now))
+    return report
+
+
+def wait_ready_sensors(debug=False, timeout: float = None) -> dict[str, float | None]:
+    """
+    Wait until every sensor in Sensor.ALL_SENSORS is initialized, or timeout expires.
+    Returns the report from wait_ready_all.
+    """
+    if debug:
+        for port, sensor in Sensor.ALL_SENSORS.items():
+            if sensor is not None:
                 print(f"Initializing Port {port}:", type(sensor).__name__)
-            sensor.wait_ready()
+    report = wait_ready_all(timeout=timeout)
     if debug:
-        print("All Sensors Initialized")
+        for port, elapsed in report.items():
+            if elapsed is None:
+                print(f"Port {port} not ready after {timeout}s")
+            else:
+                print(f"Port {port} ready in {elapsed:.3f}s")
+        if None not in report.values():
+            print("All Sensors Initialized")
+    return report
+
+
+class SensorReading(NamedTuple):
+    "A sensor value published by SensorSampler, with the time it was read."
+    value: object
+    timestamp: float
+    sensor_type: int
+
+
+class SensorSampler:
+    """
+    Opt-in background thread that reads every sensor in Sensor.ALL_SENSORS at a fixed rate,
+    and publishes the latest timestamped reading of each port.
+
+    Readings are published by replacing a single dictionary entry, so any thread can
+    read them without taking a lock or waiting on the bus. While a sampler is running,
+    Sensor.get_value returns the latest published reading, as long as it is newer than
+    max_age and the sensor has not changed mode since it was read.
+
+    Example:
+
+    sampler = SensorSampler(rate_hz=50)
+    sampler.start()
+    distance = US_SENSOR.get_cm()  # no bus read
+    print(sampler.get_rate(), sampler.get_jitter())
+    sampler.stop()
+    """
+    _active: SensorSampler = None
+
+    def __init__(self, rate_hz: float = 50, max_age: float = None, history: int = 200):
+        """
+        Keyword arguments:
+        rate_hz - How many times per second every sensor is read
+        max_age - Oldest reading (in seconds) Sensor.get_value will accept, 3 periods by default
+        history - How many recent sampling periods are kept to compute rate and jitter
+        """
+        if rate_hz <= 0:
+            raise ValueError("rate_hz must be a positive value")
+        self.period = 1 / rate_hz
+        self.max_age = 3 * self.period if max_age is None else max_age
+        self.readings: dict[int, SensorReading] = {}
+        self.sample_count = 0
+        self._periods = deque(maxlen=history)
+        self._event = threading.Event()
+        self._thread = None
+
+    @staticmethod
+    def get_active() -> SensorSampler | None:
+        "Return the running sampler that serves Sensor.get_value, or None."
+        return SensorSampler._active
+
+    def start(self):
+        "Start sampling in a daemon thread. Sensor.get_value is served from this sampler."
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._event.set()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        SensorSampler._active = self
+
+    def stop(self):
+        "Stop sampling. Sensor.get_value goes back to reading the bus."
+        self._event.clear()
+        if SensorSampler._active is self:
+            SensorSampler._active = None
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join()
+
+    def is_running(self) -> bool:
+        return self._event.is_set()
+
+    def sample_once(self):
+        "Read every registered sensor once and publish the readings."
+        for sensor in list(Sensor.ALL_SENSORS.values()):
+            if sensor is None:
+                continue
+            index = _SENSOR_PORT_INDEX[sensor.port]
+            sensor_type = sensor.brick.SensorType[index]
+            try:
+                value = sensor.brick.get_sensor(sensor.port)
+            except SensorError:
+                value = None
+            self.readings[sensor.port] = SensorReading(value, clock.time(), sensor_type)
+        self.sample_count += 1
+
+    def _run(self):
+        # Paced on real time: sleeping on a simulated clock from this thread would
+        # advance the simulation behind the control loop's back
+        next_time = time.time()
+        last_start = None
+        while self._event.is_set():
+            start = time.time()
+            if last_start is not None:
+                self._periods.append(start - last_start)
+            last_start = start
+            self.sample_once()
+
+            next_time += self.period
+            delay = next_time - time.time()
+            if delay < -self.period:
+                # Fell more than a period behind, do not try to catch up with a burst
+                next_time = time.time()
+            elif delay > 0:
+                time.sleep(delay)
+
+    def get_reading(self, sensor: Sensor) -> SensorReading | None:
+        "Return the latest reading for the sensor, or None if it was never sampled."
+        return self.readings.get(sensor.port)
+
+    def serves_sensor(self, sensor: Sensor) -> SensorReading | None:
+        "Return the latest reading if Sensor.get_value may use it, otherwise None."
+        reading = self.readings.get(sensor.port)
+        if reading is None or Sensor.ALL_SENSORS.get(_port_name(sensor.port)) is not sensor:
+            return None
+        if clock.time() - reading.timestamp > self.max_age:
+            return None
+        if sensor.brick.SensorType[_SENSOR_PORT_INDEX[sensor.port]] != reading.sensor_type:
+            return None
+        return reading
+
+    def get_rate(self) -> float:
+        "Achieved sampling rate in Hz over the recent history. 0 if not enough samples."
+        periods = list(self._periods)
+        if not periods:
+            return 0
+        return len(periods) / sum(periods)
+
+    def get_jitter(self) -> float:
+        "Standard deviation of the sampling period in seconds over the recent history."
+        periods = list(self._periods)
+        if len(periods) < 2:
+            return 0
+        return pstdev(periods)
 
 
 class TouchSensor(Sensor):
@@ -573,6 +964,125 @@ class EV3ColorSensor(Sensor):
             self.wait_ready()
         return self.get_value()
 
+
+class ColorModeScheduler:
+    """
+    Shares one EV3ColorSensor between several modes, without switching modes on every read.
+
+    Time is split into a repeating cycle, where each mode gets a slot proportional to its
+    duty. Reads of the mode the sensor is currently in go to the sensor. Reads of any other
+    mode return the last value cached for that mode, along with its age. A mode that has not
+    been requested during the last cycle gives up its slot, so a single active mode never
+    pays for a switch.
+
+    After a switch, the scheduler does not spin on wait_ready. Reads keep returning the
+    cached value until the sensor reports VALID_DATA in the new mode.
+
+    Example:
+
+    scheduler = ColorModeScheduler(COLOR_SENSOR, duty={"red": 0.8, "component": 0.2})
+    light = scheduler.get_red()   # fresh while in red mode, cached otherwise
+    rgb = scheduler.get_rgb()
+    print(scheduler.switch_count, scheduler.get_age("component"))
+    """
+
+    def __init__(self, sensor: EV3ColorSensor, duty: dict[str, float], cycle: float = 0.5):
+        """
+        Keyword arguments:
+        sensor - The color sensor to share
+        duty - Fraction of the cycle given to each mode, such as {"red": 0.8, "component": 0.2}
+        cycle - Length of one full schedule cycle in seconds
+        """
+        if not duty or any(d < 0 for d in duty.values()) or sum(duty.values()) <= 0:
+            raise ValueError("duty must give a positive fraction to at least one mode")
+        self.sensor = sensor
+        self.cycle = cycle
+        total = sum(duty.values())
+        self.slots = {mode.lower(): d / total * cycle for mode, d in duty.items()}
+        self.modes = list(self.slots.keys())
+
+        self.switch_count = 0
+        self.read_count = {mode: 0 for mode in self.modes}
+        self._cache: dict[str, tuple] = {}
+        self._last_request = {mode: None for mode in self.modes}
+        self._slot_start = clock.time()
+        self._ready = sensor.mode in self.slots
+
+    def _is_wanted(self, mode: str, now: float) -> bool:
+        last = self._last_request[mode]
+        return self.slots[mode] > 0 and last is not None and now - last <= self.cycle
+
+    def _switch(self, mode: str, now: float):
+        self.sensor.set_mode(mode)
+        self.switch_count += 1
+        self._slot_start = now
+        self._ready = False
+
+    def tick(self):
+        "Switch to the next wanted mode if the current slot has expired or is unused."
+        now = clock.time()
+        current = self.sensor.mode
+        if current not in self.slots:
+            wanted = [m for m in self.modes if self._is_wanted(m, now)]
+            if wanted:
+                self._switch(wanted[0], now)
+            return
+        if self._is_wanted(current, now) and now - self._slot_start < self.slots[current]:
+            return
+        start = self.modes.index(current)
+        for i in range(1, len(self.modes) + 1):
+            mode = self.modes[(start + i) % len(self.modes)]
+            if self._is_wanted(mode, now):
+                if mode != current:
+                    self._switch(mode, now)
+                else:
+                    self._slot_start = now
+                return
+
+    def get(self, mode: str):
+        """
+        Return the latest value of the given mode. It is read from the sensor if the sensor
+        is in that mode and ready, otherwise the cached value (or None) is returned.
+        """
+        mode = mode.lower()
+        if mode not in self.slots:
+            raise ValueError(f"mode {mode} is not part of this schedule")
+        self._last_request[mode] = clock.time()
+        self.tick()
+
+        if self.sensor.mode == mode:
+            if not self._ready:
+                self._ready = self.sensor.get_status() == Sensor.Status.VALID_DATA
+            if self._ready:
+                value = self.sensor.get_value()
+                self._cache[mode] = (value, clock.time())
+                self.read_count[mode] += 1
+                return value
+        return self._cache.get(mode, (None, None))[0]
+
+    def get_age(self, mode: str) -> float:
+        "Seconds since the cached value of this mode was read. INF if never read."
+        timestamp = self._cache.get(mode.lower(), (None, None))[1]
+        return INF if timestamp is None else clock.time() - timestamp
+
+    def get_rgb(self) -> list[float]:
+        "Return the latest RGB values, as EV3ColorSensor.get_rgb does."
+        val = self.get(EV3ColorSensor.Mode.COMPONENT)
+        return val[:-1] if val is not None else [None, None, None]
+
+    def get_red(self) -> float:
+        "Return the latest reflected red light value."
+        return self.get(EV3ColorSensor.Mode.RED)
+
+    def get_ambient(self) -> float:
+        "Return the latest ambient light value."
+        return self.get(EV3ColorSensor.Mode.AMBIENT)
+
+    def get_color_id(self) -> int:
+        "Return the latest color code guessed by the sensor in id mode."
+        return self.get(EV3ColorSensor.Mode.ID)
+
+
 class EV3GyroSensor(Sensor):
     """
     EV3 Gyro sensor. Default mode is "both".
@@ -645,6 +1155,11 @@ class Motor:
     MAX_SPEED = 1560  # positive or negative degree per second speed
     MAX_POWER = 100  # positive or negative percent power
 
+    ALL_MOTORS = {key: None for key in 'A B C D'.split(' ')}
+    # Incremented when the motors are cut behind the back of Motor objects, which
+    # makes every object forget its cached command values.
+    _cache_epoch = 0
+
     def __init__(self, port: Literal["A", "B", "C", "D"] | list[str], bp=None):
         """
         Initialize this Motor object with the ports "A", "B", "C", or "D".
@@ -652,6 +1167,10 @@ class Motor:
         both motors at the exact same time (exact combined behavior unknown).
         """
         self.brick = Brick(bp)
+        self.sent = 0  # commands written to the bus
+        self.suppressed = 0  # commands dropped as repeats, or coalesced in a CommandBatch
+        self._cache = {}  # last written values, by kind of command: "dps", "power", "limits"
+        self._cache_epoch = Motor._cache_epoch
         self.set_port(port)
 
     def set_port(self, port):
@@ -664,6 +1183,8 @@ class Motor:
             self.port = sum([PORTS[i] for i in port])
         elif isinstance(port, int) or isinstance(port, str):
             self.port = PORTS[str(port).upper()]
+            if str(port).upper() in Motor.ALL_MOTORS:
+                Motor.ALL_MOTORS[str(port).upper()] = self
 
     def set_power(self, power):
         """
@@ -683,7 +1204,7 @@ class Motor:
         Keyword arguments:
         power - The power from -100 to 100, or -128 for float
         """
-        self.brick.set_motor_power(self.port, power)
+        self._send(self.brick.set_motor_power, power, key="power")
 
     def float_motor(self):
         """(Float the motor), which unlocks the motor, and allows outside forces to rotate it.
@@ -699,7 +1220,7 @@ class Motor:
         It DOES NOT RESET any limits defined by (Motor.set_limits)
         The Motor will stop any current movements, then unlock
         """
-        self.brick.set_motor_power(self.port, -128)
+        self._send(self.brick.set_motor_power, -128, key="power")
 
     def set_position(self, position):
         """
@@ -723,8 +1244,12 @@ class Motor:
         SIDE EFFECTS:
         If you use Motor.set_position IMMEDIATELY AFTER Motor.set_power or Motor.set_dps,
             it will rotate at FULL POWER. This may crash the robot.
+
+        Returns a MotionFuture that is done once the encoder reaches the position.
         """
-        self.brick.set_motor_position(self.port, position)
+        targets = [(port, position) for port in self._single_ports()]
+        sent = self._send(self.brick.set_motor_position, position)
+        return MotionFuture(self, targets, cancelled=not sent)
 
     def set_position_relative(self, degrees):
         """
@@ -750,8 +1275,28 @@ class Motor:
         SIDE EFFECTS:
         If you use Motor.set_position IMMEDIATELY AFTER Motor.set_power or Motor.set_dps,
             it will rotate at FULL POWER. This may crash the robot.
+
+        Returns a MotionFuture that is done once the encoders reach the new positions.
+        Each port of a multi-port motor moves degrees away from its own position.
+
+        >>> from .simulator import SimulatedBrickPi3
+        >>> bp = SimulatedBrickPi3()  # motors that do not move by themselves
+        >>> bp.offset_motor_encoder(bp.PORT_A, 100)
+        >>> bp.offset_motor_encoder(bp.PORT_C, -40)
+        >>> move = Motor(["A", "C"], bp=bp).set_position_relative(90)
+        >>> move.targets
+        [(1, 190), (4, 50)]
+        >>> bp.Motors[0].position_goal, bp.Motors[2].position_goal
+        (190, 50)
         """
-        self.brick.set_motor_position_relative(self.port, degrees)
+        # Same as BrickPi3.set_motor_position_relative, but keeps the targets for the future
+        targets = [(port, self.brick.get_motor_encoder(port) + degrees) for port in self._single_ports()]
+        sent = all([self._send(self.brick.set_motor_position, target, port=port) for port, target in targets])
+        return MotionFuture(self, targets, cancelled=not targets or not sent)
+
+    def _single_ports(self) -> list[int]:
+        "The single port values (PORT_A, ...) this motor drives."
+        return [PORTS[name] for name in MOTOR_PORT_NAMES if self.port & PORTS[name]]
 
     def set_position_kp(self, kp=25):
         """
@@ -796,8 +1341,68 @@ class Motor:
         Keyword arguments:
         dps - The target speed in degrees per second
         """
-        self.brick.set_motor_dps(self.port, dps)
-        self.set_limits(dps=dps)
+        if self._send(self.brick.set_motor_dps, dps, key="dps"):
+            self.set_limits(dps=dps)
+
+    def _send(self, command, *args, key: str = None, port: int = None) -> bool:
+        """
+        Send a command for this motor's port (or for one of its ports, if port is given),
+        unless the emergency stop is active.
+        Returns False if it was dropped because of the emergency stop, True otherwise.
+
+        Commands with a key ("dps", "power", "limits") are cached: one that repeats the
+        last written value is not sent again, and inside a CommandBatch it is deferred
+        so that only the last one of its kind is sent. Commands without a key (position
+        moves) are always sent right away.
+        """
+        with _MOTOR_COMMAND_LOCK:
+            if EMERGENCY_STOP.is_set():
+                return False
+            batch = CommandBatch.get_active()
+            if batch is None:
+                self._write(command, args, key, port)
+            elif key is None:
+                batch.discard(self)  # pending speed or power commands are superseded
+                self._write(command, args, key, port)
+            else:
+                batch.defer(self, key, self._write, (command, args, key))
+            return True
+
+    def _write(self, command, args: tuple, key: str = None, port: int = None):
+        "Write a command unless it repeats the cached value. Call with _MOTOR_COMMAND_LOCK held."
+        if EMERGENCY_STOP.is_set():
+            return
+        self._check_cache()
+        if key is not None and self._cache.get(key) == args:
+            self.suppressed += 1
+            return
+        command(self.port if port is None else port, *args)
+        self.sent += 1
+        self._remember(key, args)
+
+    def _remember(self, key: str, args: tuple):
+        "Update the cache after writing a command of the given kind (None for position moves)."
+        if key == "limits":
+            self._cache["limits"] = args
+            return
+        # Speed, power and position control replace each other, and set_dps and
+        # set_power also reset the limits
+        limits = self._cache.get("limits")
+        self._cache = {}
+        if key is None:
+            if limits is not None:
+                self._cache["limits"] = limits
+        else:
+            self._cache[key] = args
+
+    def _check_cache(self):
+        if self._cache_epoch != Motor._cache_epoch:
+            self._cache = {}
+            self._cache_epoch = Motor._cache_epoch
+
+    def invalidate_cache(self):
+        "Forget the cached command values, so the next commands are all sent."
+        self._cache = {}
 
     def set_limits(self, power=0, dps=0):
         """
@@ -815,7 +1420,7 @@ class Motor:
         power - The power limit in percent (0 to 100), with 0 being no limit (100)
         dps - The speed limit in degrees per second, with 0 being no limit
         """
-        self.brick.set_motor_limits(self.port, power, dps)
+        self._send(self.brick.set_motor_limits, power, dps, key="limits")
 
     def get_status(self):
         """
@@ -832,6 +1437,9 @@ class Motor:
             encoder - The encoder position
             dps - The current speed in Degrees Per Second
         """
+        snapshot = SensorSnapshot.get_active()
+        if snapshot is not None and snapshot.serves_motor(self):
+            return snapshot.motors[self.port]
         try:
             return self.brick.get_motor_status(self.port)
         except IOError:
@@ -846,6 +1454,9 @@ class Motor:
         Keyword arguments:
         Returns the encoder position in degrees
         """
+        snapshot = SensorSnapshot.get_active()
+        if snapshot is not None and snapshot.serves_motor(self):
+            return snapshot.motors[self.port][2]
         return self.brick.get_motor_encoder(self.port)
 
     def get_position(self):
@@ -929,22 +1540,508 @@ class Motor:
         return tuple(result)
 
     def wait_is_moving(self, sleep_interval: float = None):
+        "Wait until the motor moves. Returns early if the emergency stop is triggered."
         if sleep_interval is None:
             sleep_interval = WAIT_READY_INTERVAL
         while not self.is_moving():
-            time.sleep(sleep_interval)
+            if clock.wait(EMERGENCY_STOP, sleep_interval):
+                return
 
     def wait_is_stopped(self, sleep_interval: float = None):
+        "Wait until the motor stops. Returns early if the emergency stop is triggered."
         if sleep_interval is None:
             sleep_interval = WAIT_READY_INTERVAL
         while self.is_moving():
-            time.sleep(sleep_interval)
+            if clock.wait(EMERGENCY_STOP, sleep_interval):
+                return
+
+
+class MotionFuture:
+    """
+    Completion of a position move started by Motor.set_position or set_position_relative.
+
+    Nothing runs in the background: the encoders are read only when done() or wait()
+    is called, so the caller can keep sensing while the motor moves and check on the
+    move between readings. The move is done once every port is within
+    MOTION_TOLERANCE degrees of its target and slower than MOTION_SETTLE_DPS, or if it
+    was dropped or interrupted by the emergency stop. It is also over, with stalled set
+    and reached not, once every port stayed slower than MOTION_SETTLE_DPS for
+    MOTION_STALL_TIME seconds without all of them being on target, such as an arm held
+    by its mechanical stop.
+
+    Example:
+
+    move = MOTOR.set_position_relative(90)
+    while not move.done():
+        if COLOR_SENSOR.get_color_name() == "green":
+            break
+    print(move.reached, move.elapsed())
+    """
+
+    def __init__(self, motor: Motor, targets: list[tuple[int, float]], cancelled: bool = False,
+                 tolerance: float = MOTION_TOLERANCE, settle_dps: float = MOTION_SETTLE_DPS,
+                 stall_time: float = MOTION_STALL_TIME):
+        self.motor = motor
+        self.targets = targets
+        self.tolerance = tolerance
+        self.settle_dps = settle_dps
+        self.stall_time = stall_time
+        self.started = clock.monotonic()
+        self.finished = self.started if cancelled else None
+        self.reached = False
+        self.stalled = False
+        self.positions = [None] * len(targets)
+        self._settled_since = None  # first poll of the current run of off-target settled polls
+
+    def _poll(self) -> bool | None:
+        """
+        Read every port once. Returns True if they are all settled on their targets,
+        False if they are all settled but one is off target, None while one moves.
+        """
+        # Read the bus directly: inside a SensorSnapshot the status would never change
+        on_target = True
+        moving = False
+        for i, (port, target) in enumerate(self.targets):
+            try:
+                _, _, position, dps = self.motor.brick.get_motor_status(port)
+            except (IOError, OSError):
+                return None
+            self.positions[i] = position
+            if position is None or abs(dps) > self.settle_dps:
+                moving = True
+            elif abs(position - target) > self.tolerance:
+                on_target = False
+        return None if moving else on_target
+
+    def done(self) -> bool:
+        """
+        Read the encoders once, and return True if the move is over.
+
+        >>> from .simulator import SimulatedBrickPi3
+        >>> bp = SimulatedBrickPi3()  # motors that do not move by themselves, as if stalled
+        >>> move = Motor("B", bp=bp).set_position_relative(90)
+        >>> move.wait(timeout=5), move.stalled, move.elapsed() < 1
+        (False, True, True)
+        """
+        if self.finished is not None:
+            return True
+        if EMERGENCY_STOP.is_set():
+            self.finished = clock.monotonic()
+            return True
+        state = self._poll()
+        if state:
+            self.reached = True
+            self.finished = clock.monotonic()
+        elif state is None:
+            self._settled_since = None
+        elif self._settled_since is None:
+            self._settled_since = clock.monotonic()
+        elif clock.monotonic() - self._settled_since >= self.stall_time:
+            self.stalled = True
+            self.finished = clock.monotonic()
+        return self.finished is not None
+
+    def wait(self, timeout: float = None, poll_interval: float = MOTION_POLL_INTERVAL) -> bool:
+        """
+        Block until the move is over, or for at most timeout seconds.
+        Returns True if the target was reached.
+        """
+        deadline = None if timeout is None else clock.monotonic() + timeout
+        while not self.done():
+            if deadline is not None and clock.monotonic() >= deadline:
+                break
+            clock.wait(EMERGENCY_STOP, poll_interval)
+        return self.reached
+
+    def result(self, timeout: float = None) -> list:
+        "Wait for the move, and return the last encoder position of each port."
+        self.wait(timeout)
+        return list(self.positions)
+
+    def elapsed(self) -> float:
+        "Seconds from the command to the end of the move, or until now if it is not over."
+        end = clock.monotonic() if self.finished is None else self.finished
+        return end - self.started
+
+    @staticmethod
+    def wait_all(futures: list[MotionFuture], timeout: float = None,
+                 poll_interval: float = MOTION_POLL_INTERVAL) -> bool:
+        "Wait for several moves at once. Returns True if every target was reached."
+        deadline = None if timeout is None else clock.monotonic() + timeout
+        while not all([future.done() for future in futures]):
+            if deadline is not None and clock.monotonic() >= deadline:
+                break
+            clock.wait(EMERGENCY_STOP, poll_interval)
+        return all(future.reached for future in futures)
+
+    def __repr__(self):
+        state = ("reached" if self.reached else "stalled" if self.stalled else
+                 "over" if self.finished is not None else "moving")
+        return f"MotionFuture({state}, targets={[t for _, t in self.targets]}, elapsed={self.elapsed():.3f}s)"
+
+
+class CommandBatch:
+    """
+    Coalesces the motor commands issued on one thread inside a 'with' block. For each
+    motor (or DriveBase) and kind of command, only the last one is kept, and the kept
+    commands are written when the block exits. Commands that repeat what the motor was
+    last sent are not written at all.
+
+    Position moves are still written right away, and discard the pending speed and
+    power commands of their motor. Do not sleep or wait for moves inside a batch:
+    deferred commands only reach the motors at the end of the block.
+
+    Example:
+
+    with CommandBatch():
+        move_forward()
+        if too_close:
+            drift_left()   # only this one is written
+    """
+    _local = threading.local()
+    _EXCLUSIVE = {"dps": "power", "power": "dps"}
+
+    def __init__(self):
+        self.pending = {}  # (id(owner), key) -> (owner, write function, arguments)
+
+    def __enter__(self):
+        CommandBatch._stack().append(self)
+        return self
+
+    def __exit__(self, *args):
+        stack = CommandBatch._stack()
+        if self in stack:
+            stack.remove(self)
+        self.flush()
+
+    @staticmethod
+    def _stack() -> list:
+        if not hasattr(CommandBatch._local, 'stack'):
+            CommandBatch._local.stack = []
+        return CommandBatch._local.stack
+
+    @staticmethod
+    def get_active() -> CommandBatch | None:
+        "Return the innermost batch active on this thread, or None."
+        stack = CommandBatch._stack()
+        return stack[-1] if stack else None
+
+    def defer(self, owner, key: str, write, args: tuple):
+        "Keep write(*args) as the pending command of this kind for owner."
+        for k in (key, CommandBatch._EXCLUSIVE.get(key)):
+            if self.pending.pop((id(owner), k), None) is not None:
+                owner.suppressed += 1
+        self.pending[(id(owner), key)] = (owner, write, args)
+
+    def discard(self, owner):
+        "Drop the pending speed and power commands of owner."
+        for k in ("dps", "power"):
+            if self.pending.pop((id(owner), k), None) is not None:
+                owner.suppressed += 1
+
+    def flush(self):
+        "Write the pending commands now, in the order they were last issued."
+        pending, self.pending = self.pending, {}
+        with _MOTOR_COMMAND_LOCK:
+            for owner, write, args in pending.values():
+                write(*args)
+
+
+def cut_all_motors():
+    """
+    Solidly stop every motor port at once, bypassing the emergency stop check.
+    Ports with a registered Motor are stopped through that motor's brick.
+    """
+    with _MOTOR_COMMAND_LOCK:
+        Motor._cache_epoch += 1
+        for name in MOTOR_PORT_NAMES:
+            motor = Motor.ALL_MOTORS[name]
+            brick = BP if motor is None else motor.brick
+            try:
+                brick.set_motor_power(PORTS[name], 0)
+            except (IOError, OSError):
+                pass
+
+
+class StopRecord(NamedTuple):
+    "Timing of one emergency stop, in seconds."
+    reason: str
+    timestamp: float
+    reaction: float  # from detecting the press to all motors cut
+    worst_case: float  # from the last poll that saw the sensor released to all motors cut
+
+
+class SafetyMonitor:
+    """
+    Emergency stop that does not wait for the control loop to notice it.
+
+    A daemon thread polls the stop sensor (usually a TouchSensor) straight from the bus
+    at rate_hz. When it is pressed, or trigger() is called, EMERGENCY_STOP is set and
+    every motor is cut at once. While it stays set, Motor commands are dropped and
+    safety_sleep, busy_sleep and Motor.wait_is_moving/wait_is_stopped return early.
+
+    A press is therefore stopped within one polling period plus the time needed to cut
+    the motors. Each stop is recorded as a StopRecord, and a warning is printed if
+    it took longer than max_latency.
+
+    Example:
+
+    monitor = SafetyMonitor(TOUCH_SENSOR, rate_hz=200)
+    monitor.start()
+    while not safety_sleep(0.05):
+        ...
+    print(monitor.stops[-1])
+    """
+
+    def __init__(self, sensor: Sensor = None, rate_hz: float = 200, max_latency: float = 0.05,
+                 on_stop=None):
+        """
+        Keyword arguments:
+        sensor - Sensor that triggers the stop when its value is 1, or None for trigger() only
+        rate_hz - How many times per second the sensor is polled
+        max_latency - Press-to-stop time (in seconds) above which a warning is printed
+        on_stop - Function called with the StopRecord after the motors are cut
+        """
+        if rate_hz <= 0:
+            raise ValueError("rate_hz must be a positive value")
+        self.sensor = sensor
+        self.period = 1 / rate_hz
+        self.max_latency = max_latency
+        self.on_stop = on_stop
+        self.stops: list[StopRecord] = []
+        self._running = threading.Event()
+        self._thread = None
+
+    def start(self):
+        "Start polling the sensor in a daemon thread."
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._running.set()
+        if self.sensor is not None:
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        "Stop polling the sensor. Does not clear an active emergency stop."
+        self._running.clear()
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join()
+
+    def is_running(self) -> bool:
+        return self._running.is_set()
+
+    @staticmethod
+    def is_stopped() -> bool:
+        return EMERGENCY_STOP.is_set()
+
+    def _is_pressed(self) -> bool:
+        # Read the bus directly, a snapshot or sampler reading could be too old
+        try:
+            return self.sensor.brick.get_sensor(self.sensor.port) == 1
+        except (SensorError, IOError, OSError):
+            return False
+
+    def _run(self):
+        # Paced and timed on real time, like SensorSampler: the latency is physical
+        next_time = time.monotonic()
+        released_at = next_time
+        while self._running.is_set():
+            now = time.monotonic()
+            if EMERGENCY_STOP.is_set():
+                released_at = now
+            elif self._is_pressed():
+                self.trigger("sensor pressed", released_at)
+            else:
+                released_at = now
+
+            next_time += self.period
+            delay = next_time - time.monotonic()
+            if delay < -self.period:
+                next_time = time.monotonic()
+            elif delay > 0:
+                time.sleep(delay)
+
+    def trigger(self, reason: str = "triggered", since: float = None) -> StopRecord:
+        """
+        Activate the emergency stop and cut every motor. Can be called from any thread.
+        since is the time.monotonic() time the stop condition could have started at,
+        used to compute the worst case latency.
+        """
+        detected = time.monotonic()
+        with _MOTOR_COMMAND_LOCK:
+            EMERGENCY_STOP.set()
+            cut_all_motors()
+        stopped = time.monotonic()
+        record = StopRecord(reason, clock.time(), stopped - detected,
+                            stopped - (detected if since is None else since))
+        self.stops.append(record)
+        if record.worst_case > self.max_latency:
+            print(f"Emergency stop took {record.worst_case * 1000:.1f} ms "
+                  f"(limit {self.max_latency * 1000:.0f} ms)", file=sys.stderr)
+        if self.on_stop is not None:
+            self.on_stop(record)
+        return record
+
+    def reset(self) -> bool:
+        """
+        Clear the emergency stop, so motors accept commands again.
+        Refuses (returns False) while the stop sensor is still pressed.
+        """
+        if self.sensor is not None and self._is_pressed():
+            return False
+        EMERGENCY_STOP.clear()
+        return True
 
 
 def create_motors(motor_ports: list[Literal["A", "B", "C", "D"]] | str):
     return Motor.create_motors(motor_ports)
 
 
+class DriveBase:
+    """
+    Differential drive made of a left and a right wheel Motor.
+
+    Both wheel commands are written together, while holding the motor command lock.
+    When both wheels get the same speed, one combined-port write commands them at
+    once, so they start in sync. Commands that repeat the speeds the motors were last
+    sent (according to the Motor caches) are not written, and inside a CommandBatch
+    only the last drive command is.
+
+    Turning commands follow the convention of the robot code: positive is to the right.
+
+    Example:
+
+    DRIVE = DriveBase(Motor("A"), Motor("D"), wheel_radius=2, track_radius=5)
+    DRIVE.forward(180)
+    DRIVE.arc(180, radius=30)  # curve right around a point 30 cm away
+    DRIVE.stop()
+    print(DRIVE.sent, DRIVE.suppressed)
+    """
+
+    def __init__(self, left: Motor, right: Motor, wheel_radius: float, track_radius: float):
+        """
+        Keyword arguments:
+        left, right - The wheel motors, each on a single port
+        wheel_radius - Radius of the wheels
+        track_radius - Half the distance between the wheels, in the same unit
+        """
+        self.left = left
+        self.right = right
+        self.wheel_radius = wheel_radius
+        self.track_radius = track_radius
+        self.ports = left.port | right.port
+        self.sent = 0  # bus writes
+        self.suppressed = 0  # commands that repeated the current speeds, or were coalesced
+
+    @property
+    def speeds(self) -> tuple | None:
+        "(left, right) dps last sent, or None if unknown."
+        left, right = self.left._cache.get("dps"), self.right._cache.get("dps")
+        if left is None or right is None:
+            return None
+        return left[0], right[0]
+
+    def set_dps(self, left_dps: float, right_dps: float) -> bool:
+        """
+        Command both wheel speeds in degrees per second. Like Motor.set_dps, the speed
+        limit is then set so it does not cap the new speeds.
+        Returns False if the command was dropped because of the emergency stop.
+
+        >>> from .simulator import SimulatedBrickPi3
+        >>> bp = SimulatedBrickPi3()
+        >>> drive = DriveBase(Motor("A", bp=bp), Motor("D", bp=bp), wheel_radius=2, track_radius=5)
+        >>> _ = drive.forward(180)  # speed, then limit
+        >>> _ = drive.spin(180)  # one speed per wheel, same limit
+        >>> _ = drive.spin(180)
+        >>> drive
+        DriveBase(speeds=(180, -180), sent=4, suppressed=1)
+        """
+        with _MOTOR_COMMAND_LOCK:
+            if EMERGENCY_STOP.is_set():
+                return False
+            batch = CommandBatch.get_active()
+            if batch is None:
+                self._write(left_dps, right_dps)
+            else:
+                batch.defer(self, "dps", self._write, (left_dps, right_dps))
+            return True
+
+    def _write(self, left_dps: float, right_dps: float):
+        "Write both wheel speeds unless they are unchanged. Call with _MOTOR_COMMAND_LOCK held."
+        if EMERGENCY_STOP.is_set():
+            return
+        left, right = self.left, self.right
+        left._check_cache()
+        right._check_cache()
+        limits = (0, max(abs(left_dps), abs(right_dps)))
+        write_dps = left._cache.get("dps") != (left_dps,) or right._cache.get("dps") != (right_dps,)
+        write_limits = left._cache.get("limits") != limits or right._cache.get("limits") != limits
+        if not write_dps and not write_limits:
+            self.suppressed += 1
+            return
+        brick = left.brick
+        if write_dps:
+            if left_dps == right_dps:
+                brick.set_motor_dps(self.ports, left_dps)
+                self.sent += 1
+            else:
+                brick.set_motor_dps(left.port, left_dps)
+                brick.set_motor_dps(right.port, right_dps)
+                self.sent += 2
+        if write_limits:
+            brick.set_motor_limits(self.ports, *limits)
+            self.sent += 1
+        for motor, dps in ((left, left_dps), (right, right_dps)):
+            motor._remember("dps", (dps,))
+            motor._remember("limits", limits)
+
+    def forward(self, dps: float) -> bool:
+        "Drive straight, backwards if dps is negative."
+        return self.set_dps(dps, dps)
+
+    def stop(self) -> bool:
+        "Solidly stop both wheels."
+        return self.set_dps(0, 0)
+
+    def spin(self, dps: float) -> bool:
+        "Turn on the spot, to the right if dps is positive."
+        return self.set_dps(dps, -dps)
+
+    def curve(self, dps: float, curvature: float) -> bool:
+        """
+        Drive along a circle of the given curvature (1 / radius, positive to the right),
+        dps being the mean wheel speed.
+        """
+        offset = dps * curvature * self.track_radius
+        return self.set_dps(dps + offset, dps - offset)
+
+    def arc(self, dps: float, radius: float) -> bool:
+        """
+        Drive along a circle of the given radius, to the right if the radius is positive.
+        A radius of 0 spins on the spot with the wheels at dps (to the left for -0.0).
+
+        >>> from .simulator import SimulatedBrickPi3
+        >>> bp = SimulatedBrickPi3()
+        >>> drive = DriveBase(Motor("A", bp=bp), Motor("D", bp=bp), wheel_radius=2, track_radius=5)
+        >>> _ = drive.arc(100, radius=10)
+        >>> drive.speeds
+        (150.0, 50.0)
+        >>> _ = drive.arc(100, radius=0)
+        >>> drive.speeds
+        (100.0, -100.0)
+        """
+        if radius == 0:
+            return self.spin(dps * math.copysign(1, radius))
+        return self.curve(dps, 0 if math.isinf(radius) else 1 / radius)
+
+    def wheel_speed(self, speed: float) -> float:
+        "Wheel dps needed to move the robot at speed (distance per second)."
+        return math.degrees(speed / self.wheel_radius)
+
+    def __repr__(self):
+        return f"DriveBase(speeds={self.speeds}, sent={self.sent}, suppressed={self.suppressed})"
+
+
 def configure_ports(*,
                     PORT_1: Type[Sensor] = None,
                     PORT_2: Type[Sensor] = None,
@@ -955,12 +2052,15 @@ def configure_ports(*,
                     PORT_C: Type[Motor] = None,
                     PORT_D: Type[Motor] = None,
                     wait: bool = True,
+                    timeout: float = WAIT_READY_TIMEOUT,
                     print_status: bool = True) -> Sensor | Motor | list[Sensor | Motor]:
     """
     Configure the ports to use the specified sensor or motor and return objects for each item,
     ordered by sensor ports followed by motor ports.
 
     When wait is True (the default), the function will wait for the sensors to be ready before returning.
+    All sensors are waited on at the same time, for at most timeout seconds; a sensor that is still
+    not ready by then is reported and returned anyway.
     When print_status is True (the default), the function will print two messages, the first to let the user
     know to wait until the ports are configured, and the second to indicate the port configuration is complete.
 
@@ -980,13 +2080,16 @@ def configure_ports(*,
     motors: list[Motor] = []
     for n, sensor_type in enumerate(sensor_ports, 1):
         if sensor_type:
-            sensor = sensor_type(n)
-            if wait:
-                if isinstance(sensor, (EV3UltrasonicSensor, EV3ColorSensor)):
-                    sensor.wait_ready()
-            if is_single_device:
-                return sensor
-            sensors.append(sensor)
+            sensors.append(sensor_type(n))
+    if wait:
+        slow_sensors = [sensor for sensor in sensors
+                        if isinstance(sensor, (EV3UltrasonicSensor, EV3ColorSensor))]
+        report = wait_ready_all(slow_sensors, timeout=timeout)
+        for port, elapsed in report.items():
+            if elapsed is None:
+                print(f"Port {port} was not ready after {timeout}s", file=sys.stderr)
+    if is_single_device and sensors:
+        return sensors[0]
     for letter, motor_type in zip("ABCD", motor_ports):
         if motor_type:
             if is_single_device:
@@ -1007,3 +2110,8 @@ try:
     atexit.register(reset_brick)
 except ValueError as err:
     print(err, "Must import brick in main thread", file=sys.stderr)
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
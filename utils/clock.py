@@ -0,0 +1,181 @@
+"""
+Module for a pluggable time source, so control code can run against real time, a
+simulation, or a recording.
+
+Code that would call time.time, time.monotonic, time.sleep or Event.wait(timeout)
+calls the functions of this module instead. They go to the current clock, which is
+the RealClock unless set_clock() installed another one.
+
+Example:
+
+    from utils import clock
+
+    sim = Simulator(world)
+    clock.set_clock(sim.clock)   # sleep() now advances the simulation
+    start = clock.monotonic()
+    clock.sleep(2)               # returns at once
+    print(clock.monotonic() - start)  # 2.0
+"""
+
+from __future__ import annotations
+
+import math
+import threading
+import time as _time
+
+
+class RealClock:
+    "The system clock."
+
+    def time(self) -> float:
+        return _time.time()
+
+    def monotonic(self) -> float:
+        return _time.monotonic()
+
+    def sleep(self, seconds: float):
+        if seconds > 0:
+            _time.sleep(seconds)
+
+    def wait(self, event: threading.Event, timeout: float = None) -> bool:
+        "Wait until event is set, for at most timeout seconds. Returns True if it is set."
+        return event.wait(timeout)
+
+
+class SimulatedClock:
+    """
+    Virtual time, which only moves when sleep() or advance() is called.
+
+    Listeners (such as a Simulator) are called with the number of seconds to run
+    whenever the clock advances, so that sleeping in the control code runs the
+    simulation instead of waiting.
+
+    >>> c = SimulatedClock(epoch=1000.0)
+    >>> ran = []
+    >>> c.add_listener(ran.append)
+    >>> c.sleep(0.5)
+    >>> c.wait(threading.Event(), 0.25)
+    False
+    >>> c.monotonic(), c.time(), ran
+    (0.75, 1000.75, [0.5, 0.25])
+    """
+
+    def __init__(self, start: float = 0.0, epoch: float = 0.0):
+        """
+        Keyword arguments:
+        start - Value of monotonic() at the start
+        epoch - Value of time() when monotonic() is 0
+        """
+        self.now = start
+        self.epoch = epoch
+        self._listeners = []
+        self._lock = threading.RLock()
+
+    def add_listener(self, listener):
+        "Call listener(seconds) every time the clock advances."
+        self._listeners.append(listener)
+
+    def remove_listener(self, listener):
+        self._listeners.remove(listener)
+
+    def time(self) -> float:
+        return self.epoch + self.now
+
+    def monotonic(self) -> float:
+        return self.now
+
+    def advance(self, seconds: float):
+        "Run the listeners for seconds, then move the clock forward."
+        if seconds <= 0:
+            return
+        with self._lock:
+            for listener in list(self._listeners):
+                listener(seconds)
+            self.now += seconds
+
+    def sleep(self, seconds: float):
+        self.advance(seconds)
+
+    def wait(self, event: threading.Event, timeout: float = None) -> bool:
+        """
+        Advance by timeout unless event is already set, and return whether it is set.
+        Without a timeout nothing could advance the clock, so this waits in real time
+        for another thread to set the event.
+        """
+        if event.is_set():
+            return True
+        if timeout is None:
+            return event.wait()
+        self.advance(timeout)
+        return event.is_set()
+
+
+class ReplayClock(SimulatedClock):
+    """
+    Time taken from a recording. The replay moves the clock to each recorded timestamp
+    with advance_to(), and sleeping in the control code moves it forward as usual.
+
+    With speed 1 the replay is paced like the original run, with speed 2 it is twice
+    as fast, and with speed None (or inf) it runs as fast as possible.
+
+    >>> c = ReplayClock(start=10.0, speed=None)
+    >>> c.advance_to(12.5)
+    >>> c.advance_to(11.0)  # never goes back
+    >>> c.sleep(0.5)
+    >>> c.monotonic()
+    13.0
+    """
+
+    def __init__(self, start: float = 0.0, epoch: float = 0.0, speed: float | None = 1.0):
+        super(ReplayClock, self).__init__(start, epoch)
+        if speed is not None and speed <= 0:
+            raise ValueError("speed must be positive, or None to run as fast as possible")
+        self.speed = None if speed is None or math.isinf(speed) else speed
+
+    def advance(self, seconds: float):
+        if seconds > 0 and self.speed is not None:
+            _time.sleep(seconds / self.speed)
+        super(ReplayClock, self).advance(seconds)
+
+    def advance_to(self, timestamp: float):
+        "Move the clock to the monotonic() timestamp, if it is ahead."
+        self.advance(timestamp - self.now)
+
+
+_clock = RealClock()
+
+
+def get_clock():
+    "Return the current clock."
+    return _clock
+
+
+def set_clock(clock=None):
+    "Make clock the current clock, or go back to the RealClock if clock is None."
+    global _clock
+    _clock = RealClock() if clock is None else clock
+
+
+def time() -> float:
+    "Seconds since the epoch, like time.time(), on the current clock."
+    return _clock.time()
+
+
+def monotonic() -> float:
+    "Monotonic seconds, like time.monotonic(), on the current clock."
+    return _clock.monotonic()
+
+
+def sleep(seconds: float):
+    "Sleep on the current clock."
+    _clock.sleep(seconds)
+
+
+def wait(event: threading.Event, timeout: float = None) -> bool:
+    "Wait for event for at most timeout seconds on the current clock. True if it is set."
+    return _clock.wait(event, timeout)
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
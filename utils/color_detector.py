@@ -1,6 +1,23 @@
+from array import array
+import math
+import mmap
+import numbers
+import struct
+import time
+
+
+def _split_samples(samples):
+    """Returns samples as a sequence of [r, g, b] samples: a flat sequence of numbers
+    (r, g, b, r, g, b, ...) is cut in threes, anything else (a list of samples, a 2D
+    array) is returned as it is."""
+    if len(samples) and isinstance(samples[0], numbers.Number):
+        return [samples[i:i + 3] for i in range(0, len(samples) - len(samples) % 3, 3)]
+    return samples
+
+
 class ColorDetector:
 
-    def __init__(self):
+    def __init__(self, reference_colors: dict = None):
         # Reference color database with calibrated RGB values for common colors
         self.REFERENCE_COLORS = {
             "black": [8.53, 9.47, 3.47],
@@ -11,24 +28,400 @@ class ColorDetector:
             "white": [250.00, 242.40, 108.80],
             "yellow": [277.53, 237.00, 22.20],
         }
+        if reference_colors is not None:
+            self.REFERENCE_COLORS = {label: list(rgb) for label, rgb in reference_colors.items()}
+        self.update_references()
+
+    def update_references(self):
+        """Precomputes the reference table. Call again after changing REFERENCE_COLORS.
+
+        Squared distance |x - r|^2 = |x|^2 - 2 x.r + |r|^2, and |x|^2 is the same for every
+        reference, so only the linear part (2r, |r|^2) is kept per reference.
+        """
+        self._labels = list(self.REFERENCE_COLORS.keys())
+        self._table = [
+            (2 * r, 2 * g, 2 * b, r * r + g * g + b * b)
+            for r, g, b in self.REFERENCE_COLORS.values()
+        ]
 
     def _compute_color_distance(self, input_rgb, reference_rgb):
+        """Squared distance between two RGB values (no square root, same ordering)."""
+        return ((input_rgb[0] - reference_rgb[0]) ** 2 +
+                (input_rgb[1] - reference_rgb[1]) ** 2 +
+                (input_rgb[2] - reference_rgb[2]) ** 2)
 
-        distance_metric = ((input_rgb[0] - reference_rgb[0]) ** 2 +
-                           (input_rgb[1] - reference_rgb[1]) ** 2 +
-                           (input_rgb[2] - reference_rgb[2]) ** 2) ** 0.5
-        return distance_metric
+    def _classify_one(self, r, g, b):
+        """Returns (index of closest reference, margin to the second closest).
+        The margin is the difference of squared distances."""
+        best = second = float("inf")
+        best_i = -1
+        for i, (r2, g2, b2, norm) in enumerate(self._table):
+            d = norm - r2 * r - g2 * g - b2 * b
+            if d < best:
+                second = best
+                best = d
+                best_i = i
+            elif d < second:
+                second = d
+        return best_i, second - best
 
     def detect_color(self, rgb_values: list):
 
-        if not rgb_values or len(rgb_values) != 3:
+        if rgb_values is None or len(rgb_values) != 3 or None in rgb_values:
             return "unknown"
 
-        # Compute distance to all reference colors
-        distance_metrics = {
-            color_label: self._compute_color_distance(rgb_values, ref_rgb)
-            for color_label, ref_rgb in self.REFERENCE_COLORS.items()
-        }
-
         # finds min
-        return min(distance_metrics.items(), key=lambda item: item[1])[0]
+        i, _ = self._classify_one(*rgb_values)
+        return self._labels[i]
+
+    def classify(self, rgb_values: list):
+        """Returns (label, margin) for a single RGB sample. A larger margin means a more
+        confident match, it is the squared distance gap to the second closest color."""
+        if rgb_values is None or len(rgb_values) != 3 or None in rgb_values:
+            return "unknown", 0.0
+        i, margin = self._classify_one(*rgb_values)
+        return self._labels[i], margin
+
+    def classify_batch(self, samples):
+        """Classifies many RGB samples in one call, such as a whole sensor sweep.
+
+        samples - a list (or 2D array) of [r, g, b] samples, or a flat array/list of
+            r, g, b, r, g, b, ...
+        Returns (labels, margins), a list of labels and an array('d') of margins.
+        Invalid samples are labelled "unknown" with a margin of 0.
+
+        >>> detector = ColorDetector()
+        >>> flat = [160, 20, 10, 250, 240, 110]
+        >>> detector.classify_batch(flat)[0], detector.classify_batch([flat[:3], None, flat[3:]])[0]
+        (['red', 'white'], ['red', 'unknown', 'white'])
+        """
+        labels = []
+        margins = array('d')
+        classify_one = self._classify_one
+        names = self._labels
+        for rgb in _split_samples(samples):
+            if rgb is None or len(rgb) != 3 or None in rgb:
+                labels.append("unknown")
+                margins.append(0.0)
+                continue
+            i, margin = classify_one(*rgb)
+            labels.append(names[i])
+            margins.append(margin)
+        return labels, margins
+
+
+class ColorModel:
+    """Color classifier fitted from calibration samples. Each color is modelled by the mean
+    and covariance of its samples, and a sample is given the color with the smallest
+    Mahalanobis distance (metric="mahalanobis") or highest Gaussian likelihood
+    (metric="gaussian", which also accounts for how spread out each color is).
+
+    Has the same detect_color/classify/classify_batch methods as ColorDetector.
+    """
+    MAGIC = b"CLRM"
+    VERSION = 1
+    _HEADER = struct.Struct("<4sBH")
+    _CLASS = struct.Struct("<I3d9dd")
+
+    def __init__(self, classes: dict = None, metric: str = "gaussian"):
+        # label -> (count, mean, inverse covariance (row major), log determinant)
+        self.classes = {} if classes is None else classes
+        if metric not in ("gaussian", "mahalanobis"):
+            raise ValueError("metric must be 'gaussian' or 'mahalanobis'")
+        self.metric = metric
+        self.update_references()
+
+    @classmethod
+    def fit(cls, samples: dict, regularization: float = 1.0, metric: str = "gaussian"):
+        """Fits a model from {label: [[r, g, b], ...]}.
+        regularization is added to the covariance diagonal, so that colors with
+        (nearly) constant readings still have an invertible covariance."""
+        classes = {}
+        for label, rgbs in samples.items():
+            rgbs = [rgb for rgb in rgbs if rgb and len(rgb) == 3 and None not in rgb]
+            n = len(rgbs)
+            if n == 0:
+                raise ValueError(f"no valid samples for color {label}")
+            mean = [sum(rgb[i] for rgb in rgbs) / n for i in range(3)]
+            cov = [[0.0] * 3 for _ in range(3)]
+            for rgb in rgbs:
+                d = [rgb[i] - mean[i] for i in range(3)]
+                for i in range(3):
+                    for j in range(3):
+                        cov[i][j] += d[i] * d[j]
+            for i in range(3):
+                for j in range(3):
+                    cov[i][j] /= n
+                cov[i][i] += regularization
+            inverse, det = _invert_3x3(cov)
+            classes[label] = (n, tuple(mean), inverse, math.log(det))
+        return cls(classes, metric)
+
+    def update_references(self):
+        """Precomputes the per-class terms used by classify."""
+        self._labels = list(self.classes.keys())
+        self._table = []
+        for n, mean, inv, log_det in self.classes.values():
+            offset = log_det if self.metric == "gaussian" else 0.0
+            self._table.append((mean, inv, offset))
+
+    def _score(self, r, g, b):
+        """Returns (index of best class, margin to the second best)."""
+        best = second = float("inf")
+        best_i = -1
+        for i, ((mr, mg, mb), inv, offset) in enumerate(self._table):
+            dr, dg, db = r - mr, g - mg, b - mb
+            d = (dr * (inv[0] * dr + inv[1] * dg + inv[2] * db) +
+                 dg * (inv[3] * dr + inv[4] * dg + inv[5] * db) +
+                 db * (inv[6] * dr + inv[7] * dg + inv[8] * db)) + offset
+            if d < best:
+                second = best
+                best = d
+                best_i = i
+            elif d < second:
+                second = d
+        return best_i, second - best
+
+    def detect_color(self, rgb_values: list):
+        return self.classify(rgb_values)[0]
+
+    def classify(self, rgb_values: list):
+        """Returns (label, margin) for a single RGB sample. The margin is the score gap
+        (squared Mahalanobis distance, plus log determinant for "gaussian") to the runner-up."""
+        if rgb_values is None or len(rgb_values) != 3 or None in rgb_values or not self._table:
+            return "unknown", 0.0
+        i, margin = self._score(*rgb_values)
+        return self._labels[i], margin
+
+    def classify_batch(self, samples):
+        """Same as ColorDetector.classify_batch, using this model."""
+        labels = []
+        margins = array('d')
+        for rgb in _split_samples(samples):
+            label, margin = self.classify(rgb)
+            labels.append(label)
+            margins.append(margin)
+        return labels, margins
+
+    def save(self, path: str):
+        """Saves the fitted model to a compact binary profile."""
+        with open(path, "wb") as f:
+            f.write(self._HEADER.pack(self.MAGIC, self.VERSION, len(self.classes)))
+            for label, (n, mean, inv, log_det) in self.classes.items():
+                name = label.encode("utf-8")
+                f.write(struct.pack("<B", len(name)) + name)
+                f.write(self._CLASS.pack(n, *mean, *inv, log_det))
+
+    @classmethod
+    def load(cls, path: str, metric: str = "gaussian"):
+        """Loads a profile written by ColorModel.save."""
+        with open(path, "rb") as f:
+            data = f.read()
+        magic, version, count = cls._HEADER.unpack_from(data, 0)
+        if magic != cls.MAGIC or version != cls.VERSION:
+            raise ValueError(f"{path} is not a version {cls.VERSION} color profile")
+        offset = cls._HEADER.size
+        classes = {}
+        for _ in range(count):
+            length = data[offset]
+            label = data[offset + 1:offset + 1 + length].decode("utf-8")
+            offset += 1 + length
+            values = cls._CLASS.unpack_from(data, offset)
+            offset += cls._CLASS.size
+            classes[label] = (values[0], values[1:4], values[4:13], values[13])
+        return cls(classes, metric)
+
+
+class ColorCalibrator:
+    """Records labelled RGB samples from a color sensor, then fits a ColorModel."""
+
+    def __init__(self):
+        self.samples = {}
+
+    def add_sample(self, label: str, rgb_values: list):
+        if rgb_values and len(rgb_values) == 3 and None not in rgb_values:
+            self.samples.setdefault(label, []).append(list(rgb_values))
+
+    def record(self, label: str, sensor, count: int = 50, interval: float = 0.02):
+        """Reads count RGB samples from sensor (an EV3ColorSensor) for the given label."""
+        for _ in range(count):
+            self.add_sample(label, sensor.get_rgb())
+            time.sleep(interval)
+        return len(self.samples.get(label, []))
+
+    def fit(self, regularization: float = 1.0, metric: str = "gaussian") -> ColorModel:
+        return ColorModel.fit(self.samples, regularization, metric)
+
+
+def _invert_3x3(m):
+    """Returns (inverse as a flat row-major tuple, determinant) of a 3x3 matrix."""
+    (a, b, c), (d, e, f), (g, h, i) = m
+    A = e * i - f * h
+    B = -(d * i - f * g)
+    C = d * h - e * g
+    det = a * A + b * B + c * C
+    if det <= 0:
+        raise ValueError("covariance matrix is singular, increase regularization")
+    inverse = (A, -(b * i - c * h), b * f - c * e,
+               B, a * i - c * g, -(a * f - c * d),
+               C, -(a * h - b * g), a * e - b * d)
+    return tuple(x / det for x in inverse), det
+
+
+def _reference_max(classifier) -> float:
+    """Largest component of the reference colors of a ColorDetector, or of the class means
+    of a ColorModel."""
+    if hasattr(classifier, "REFERENCE_COLORS"):
+        references = classifier.REFERENCE_COLORS.values()
+    elif hasattr(classifier, "classes"):
+        references = [mean for _, mean, _, _ in classifier.classes.values()]
+    else:
+        references = []
+    top = max((max(rgb) for rgb in references), default=0)
+    return top if top > 0 else ColorLUT.DEFAULT_MAX_VALUE
+
+
+class ColorLUT:
+    """Color classifier baked into a quantized 3D lookup table of bins x bins x bins labels.
+
+    Any classifier with a classify_batch method (ColorDetector, ColorModel) can be baked.
+    Classifying a sample is then a single index into a bytes buffer. The table can be saved
+    and memory-mapped back from disk, so loading it costs no parsing or extra memory.
+    """
+    MAGIC = b"CLUT"
+    VERSION = 1
+    MAX_VALUE_MARGIN = 0.15  # of the largest reference component, see bake
+    DEFAULT_MAX_VALUE = 512.0  # when the classifier has no references
+    _HEADER = struct.Struct("<4sBHdB")
+
+    def __init__(self, table, labels: list, bins: int = 32, max_value: float = DEFAULT_MAX_VALUE):
+        if len(table) != bins ** 3:
+            raise ValueError(f"table must have bins**3 = {bins ** 3} entries")
+        if len(labels) > 255:
+            raise ValueError("a lookup table supports at most 255 labels")
+        self.table = table
+        self.labels = list(labels)
+        self.bins = bins
+        self.max_value = max_value
+        self._scale = bins / max_value
+        self._mmap = None
+
+    @classmethod
+    def bake(cls, classifier, bins: int = 32, max_value: float = None):
+        """Classifies the center of every bin with classifier, and stores the result.
+        Readings at or above max_value fall into the last bin. By default max_value is the
+        largest reference (or class mean) component plus MAX_VALUE_MARGIN, so that no bins
+        are spent on readings far above every color.
+
+        >>> import random
+        >>> detector = ColorDetector()
+        >>> lut = ColorLUT.bake(detector)
+        >>> round(lut.max_value, 2)
+        319.16
+        >>> rng = random.Random(0)
+        >>> samples = [[rng.uniform(0, 300) for _ in range(3)] for _ in range(5000)]
+        >>> exact, _ = detector.classify_batch(samples)
+        >>> sum(a == b for a, b in zip(exact, lut.detect_colors(samples))) / len(samples) > 0.975
+        True
+        """
+        if max_value is None:
+            max_value = _reference_max(classifier) * (1 + cls.MAX_VALUE_MARGIN)
+        step = max_value / bins
+        centers = [(i + 0.5) * step for i in range(bins)]
+        labels = []
+        codes = {}
+        table = bytearray(bins ** 3)
+        index = 0
+        for r in centers:
+            for g in centers:
+                batch, _ = classifier.classify_batch([[r, g, b] for b in centers])
+                for label in batch:
+                    if label not in codes:
+                        codes[label] = len(labels)
+                        labels.append(label)
+                    table[index] = codes[label]
+                    index += 1
+        return cls(bytes(table), labels, bins, max_value)
+
+    def detect_color(self, rgb_values: list):
+        if rgb_values is None or len(rgb_values) != 3 or None in rgb_values:
+            return "unknown"
+        return self.detect_colors((rgb_values,))[0]
+
+    def detect_colors(self, samples):
+        """Classifies a list of [r, g, b] samples, or a flat array of r, g, b, r, g, b, ..."""
+        bins = self.bins
+        top = bins - 1
+        scale = self._scale
+        table = self.table
+        names = self.labels
+        result = []
+        for rgb in _split_samples(samples):
+            if rgb is None or len(rgb) != 3 or None in rgb:
+                result.append("unknown")
+                continue
+            r, g, b = rgb
+            ri = int(r * scale)
+            gi = int(g * scale)
+            bi = int(b * scale)
+            # Clamp with comparisons, calling min/max costs more than the lookup itself
+            if ri > top:
+                ri = top
+            elif ri < 0:
+                ri = 0
+            if gi > top:
+                gi = top
+            elif gi < 0:
+                gi = 0
+            if bi > top:
+                bi = top
+            elif bi < 0:
+                bi = 0
+            result.append(names[table[(ri * bins + gi) * bins + bi]])
+        return result
+
+    def save(self, path: str):
+        """Saves the table. The labels come first, then the raw table bytes."""
+        with open(path, "wb") as f:
+            f.write(self._HEADER.pack(self.MAGIC, self.VERSION, self.bins,
+                                      self.max_value, len(self.labels)))
+            for label in self.labels:
+                name = label.encode("utf-8")
+                f.write(struct.pack("<B", len(name)) + name)
+            f.write(self.table)
+
+    @classmethod
+    def load(cls, path: str, use_mmap: bool = True):
+        """Loads a table saved by ColorLUT.save. With use_mmap, the table is memory-mapped
+        from the file instead of being read into memory. Call close() when done."""
+        with open(path, "rb") as f:
+            if use_mmap:
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            else:
+                data = f.read()
+        magic, version, bins, max_value, count = cls._HEADER.unpack_from(data, 0)
+        if magic != cls.MAGIC or version != cls.VERSION:
+            raise ValueError(f"{path} is not a version {cls.VERSION} color lookup table")
+        offset = cls._HEADER.size
+        labels = []
+        for _ in range(count):
+            length = data[offset]
+            labels.append(bytes(data[offset + 1:offset + 1 + length]).decode("utf-8"))
+            offset += 1 + length
+        table = memoryview(data)[offset:offset + bins ** 3]
+        lut = cls(table, labels, bins, max_value)
+        if use_mmap:
+            lut._mmap = data
+        return lut
+
+    def close(self):
+        """Releases the memory map of a table loaded with use_mmap."""
+        if self._mmap is not None:
+            self.table.release()
+            self._mmap.close()
+            self._mmap = None
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
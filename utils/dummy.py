@@ -2,6 +2,7 @@ from math import inf
 import threading
 from typing import Literal
 import time
+import weakref
 
 
 class Enumeration(object):
@@ -37,27 +38,96 @@ class SensorError(Exception):
     """Exception raised if a sensor is not yet configured when trying to read it with get_sensor"""
 
 
-class _FakeMotor:
+# Rate at which the motor engine advances the fake motors, in ticks per second. The
+# BrickPi3 methods bring a bank up to date before using it, so encoders read through
+# them are exact whatever the rate: a higher rate only matters to code that reads the
+# bank directly (see set_motor_rate)
+MOTOR_RATE_HZ = 5
+
+
+class _MotorBank:
+    """
+    State of the four fake motors of one BrickPi3, stored as columns (one list entry
+    per motor) so that a tick advances every motor in a single pass.
+
+    Banks are stepped by the shared _MotorEngine thread, and by catch_up() whenever a
+    BrickPi3 method uses them, or by hand with step(dt) (the simulator does that on
+    virtual time).
+    """
     MAX_SPEED = 1050
     MAX_POS = 65536
-    THREAD_INTERVAL = 0.2
 
-    def __init__(self):
-        self.event = threading.Event()
-        self.thread = threading.Thread(target=self._listener, daemon=True)
+    def __init__(self, count=4):
+        # Plain lists: element access is cheaper than with array.array in CPython
+        self.position = [0.0] * count
+        self.speed = [0.0] * count  # Maximum is 1050dps
+        self.power = [0.0] * count
+        self.goal = [0.0] * count
+        self.has_goal = [False] * count
+        self.power_limit = [100.0] * count
+        self.speed_limit = [float(self.MAX_SPEED)] * count
+        self.lock = threading.Lock()
+        self.wake = lambda: None  # set by the engine, called when a motor is commanded
+        self.catch_up = lambda: None  # set by the engine, steps the bank up to now
+        self.stepped_at = None  # monotonic time the bank was last stepped to by the engine
+        self.motors = [_FakeMotor(self, i) for i in range(count)]
+
+    def is_moving(self):
+        return any(self.has_goal) or any(self.speed)
+
+    def step_to(self, now):
+        "Advance every motor up to the monotonic time now. Returns True if a motor is still moving."
+        with self.lock:
+            dt = max(now - self.stepped_at, 0.0)
+            self.stepped_at = max(now, self.stepped_at)
+        return self.step(dt)
+
+    def step(self, dt):
+        "Advance every motor by dt seconds. Returns True if a motor is still moving."
+        with self.lock:
+            position, speed, has_goal = self.position, self.speed, self.has_goal
+            if not any(has_goal):
+                # Speed control only, the common case
+                moving = False
+                for i, v in enumerate(speed):
+                    if v:
+                        position[i] += v * dt
+                        moving = True
+                return moving
+            power, goal = self.power, self.goal
+            for i in range(len(position)):
+                if not has_goal[i]:
+                    position[i] += speed[i] * dt
+                    continue
+                best_speed = min(self.speed_limit[i], self.power_limit[i] / 100 * self.MAX_SPEED)
+                diff = goal[i] - position[i]
+                if abs(diff) <= best_speed * dt:
+                    position[i] = goal[i]
+                    has_goal[i] = False
+                    speed[i] = power[i] = 0.0
+                else:
+                    speed[i] = best_speed if diff > 0 else -best_speed
+                    power[i] = speed[i] * 100 / self.MAX_SPEED
+                    position[i] += speed[i] * dt
+            return any(has_goal) or any(speed)
 
-        self.position_goal = None
-        self.state = 0
 
-        self.position = 0
-        self.speed = 0  # Maximum is 1050dps
-        self.power = 0  # Maximum is 1050dps
+class _FakeMotor:
+    "One motor of a _MotorBank, with the interface the dummy BrickPi3 methods use."
 
-        self.set_limits()
+    def __init__(self, bank, index):
+        self.bank = bank
+        self.index = index
 
-    def start(self):
-        self.event.set()
-        self.thread.start()
+    position = property(lambda self: self.bank.position[self.index])
+    speed = property(lambda self: self.bank.speed[self.index])
+    power = property(lambda self: self.bank.power[self.index])
+    power_limit = property(lambda self: self.bank.power_limit[self.index])
+    speed_limit = property(lambda self: self.bank.speed_limit[self.index])
+
+    @property
+    def position_goal(self):
+        return self.bank.goal[self.index] if self.bank.has_goal[self.index] else None
 
     @staticmethod
     def limit(val, lower, upper):
@@ -68,77 +138,128 @@ class _FakeMotor:
         limit = abs(limit)
         return _FakeMotor.limit(val, -limit, limit)
 
-    def _listener(self, *args):
-        while self.event.is_set():
-            if self.position_goal is not None:
-                if self.state == 0:
-                    self.state = -1 if self.position_goal < self.position else 1
-                best_speed = self.state * min(self.speed_limit,
-                                         self.power_limit/100*self.MAX_SPEED)
-                self.speed = best_speed
-                self.power = best_speed * 100 / self.MAX_SPEED
-
-                if (self.state == -1 and self.position <= self.position_goal) or (self.state == 1 and self.position >= self.position_goal):
-                    self.set_position(self.position_goal)
-                    self.position_goal = None
-                    self.state = 0
-                    self.speed = 0
-                    self.power = 0
-            else:
-                self.state = 0
-            delta_pos = self.speed * self.THREAD_INTERVAL
-            self.set_position(self.position + delta_pos)
-            time.sleep(self.THREAD_INTERVAL)
+    def _stop(self):
+        bank, i = self.bank, self.index
+        bank.speed[i] = bank.power[i] = 0.0
+        bank.has_goal[i] = False
 
-    def go_position(self, goal):
-        self.stop()
-        self.position_goal = self.abs_limit(goal, self.MAX_POS)
+    def _move(self, speed):
+        bank, i = self.bank, self.index
+        with bank.lock:
+            self._stop()
+            bank.speed[i] = self.abs_limit(speed, bank.MAX_SPEED)
+            bank.power[i] = bank.speed[i] / bank.MAX_SPEED * 100
+        bank.wake()
 
     def stop(self):
-        self.speed = 0
-        self.power = 0
-        self.state = 0
-        self.position_goal = None
-
-    def power_to_speed(self):
-        self.speed = self.power / 100 * self.MAX_SPEED
+        with self.bank.lock:
+            self._stop()
 
-    def speed_to_power(self):
-        self.power = self.speed / self.MAX_SPEED * 100
+    def go_position(self, goal):
+        bank, i = self.bank, self.index
+        with bank.lock:
+            self._stop()
+            bank.goal[i] = self.abs_limit(goal, bank.MAX_POS)
+            bank.has_goal[i] = True
+        bank.wake()
 
     def set_limits(self, power=0, speed=0):
+        bank, i = self.bank, self.index
         power = abs(power)
         speed = abs(speed)
-        if power == 0:
-            self.power_limit = 100
-        else:
-            self.power_limit = self.limit(power, 0, 100)
-        if speed == 0:
-            self.speed_limit = self.MAX_SPEED
-        else:
-            self.speed_limit = self.limit(speed, 0, self.MAX_SPEED)
+        with bank.lock:
+            bank.power_limit[i] = 100 if power == 0 else self.limit(power, 0, 100)
+            bank.speed_limit[i] = bank.MAX_SPEED if speed == 0 else self.limit(speed, 0, bank.MAX_SPEED)
 
     def set_power(self, power):
-        self.stop()
-        self.power = power
-        self.power_to_speed()
+        if power == BrickPi3.MOTOR_FLOAT:
+            self.stop()
+        else:
+            self._move(self.abs_limit(power, 100) / 100 * self.bank.MAX_SPEED)
 
     def set_speed(self, speed):
-        self.stop()
-        self.speed = speed
-        self.speed_to_power()
+        self._move(speed)
 
     def set_position(self, pos):
+        "Set the encoder value, like offset_motor_encoder."
         if pos is None:
-            self.position = 0
-        self.position = round((self.abs_limit(pos, self.MAX_POS) +
-                               self.MAX_POS) % (131072+1) - self.MAX_POS, 1)
+            pos = 0
+        with self.bank.lock:
+            self.bank.position[self.index] = ((self.abs_limit(pos, self.bank.MAX_POS) + self.bank.MAX_POS)
+                                              % (131072 + 1) - self.bank.MAX_POS)
 
     def shutdown(self):
-        self.event.clear()
+        self.stop()
 
-    def __del__(self):
-        self.shutdown()
+
+class _MotorEngine:
+    """
+    Single daemon thread advancing the motor banks of every dummy BrickPi3 at rate_hz.
+
+    Each tick steps the banks by the time actually elapsed, so encoder trajectories stay
+    exact when a tick is late, and the BrickPi3 methods catch a bank up before reading
+    or commanding it, so the readings do not depend on the rate. The thread sleeps until
+    the next command while no motor moves. Banks are held weakly, so a BrickPi3 that is
+    garbage collected drops out.
+    """
+
+    def __init__(self, rate_hz=MOTOR_RATE_HZ):
+        self.set_rate(rate_hz)
+        self.banks = weakref.WeakSet()
+        self._wake = threading.Event()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def set_rate(self, rate_hz):
+        if rate_hz <= 0:
+            raise ValueError("rate_hz must be a positive value")
+        self.rate_hz = rate_hz
+        self.period = 1 / rate_hz
+
+    def register(self, bank):
+        bank.wake = self._wake.set
+        bank.stepped_at = time.monotonic()
+        bank.catch_up = lambda: bank.step_to(time.monotonic())
+        with self._lock:
+            self.banks.add(bank)
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+        self._wake.set()
+
+    def unregister(self, bank):
+        bank.wake = bank.catch_up = lambda: None
+        self.banks.discard(bank)
+
+    def _run(self):
+        next_time = time.monotonic()
+        while True:
+            # Cleared before stepping, so a command sent during the step is not missed
+            self._wake.clear()
+            now = time.monotonic()
+            moving = False
+            for bank in list(self.banks):
+                moving = bank.step_to(now) or moving
+            if not moving:
+                self._wake.wait()
+                next_time = time.monotonic()
+                continue
+            next_time += self.period
+            delay = next_time - time.monotonic()
+            if delay < -self.period:
+                next_time = time.monotonic()
+            elif delay > 0:
+                time.sleep(delay)
+
+
+_ENGINE = _MotorEngine()
+
+
+def set_motor_rate(rate_hz):
+    """Change how many times per second the fake motors are advanced. Readings through
+    the BrickPi3 methods are exact at any rate: raise it only to follow high-resolution
+    trajectories by reading the motor banks (or _FakeMotor views) directly."""
+    _ENGINE.set_rate(rate_hz)
 
 
 class BrickPi3():
@@ -354,13 +475,18 @@ class BrickPi3():
                 "get_sensor error. Must be one sensor port at a time. PORT_1, PORT_2, PORT_3, or PORT_4.")
         return (port_index, message_type)
 
+    @classmethod
+    def _motor_indexes(cls, port):
+        "Motor commands accept several ports at once, such as PORT_A + PORT_D."
+        if not 0 < port <= 0x0F:
+            raise IOError("Motor port must be a combination of PORT_A, PORT_B, PORT_C, and PORT_D.")
+        return [i for i in range(4) if port & (1 << i)]
+
     def __init__(self, addr=1, detect=True):
         self.SPI_Address = 1
         self.SensorType = [None for i in range(4)]
-        self.Motors = [_FakeMotor() for i in range(4)]
+        self.Motors = self._create_motors()
         self.SPI_Messages = {self._convert_port(2**i)[1]: i for i in range(4)}
-        for mot in self.Motors:
-            mot.start()
 
         self._internal_data = {
             BrickPi3.SENSOR_TYPE.TOUCH: 0,
@@ -377,13 +503,13 @@ class BrickPi3():
             BrickPi3.SENSOR_TYPE.EV3_GYRO_ABS_DPS: (0, 0)
         }
 
-    def __del__(self):
-        if hasattr(self, "Motors"):
-            try:
-                for mot in self.Motors:
-                    mot.shutdown()
-            except TypeError:
-                pass
+    def _create_motors(self):
+        """Create the four fake motors, advanced by the motor engine. Overridden by the simulator.
+        The engine holds the bank weakly, so it stops moving once nothing refers to it
+        (brick.Brick copies share it)."""
+        self.motor_bank = _MotorBank()
+        _ENGINE.register(self.motor_bank)
+        return self.motor_bank.motors
 
     def spi_transfer_array(self, data_out):
         """Used by Brick.get_sensor_status"""
@@ -481,12 +607,14 @@ class BrickPi3():
         return self._internal_data[sensorType]
 
     def set_motor_power(self, port, power):
-        i, _ = self._convert_port(port)
-        self.Motors[i].set_power(power)
+        self.motor_bank.catch_up()
+        for i in self._motor_indexes(port):
+            self.Motors[i].set_power(power)
 
     def set_motor_position(self, port, position):
-        i, _ = self._convert_port(port)
-        self.Motors[i].go_position(position)
+        self.motor_bank.catch_up()
+        for i in self._motor_indexes(port):
+            self.Motors[i].go_position(position)
 
     def set_motor_position_relative(self, port, degrees):
         pos = self.get_motor_encoder(port)
@@ -499,26 +627,32 @@ class BrickPi3():
         pass
 
     def set_motor_dps(self, port, dps):
-        i, _ = self._convert_port(port)
-        self.Motors[i].set_speed(dps)
+        self.motor_bank.catch_up()
+        for i in self._motor_indexes(port):
+            self.Motors[i].set_speed(dps)
 
     def set_motor_limits(self, port, power=0, dps=0):
-        i, _ = self._convert_port(port)
-        self.Motors[i].set_limits(power, dps)
+        self.motor_bank.catch_up()
+        for i in self._motor_indexes(port):
+            self.Motors[i].set_limits(power, dps)
 
     def get_motor_status(self, port):
+        self.motor_bank.catch_up()
         i, _ = self._convert_port(port)
         return [0, self.Motors[i].power, self.Motors[i].position, self.Motors[i].speed]
 
     def get_motor_encoder(self, port):
+        self.motor_bank.catch_up()
         i, _ = self._convert_port(port)
         return self.Motors[i].position
 
     def offset_motor_encoder(self, port, position):
+        self.motor_bank.catch_up()
         i, _ = self._convert_port(port)
         self.Motors[i].set_position(position)
 
     def reset_motor_encoder(self, port):
+        self.motor_bank.catch_up()
         i, _ = self._convert_port(port)
         self.Motors[i].set_position(0)
 
@@ -6,11 +6,15 @@ Author: Ryan Au
 """
 
 import math
-import time
+import sys
+from array import array
+from bisect import bisect_left, insort
 from collections import UserList, deque
-from statistics import mean, median
+from statistics import mean
 import threading
 
+from . import clock
+
 
 def range_limit(value: float, lower: float, upper: float) -> float:
     """Prevents the value from going beyond the upper or lower values.
@@ -452,15 +456,255 @@ class CircularList(AtomicActor):
         raise Exception("Unimplemented function")
 
 
+class RingBuffer:
+    """A CircularList replacement for numeric streams, backed by a preallocated array.array.
+
+    It has the same methods as CircularList, but takes no lock and allocates nothing per
+    append. Without a lock, only one thread may change it (append/update, pop, pophead,
+    clear, ...), while other threads only read it with to_list or slicing, which give a
+    consistent snapshot of the window. Values are stored as typecode (floats by default),
+    so ints come back as floats. None, which sensors return before they are ready, is
+    stored as NaN and read back as None, as is NaN (with a float typecode only).
+
+    Every item is stored twice, at slot and slot + size, so the window is always one
+    contiguous slice of data and to_list is a single copy.
+
+    >>> r = RingBuffer(3)
+    >>> r.append(1)
+    Empty
+    >>> r.update([2, 3, 4])
+    >>> r
+    [2.0, 3.0, 4.0]
+    >>> r.append(5)
+    2.0
+    >>> r[0], r[-1], r[0:2], len(r)
+    (3.0, 5.0, [3.0, 4.0], 3)
+    >>> r.pop(), r.pophead(), r.to_list()
+    (5.0, 3.0, [4.0])
+    >>> r[0] = 7
+    >>> 7 in r, r.count(7), r.index(7)
+    (True, 1, 0)
+    >>> r.clear()
+    >>> len(r)
+    0
+    >>> r.pop() # doctest: +IGNORE_EXCEPTION_DETAIL
+    Traceback (most recent call last):
+    RuntimeError: There are no items in this list
+    >>> r.update([1, None, 3])
+    >>> r, r[1], r.count(None)
+    ([1.0, None, 3.0], None, 1)
+    >>> r.append(4), r.append(5)
+    (1.0, None)
+    """
+    _EMPTY = CircularList.Empty()
+    _MISSING = math.nan  # stored for None
+
+    def __init__(self, size: int, typecode: str = 'd'):
+        if type(size) != int:
+            raise ValueError("size must be of type int")
+        if size <= 0:
+            raise ValueError("size must be positive non-zero value")
+        self.size = size
+        self.typecode = typecode
+        self.data = array(typecode, bytes(array(typecode).itemsize * size * 2))
+        # Total number of items ever removed from the front, and ever appended.
+        # The item number n lives in data[n % size].
+        self._start = 0
+        self._end = 0
+        # Item number after the last None or NaN: while the window starts before it,
+        # reads have to turn NaN back into None
+        self._missing_end = 0
+
+    def __repr__(self):
+        return repr(self.to_list())
+
+    def __len__(self):
+        return self._end - self._start
+
+    def __iter__(self):
+        """Iterates from oldest to newest without copying the buffer."""
+        data, size = self.data, self.size
+        for n in range(self._start, self._end):
+            item = data[n % size]
+            yield item if item == item else None
+
+    def append(self, element):
+        """Appends element. Returns the overwritten oldest element if the buffer was full,
+        otherwise CircularList.Empty."""
+        end = self._end
+        size = self.size
+        slot = end % size
+        data = self.data
+        if element is None or element != element:
+            element = self._MISSING
+            self._missing_end = end + 1
+        if end - self._start == size:
+            last_item = data[slot]
+            if last_item != last_item:
+                last_item = None
+            self._start += 1
+        else:
+            last_item = self._EMPTY
+        data[slot] = element
+        data[slot + size] = element
+        self._end = end + 1
+        return last_item
+
+    def update(self, iterable):
+        for i in iterable:
+            self.append(i)
+
+    def extend(self, iterable):
+        self.update(iterable)
+
+    def to_list(self):
+        # Reading _end before _start, the window never includes the slot being appended.
+        # Slicing the array is atomic, and append moves _start before overwriting the
+        # oldest item, so items overwritten before the slice are dropped afterwards.
+        end = self._end
+        start = self._start
+        first = start % self.size
+        items = self.data[first:first + max(end - start, 0)]
+        stale = self._start - start
+        items = items[stale:].tolist() if stale else items.tolist()
+        if self._missing_end > start:
+            return [item if item == item else None for item in items]
+        return items
+
+    def pop(self):
+        """Remove last added item and return it."""
+        if self._end == self._start:
+            raise RuntimeError("There are no items in this list")
+        self._end -= 1
+        item = self.data[self._end % self.size]
+        return item if item == item else None
+
+    def poptail(self):
+        """Remove last added item and return it."""
+        return self.pop()
+
+    def pophead(self):
+        """Remove first added item and return it."""
+        if self._end == self._start:
+            raise RuntimeError("There are no items in this list")
+        item = self.data[self._start % self.size]
+        self._start += 1
+        return item if item == item else None
+
+    def _convert_index(self, i: int) -> int:
+        n = self._end - self._start
+        if i < 0:
+            i += n
+        if i < 0 or i >= n:
+            raise IndexError("Index out of bounds")
+        return (self._start + i) % self.size
+
+    def __getitem__(self, i: slice | int):
+        if type(i) == slice:
+            return self.to_list()[i]
+        item = self.data[self._convert_index(i)]
+        return item if item == item else None
+
+    def __setitem__(self, i: int, value):
+        slot = self._convert_index(i)
+        if value is None or value != value:
+            value = self._MISSING
+            self._missing_end = self._end
+        self.data[slot] = value
+        self.data[slot + self.size] = value
+
+    def __contains__(self, value):
+        return any(item == value for item in self)
+
+    def __reversed__(self):
+        c = RingBuffer(self.size, self.typecode)
+        c.update(reversed(self.to_list()))
+        return c
+
+    def clear(self):
+        self._start = self._end
+
+    def copy(self):
+        c = RingBuffer(self.size, self.typecode)
+        c.update(self)
+        return c
+
+    def count(self, value):
+        return sum(1 for item in self if item == value)
+
+    def index(self, value):
+        for i, item in enumerate(self):
+            if item == value:
+                return i
+        raise ValueError(f"{value} is not in list")
+
+    def _rewrite(self, items: list):
+        """Replaces the window with items (at most size of them)."""
+        self._start = self._end = 0
+        self.update(items)
+
+    def remove(self, value):
+        """Removes the first occurrence of value.
+
+        >>> r = RingBuffer(4)
+        >>> r.update([3, 1, 2, 1])
+        >>> r.remove(1)
+        >>> r
+        [3.0, 2.0, 1.0]
+        >>> r.reverse()
+        >>> r
+        [1.0, 2.0, 3.0]
+        >>> r.update([0, -1])
+        >>> r.sort()
+        >>> r
+        [-1.0, 0.0, 2.0, 3.0]
+        """
+        items = self.to_list()
+        items.remove(value)
+        self._rewrite(items)
+
+    def reverse(self):
+        self._rewrite(self.to_list()[::-1])
+
+    def sort(self):
+        self._rewrite(sorted(self.to_list()))
+
+
 class WindowedFilter(AtomicActor):
-    def __init__(self, window_size=10):
+    def __init__(self, window_size=10, buffer_type=CircularList, history=None, downsample=False):
+        """buffer_type - CircularList (default), or RingBuffer for high-rate numeric
+        streams appended from a single thread.
+        history - How many outputs to keep in to_list(). None keeps every output (the default),
+        0 keeps none and N keeps the last N. get_value() works with any setting.
+        downsample - With history=N, keep outputs from the whole run instead of the last N.
+        They are stored in an array of at most N floats. Whenever it fills up, every other
+        stored output is dropped and only every 2nd, 4th, 8th... output is stored from then on.
+
+        >>> m = MeanWindow(2, history=3)
+        >>> _ = m.extend(range(10))
+        >>> m.to_list(), m.get_value()
+        ([6.5, 7.5, 8.5], 8.5)
+        >>> d = SumWindow(1, history=4, downsample=True)
+        >>> _ = d.extend(range(10))
+        >>> d.to_list(), d.stride, d.get_value()
+        ([0.0, 4.0, 8.0], 4, 9)
+        """
         if type(window_size) != int or window_size <= 0:
             raise RuntimeError(
                 "window_size is an invalid value. Must be a positive integer.")
+        if downsample and not history:
+            raise ValueError("downsample requires a positive history size")
 
         self.window_size = window_size
-        self.queue = deque()
-        self.circ = CircularList(self.window_size)
+        self.history = history
+        self.downsample = downsample
+        self.queue = array('d') if downsample else deque(maxlen=history)
+        self.stride = 1
+        self.output_count = 0
+        self.last_value = None
+        # Latest outputs, whatever the history policy, so pop() can go back to them
+        self._recent = deque(maxlen=window_size + 1)
+        self.circ = buffer_type(self.window_size)
 
     def __appender__(self, in_value, out_value):
         """The method to be overriden, when subclassing WindowedFilter.
@@ -477,19 +721,102 @@ class WindowedFilter(AtomicActor):
         return list(self.queue)
 
     def get_value(self):
-        if self.queue:
-            return self.queue[-1]
+        return self.last_value
+
+    def memory_usage(self):
+        """Approximate bytes held by the output history and the window."""
+        history = sys.getsizeof(self.queue)
+        if not self.downsample:
+            history += len(self.queue) * sys.getsizeof(0.0)
+        window = sys.getsizeof(self.circ.data)
+        if not isinstance(self.circ.data, array):
+            window += len(self.circ) * sys.getsizeof(0.0)
+        return history + window
+
+    def _record(self, value):
+        """Stores one output, following the history policy."""
+        self.last_value = value
+        self._recent.append(value)
+        index = self.output_count
+        self.output_count += 1
+        if not self.downsample:
+            self.queue.append(value)
+            return
+        if index % self.stride:
+            return
+        if len(self.queue) >= self.history:
+            self.queue = self.queue[::2]
+            self.stride *= 2
+            if index % self.stride:
+                return
+        self.queue.append(math.nan if value is None else value)
+
+    def _record_all(self, values):
+        if values and not self.downsample:
+            self.queue.extend(values)
+            self._recent.extend(values)
+            self.last_value = values[-1]
+            self.output_count += len(values)
         else:
-            return None
+            for value in values:
+                self._record(value)
 
     def append(self, value, **kwargs):
         out_value = self.circ.append(value)
         if isinstance(out_value, CircularList.Empty):
             out_value = None
         in_value = self.__appender__(value, out_value, **kwargs)
-        self.queue.append(in_value)
+        self._record(in_value)
+
+    def extend(self, values, **kwargs):
+        """Appends every value of values (a list, array.array or NumPy array) in one call,
+        giving exactly the same outputs as calling append on each value.
+        Returns the list of new outputs.
+
+        >>> streamed, batched = MeanWindow(3), MeanWindow(3)
+        >>> for v in [0.1, 0.7, 0.2, 0.9, 0.3]:
+        ...     streamed.append(v)
+        >>> _ = batched.extend([0.1, 0.7])
+        >>> _ = batched.extend(array('d', [0.2, 0.9, 0.3]))
+        >>> streamed.to_list() == batched.to_list()
+        True
+        >>> streamed.get_inner_list() == batched.get_inner_list()
+        True
+        """
+        values = list(values)
+        outs = self._shift_window(values)
+        results = self.__extend__(values, outs, **kwargs)
+        self._record_all(results)
+        return results
+
+    def _shift_window(self, values):
+        """Pushes values into the window, and returns the value each one evicted (or None)."""
+        window = self.circ.to_list()
+        stream = window + values
+        skip = len(window) - self.window_size
+        outs = [stream[skip + i] if skip + i >= 0 else None for i in range(len(values))]
+        self.circ.update(values[-self.window_size:])
+        return outs
+
+    def __extend__(self, values, outs, **kwargs):
+        """Batch version of __appender__, given each new value and the value it evicted.
+        Override it with a tighter loop when subclassing WindowedFilter."""
+        appender = self.__appender__
+        return [appender(v, o, **kwargs) for v, o in zip(values, outs)]
 
     def pop(self):
+        """Removes the last appended value, and returns the last output. get_value() then
+        gives the output from before that append again, whatever the history setting.
+
+        >>> d = MeanWindow(3, history=4, downsample=True)
+        >>> _ = d.extend(range(1, 21))
+        >>> d.pop(), d.get_value(), d.to_list()
+        (19.0, 18.0, [1.0, 8.0, 16.0])
+        >>> h = MeanWindow(3, history=0)
+        >>> _ = h.extend([1, 2, 3, 4])
+        >>> h.pop(), h.get_value(), h.to_list()
+        (3.0, 2.0, [])
+        """
         try:
             out_value = self.circ.pop()
         except:
@@ -497,23 +824,35 @@ class WindowedFilter(AtomicActor):
         if isinstance(out_value, CircularList.Empty):
             out_value = None
         _ = self.__appender__(None, out_value)
-        try:
-            return self.queue.pop()
-        except:
+        if not self._recent:
             return None
+        value = self._recent.pop()
+        self.last_value = self._recent[-1] if self._recent else None
+        if self.output_count > 0:
+            self.output_count -= 1
+            if not self.downsample:
+                if self.queue:
+                    self.queue.pop()
+            elif self.output_count % self.stride == 0 and self.queue:
+                self.queue.pop()  # the popped output was stored
+        return value
 
     def clear(self):
-        while self.pop() is not None:
-            pass
-        self.queue.clear()
+        while len(self.circ) > 0:
+            self.pop()
+        self.queue = array('d') if self.downsample else deque(maxlen=self.history)
+        self._recent.clear()
+        self.stride = 1
+        self.output_count = 0
+        self.last_value = None
 
     def __repr__(self):
         return str(list(self.queue))
 
 
 class MeanWindow(WindowedFilter):
-    def __init__(self, window_size=10):
-        super().__init__(window_size)
+    def __init__(self, window_size=10, buffer_type=CircularList, history=None, downsample=False):
+        super().__init__(window_size, buffer_type, history, downsample)
         self.running_sum = 0
         self.running_n = 0
 
@@ -527,10 +866,24 @@ class MeanWindow(WindowedFilter):
         self.running_n = min(self.window_size, self.running_n + 1)
         return self.running_sum / self.running_n
 
+    def __extend__(self, values, outs):
+        total, n, size = self.running_sum, self.running_n, self.window_size
+        results = []
+        for v, o in zip(values, outs):
+            if o is not None:
+                total -= o
+            if v is not None:
+                total += v
+            if n < size:
+                n += 1
+            results.append(total / n)
+        self.running_sum, self.running_n = total, n
+        return results
+
 
 class SumWindow(WindowedFilter):
-    def __init__(self, window_size=10):
-        super().__init__(window_size)
+    def __init__(self, window_size=10, buffer_type=CircularList, history=None, downsample=False):
+        super().__init__(window_size, buffer_type, history, downsample)
         self.running_sum = 0
 
     def __appender__(self, in_value, out_value):
@@ -541,24 +894,144 @@ class SumWindow(WindowedFilter):
 
         return self.running_sum
 
+    def __extend__(self, values, outs):
+        total = self.running_sum
+        results = []
+        for v, o in zip(values, outs):
+            if o is not None:
+                total -= o
+            if v is not None:
+                total += v
+            results.append(total)
+        self.running_sum = total
+        return results
+
+
+class QuantileWindow(WindowedFilter):
+    """Rolling quantile of the window, from 0 (minimum) to 1 (maximum).
+
+    The window is kept as a sorted list. Each append removes the outgoing value with a
+    binary search and inserts the new one with insort, so no sort is done per sample.
+    Both are O(log n) searches plus one memmove, which beats a dual-heap at these window
+    sizes. Quantiles between two samples are linearly interpolated. NaN values cannot be
+    sorted, so they are only counted, and the quantile is that of the other values.
+
+    >>> q = QuantileWindow(5, quantile=0.25)
+    >>> for v in [10, 1, 7, 3, 5, 9]:
+    ...     q.append(v)
+    >>> q.to_list()
+    [10, 3.25, 4.0, 2.5, 3, 3]
+    >>> q.data
+    [1, 3, 5, 7, 9]
+    >>> for v in [float('nan'), 8]:
+    ...     q.append(v)
+    >>> q.data, q.nans, q.get_value()
+    ([3, 5, 8, 9], 1, 4.5)
+    """
 
-class MedianWindow(WindowedFilter):
-    def __init__(self, window_size=10):
-        super().__init__(window_size)
+    def __init__(self, window_size=10, quantile=0.5, buffer_type=CircularList,
+                 history=None, downsample=False):
+        super().__init__(window_size, buffer_type, history, downsample)
+        if not 0 <= quantile <= 1:
+            raise ValueError("quantile must be between 0 and 1")
+        self.quantile = quantile
         self.data = []
+        self.nans = 0  # NaN values in the window, kept out of data
+
+    def _remove(self, value):
+        """Removes value from data, or from the NaN count. Raises ValueError if it is not in
+        the window, like list.remove."""
+        if value != value:
+            self.nans -= 1
+            return
+        data = self.data
+        i = bisect_left(data, value)
+        if i == len(data) or data[i] != value:
+            raise ValueError(f"{value!r} is not in the window")
+        del data[i]
 
     def __appender__(self, in_value, out_value):
         if out_value is not None:
-            self.data.remove(out_value)
+            self._remove(out_value)
         if in_value is not None:
-            self.data.append(in_value)
-        self.data.sort()
-        return median(self.data)
+            if in_value == in_value:
+                insort(self.data, in_value)
+            else:
+                self.nans += 1
+        return self._compute()
+
+    def __extend__(self, values, outs):
+        data = self.data
+        compute = self._compute
+        results = []
+        for v, o in zip(values, outs):
+            if o is not None:
+                i = bisect_left(data, o)
+                if i < len(data) and data[i] == o:
+                    del data[i]
+                else:
+                    self._remove(o)  # NaN, or not in the window
+            if v is not None:
+                if v == v:
+                    insort(data, v)
+                else:
+                    self.nans += 1
+            results.append(compute())
+        return results
+
+    def _compute(self):
+        data = self.data
+        if not data:
+            return None
+        position = self.quantile * (len(data) - 1)
+        lower = int(position)
+        fraction = position - lower
+        if fraction == 0:
+            return data[lower]
+        return data[lower] + (data[lower + 1] - data[lower]) * fraction
+
+
+class PercentileWindow(QuantileWindow):
+    """Rolling percentile of the window, from 0 to 100.
+
+    >>> p = PercentileWindow(4, percentile=100)
+    >>> for v in [3, 8, 2, 5, 1]:
+    ...     p.append(v)
+    >>> p.to_list()
+    [3, 8, 8, 8, 8]
+    """
+
+    def __init__(self, window_size=10, percentile=50, buffer_type=CircularList,
+                 history=None, downsample=False):
+        super().__init__(window_size, percentile / 100, buffer_type, history, downsample)
+
+
+class MedianWindow(QuantileWindow):
+    """Rolling median of the window, computed exactly as statistics.median does.
+
+    >>> m = MedianWindow(4)
+    >>> for v in [5, 1, 4, 2, 8]:
+    ...     m.append(v)
+    >>> m.to_list()
+    [5, 3.0, 4, 3.0, 3.0]
+    """
+
+    def __init__(self, window_size=10, buffer_type=CircularList, history=None, downsample=False):
+        super().__init__(window_size, 0.5, buffer_type, history, downsample)
+
+    def _compute(self):
+        data = self.data
+        n = len(data)
+        if n == 0:
+            return None
+        if n % 2 == 1:
+            return data[n // 2]
+        return (data[n // 2 - 1] + data[n // 2]) / 2
 
 
 class IntegrationTracker(WindowedFilter):
-    def __init__(self, default_dx=1):
-        super().__init__(window_size=1)
+    def __init__(self, default_dx=1, history=None, downsample=False):
+        super().__init__(window_size=1, history=history, downsample=downsample)
         self.default_dx = default_dx
 
     def __appender__(self, in_value, out_value, dx=None):
@@ -575,6 +1048,333 @@ class IntegrationTracker(WindowedFilter):
         else:
             return (out_value + in_value) / 2 * dx + old
 
+    def __extend__(self, values, outs, dx=None):
+        """dx may be a single step, or one step per value."""
+        if dx is None:
+            dx = self.default_dx
+        dxs = dx if hasattr(dx, '__len__') else [dx] * len(values)
+        total = self.get_value()
+        total = 0 if total is None else total
+        results = []
+        for v, o, step in zip(values, outs, dxs):
+            if o is not None and v is not None:
+                total = (o + v) / 2 * step + total
+            results.append(total)
+        return results
+
+
+class ExponentialFilter:
+    """Exponential moving average (first order IIR low-pass), O(1) memory per sample.
+
+    Each append moves the output a fraction alpha of the way towards the new value.
+    Instead of alpha, a time_constant (seconds) may be given, so that the smoothing
+    stays the same when the sampling period dt changes.
+
+    >>> e = ExponentialFilter(alpha=0.5)
+    >>> for v in [10, 20, 20, 20]:
+    ...     e.append(v)
+    >>> e.get_value()
+    18.75
+    """
+
+    def __init__(self, alpha=0.5, time_constant=None, default_dt=0.05):
+        if time_constant is None and not 0 < alpha <= 1:
+            raise ValueError("alpha must be within (0, 1]")
+        self.alpha = alpha
+        self.time_constant = time_constant
+        self.default_dt = default_dt
+        self.value = None
+
+    def get_value(self):
+        return self.value
+
+    def append(self, value, dt=None):
+        if value is None:
+            return
+        if self.value is None:
+            self.value = value
+            return
+        alpha = self.alpha
+        if self.time_constant is not None:
+            dt = self.default_dt if dt is None else dt
+            alpha = 1 - math.exp(-dt / self.time_constant)
+        self.value += alpha * (value - self.value)
+
+    def clear(self):
+        self.value = None
+
+
+class AlphaBetaFilter:
+    """Alpha-beta tracker: estimates a value and its rate of change (per second).
+
+    Between samples the value is predicted from its rate. The prediction error then
+    corrects the value by alpha and the rate by beta / dt.
+
+    >>> ab = AlphaBetaFilter(alpha=0.5, beta=0.1, default_dt=1)
+    >>> for v in [0, 1, 2, 3, 4, 5]:
+    ...     ab.append(v)
+    >>> round(ab.get_value(), 3), round(ab.get_rate(), 3)
+    (4.424, 0.636)
+    """
+
+    def __init__(self, alpha=0.5, beta=0.1, default_dt=0.05):
+        self.alpha = alpha
+        self.beta = beta
+        self.default_dt = default_dt
+        self.value = None
+        self.rate = 0.0
+
+    def get_value(self):
+        return self.value
+
+    def get_rate(self):
+        return self.rate
+
+    def append(self, value, dt=None):
+        if value is None:
+            return
+        if self.value is None:
+            self.value = value
+            return
+        dt = self.default_dt if dt is None else dt
+        predicted = self.value + self.rate * dt
+        residual = value - predicted
+        self.value = predicted + self.alpha * residual
+        self.rate += self.beta * residual / dt
+
+    def clear(self):
+        self.value = None
+        self.rate = 0.0
+
+
+class KalmanFilter1D:
+    """Scalar Kalman filter for a slowly changing value (random walk model).
+
+    process_variance - how much the true value may drift per second (variance)
+    measurement_variance - variance of the sensor noise
+    The gain adapts on its own: large while the estimate is uncertain, then settling
+    to the steady state given by the two variances.
+
+    >>> k = KalmanFilter1D(process_variance=0.1, measurement_variance=4)
+    >>> for v in [30, 32, 29, 31, 30, 30]:
+    ...     k.append(v)
+    >>> round(k.get_value(), 2), round(k.variance, 3)
+    (30.33, 0.674)
+    """
+
+    def __init__(self, process_variance=1.0, measurement_variance=4.0, default_dt=0.05):
+        self.process_variance = process_variance
+        self.measurement_variance = measurement_variance
+        self.default_dt = default_dt
+        self.value = None
+        self.variance = None
+
+    def get_value(self):
+        return self.value
+
+    def append(self, value, dt=None):
+        if value is None:
+            return
+        if self.value is None:
+            self.value = value
+            self.variance = self.measurement_variance
+            return
+        dt = self.default_dt if dt is None else dt
+        variance = self.variance + self.process_variance * dt
+        gain = variance / (variance + self.measurement_variance)
+        self.value += gain * (value - self.value)
+        self.variance = (1 - gain) * variance
+
+    def clear(self):
+        self.value = None
+        self.variance = None
+
+
+class ConstantVelocityKalman:
+    """Kalman filter tracking a distance and its velocity, such as the distance to a wall
+    while driving alongside it. The state is [distance, velocity], and the velocity may
+    change by random accelerations of acceleration_variance (per second squared).
+
+    get_value() gives the filtered distance, get_velocity() its rate of change per second,
+    and predict(dt) the expected distance dt seconds from now.
+
+    >>> k = ConstantVelocityKalman(acceleration_variance=1, measurement_variance=1, default_dt=1)
+    >>> for v in [20, 19, 18, 17, 16, 15]:
+    ...     k.append(v)
+    >>> round(k.get_value(), 2), round(k.get_velocity(), 2)
+    (15.0, -1.0)
+    """
+
+    def __init__(self, acceleration_variance=10.0, measurement_variance=4.0, default_dt=0.05,
+                 initial_velocity_variance=100.0):
+        self.acceleration_variance = acceleration_variance
+        self.measurement_variance = measurement_variance
+        self.default_dt = default_dt
+        self.initial_velocity_variance = initial_velocity_variance
+        self.clear()
+
+    def get_value(self):
+        return self.distance
+
+    def get_velocity(self):
+        return self.velocity
+
+    def predict(self, dt):
+        if self.distance is None:
+            return None
+        return self.distance + self.velocity * dt
+
+    def append(self, value, dt=None):
+        if value is None:
+            return
+        if self.distance is None:
+            self.distance = value
+            self.velocity = 0.0
+            self.p00, self.p01, self.p11 = self.measurement_variance, 0.0, self.initial_velocity_variance
+            return
+        dt = self.default_dt if dt is None else dt
+        q = self.acceleration_variance
+
+        # Predict: x = F x, P = F P F' + Q, with F = [[1, dt], [0, 1]]
+        distance = self.distance + self.velocity * dt
+        p00 = self.p00 + dt * (2 * self.p01 + dt * self.p11) + q * dt ** 4 / 4
+        p01 = self.p01 + dt * self.p11 + q * dt ** 3 / 2
+        p11 = self.p11 + q * dt ** 2
+
+        # Update with the measured distance, H = [1, 0]
+        s = p00 + self.measurement_variance
+        k0, k1 = p00 / s, p01 / s
+        residual = value - distance
+        self.distance = distance + k0 * residual
+        self.velocity += k1 * residual
+        self.p00, self.p01, self.p11 = (1 - k0) * p00, (1 - k0) * p01, p11 - k1 * p01
+
+    def clear(self):
+        self.distance = None
+        self.velocity = 0.0
+        self.p00 = self.p01 = self.p11 = 0.0
+
+
+class LabelChange:
+    """A change of stable label reported by LabelDebouncer.
+
+    label - the new stable label
+    previous - the stable label before this change (None at the start)
+    latency_samples - samples between the first sighting of label and this change
+    latency_ms - the same latency, in milliseconds
+    timestamp - time of the sample that confirmed the change
+    """
+
+    def __init__(self, label, previous, latency_samples, latency_ms, timestamp):
+        self.label = label
+        self.previous = previous
+        self.latency_samples = latency_samples
+        self.latency_ms = latency_ms
+        self.timestamp = timestamp
+
+    def __repr__(self):
+        return f"LabelChange({self.previous!r} -> {self.label!r}, {self.latency_samples} samples)"
+
+
+class LabelDebouncer(AtomicActor):
+    """Streaming filter for labels, such as color names, that reports a change only once
+    the new label is stable.
+
+    A label becomes the stable label once it fills at least `votes` of the last
+    `window_size` samples. By default votes == window_size, so the label must be seen
+    window_size times in a row. A lower votes gives a majority vote that tolerates
+    glitches. The stable label then holds (hysteresis) until another label reaches
+    the same number of votes.
+
+    >>> d = LabelDebouncer(window_size=3)
+    >>> [d.append(x) for x in ["white", "black", "white", "white", "white"]]
+    [None, None, None, None, LabelChange(None -> 'white', 2 samples)]
+    >>> [d.append(x) for x in ["black", "black", "black", "black"]]
+    [None, None, LabelChange('white' -> 'black', 2 samples), None]
+    >>> d.get_value()
+    'black'
+    >>> m = LabelDebouncer(window_size=5, votes=3)
+    >>> [m.append(x) for x in ["red", "white", "red", "red"]]
+    [None, None, None, LabelChange(None -> 'red', 3 samples)]
+    """
+
+    def __init__(self, window_size: int = 3, votes: int = None):
+        super(LabelDebouncer, self).__init__()
+        if votes is None:
+            votes = window_size
+        if votes <= window_size / 2 or votes > window_size:
+            raise ValueError("votes must be a majority of window_size, and at most window_size")
+        self.window_size = window_size
+        self.votes = votes
+        self.circ = CircularList(window_size)  # (label, timestamp) samples
+        self.counts = {}
+        self.stable = None
+        self.sample_index = 0
+        self.last_change: LabelChange = None
+
+    def get_value(self):
+        """Returns the current stable label, None until one is established."""
+        return self.stable
+
+    @AtomicActor._atomic
+    def append(self, label, timestamp: float = None):
+        """Adds one label sample. Returns a LabelChange if the stable label changed,
+        otherwise None. timestamp defaults to clock.time(), so latencies follow a
+        simulated clock.
+
+        >>> from .clock import SimulatedClock
+        >>> clock.set_clock(SimulatedClock())
+        >>> d = LabelDebouncer(window_size=2)
+        >>> d.append("red")
+        >>> clock.sleep(0.05)
+        >>> d.append("red").latency_ms
+        50.0
+        >>> clock.set_clock()
+        """
+        if timestamp is None:
+            timestamp = clock.time()
+
+        out_value = self.circ.append((label, timestamp))
+        if not isinstance(out_value, CircularList.Empty):
+            out_label = out_value[0]
+            self.counts[out_label] -= 1
+            if self.counts[out_label] == 0:
+                del self.counts[out_label]
+        self.counts[label] = self.counts.get(label, 0) + 1
+
+        change = None
+        if label != self.stable and self.counts[label] >= self.votes:
+            # Latency is measured from the oldest sighting of label still in the window
+            window = self.circ.to_list()
+            for age, (old_label, old_time) in enumerate(reversed(window)):
+                if old_label == label:
+                    latency, onset_time = age, old_time
+            change = LabelChange(label, self.stable, latency,
+                                 (timestamp - onset_time) * 1000, timestamp)
+            self.stable = label
+            self.last_change = change
+        self.sample_index += 1
+        return change
+
+    @AtomicActor._atomic
+    def clear(self):
+        """Forgets the window, the stable label and the last change, as if just created.
+
+        >>> d = LabelDebouncer(window_size=2)
+        >>> [d.append(x) for x in ["black", "black"]]
+        [None, LabelChange(None -> 'black', 1 samples)]
+        >>> d.clear()
+        >>> d.get_value(), d.last_change, d.sample_index
+        (None, None, 0)
+        >>> [d.append(x) for x in ["black", "black"]]  # reported again
+        [None, LabelChange(None -> 'black', 1 samples)]
+        """
+        self.circ.clear()
+        self.counts.clear()
+        self.stable = None
+        self.sample_index = 0
+        self.last_change = None
+
 
 class ValueListWrapper(UserList):
     def __init__(self, iterable=None):
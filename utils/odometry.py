@@ -0,0 +1,217 @@
+"""
+Module for tracking the robot pose (x, y, theta) from the drive wheel encoders.
+
+The pose starts at (0, 0, 0): x points forward, y to the right, and theta grows when
+the robot turns right, like the angles used by turn() in the robot code. Distances are
+in the unit of the wheel and track radii (cm for the robot).
+
+Example:
+
+    ODOMETRY = Odometry(MOTOR_L, MOTOR_R, wheel_radius=RW, track_radius=RB)
+    ODOMETRY.start()                       # optional, samples in the background
+    step = ODOMETRY.distance_trigger(1)    # 1 cm from here
+    DRIVE.forward(45)
+    step.wait(timeout=2)
+    DRIVE.stop()
+    print(ODOMETRY.get_pose())
+"""
+
+from __future__ import annotations
+
+from typing import NamedTuple
+import math
+import threading
+import time
+
+from . import clock
+from .brick import EMERGENCY_STOP, Motor
+
+
+class Pose(NamedTuple):
+    "Position and heading (radians, positive to the right) of the robot."
+    x: float
+    y: float
+    theta: float
+
+
+def integrate_pose(pose: Pose, left: float, right: float, track_radius: float) -> Pose:
+    """Move pose by the distances travelled by the left and right wheels, assuming the
+    robot went along an arc in between (midpoint heading).
+
+    >>> p = integrate_pose(Pose(0, 0, 0), 10, 10, 5)
+    >>> p
+    Pose(x=10.0, y=0.0, theta=0.0)
+    >>> p = integrate_pose(p, math.pi * 5 / 2, -math.pi * 5 / 2, 5)  # turn right on the spot
+    >>> round(p.x, 6), round(p.y, 6), round(math.degrees(p.theta), 6)
+    (10.0, 0.0, 90.0)
+    >>> p = integrate_pose(p, 3, 3, 5)
+    >>> round(p.x, 6), round(p.y, 6)
+    (10.0, 3.0)
+    """
+    distance = (left + right) / 2
+    turn = (left - right) / (2 * track_radius)
+    heading = pose.theta + turn / 2
+    return Pose(pose.x + distance * math.cos(heading),
+                pose.y + distance * math.sin(heading),
+                pose.theta + turn)
+
+
+class DistanceTrigger:
+    """Fires once the robot has travelled a given distance (along its path, forwards or
+    backwards) since the trigger was created. Made by Odometry.distance_trigger."""
+
+    def __init__(self, odometry: Odometry, distance: float):
+        self.odometry = odometry
+        self.distance = distance
+        self.start = odometry.travelled
+
+    def remaining(self) -> float:
+        return self.distance - (self.odometry.travelled - self.start)
+
+    def reached(self) -> bool:
+        "True once the distance was travelled. Reads the encoders unless the odometry is running."
+        if not self.odometry.is_running():
+            self.odometry.update()
+        return self.remaining() <= 0
+
+    def wait(self, timeout: float = None) -> bool:
+        """
+        Block until the distance is travelled, for at most timeout seconds, or until the
+        emergency stop is triggered. Returns True if the distance was travelled.
+        """
+        deadline = None if timeout is None else clock.monotonic() + timeout
+        while not self.reached():
+            if EMERGENCY_STOP.is_set():
+                return False
+            if deadline is not None and clock.monotonic() >= deadline:
+                return False
+            if self.odometry.is_running():
+                self.odometry.wait_update(self.odometry.period)
+            else:
+                clock.wait(EMERGENCY_STOP, self.odometry.period)
+        return True
+
+
+class Odometry:
+    """
+    Integrates the pose of a differential drive robot from its wheel encoders.
+
+    Call update() whenever a new pose is needed, or start() a daemon thread that updates
+    at rate_hz. Both wheel encoders are read back to back, so the pose stays consistent.
+    """
+
+    def __init__(self, left: Motor, right: Motor, wheel_radius: float, track_radius: float,
+                 rate_hz: float = 50):
+        """
+        Keyword arguments:
+        left, right - The drive wheel motors
+        wheel_radius - Radius of the wheels (RW)
+        track_radius - Half the distance between the wheels (RB)
+        rate_hz - How many times per second the background thread reads the encoders
+        """
+        if rate_hz <= 0:
+            raise ValueError("rate_hz must be a positive value")
+        self.left = left
+        self.right = right
+        self.wheel_radius = wheel_radius
+        self.track_radius = track_radius
+        self.period = 1 / rate_hz
+        self.pose = Pose(0.0, 0.0, 0.0)
+        self.travelled = 0.0  # path length, counting backwards moves as positive
+        self.timestamp = None
+        self._encoders = None
+        self._updated = threading.Condition()
+        self._running = threading.Event()
+        self._thread = None
+
+    def start(self):
+        "Update the pose in a daemon thread."
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._running.set()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._running.clear()
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join()
+
+    def is_running(self) -> bool:
+        return self._running.is_set()
+
+    def _run(self):
+        # Paced on real time, like SensorSampler. Simulations call update() instead.
+        next_time = time.monotonic()
+        while self._running.is_set():
+            self.update()
+            next_time += self.period
+            delay = next_time - time.monotonic()
+            if delay < -self.period:
+                next_time = time.monotonic()
+            elif delay > 0:
+                time.sleep(delay)
+
+    def update(self) -> Pose:
+        """Read both encoders and integrate the movement since the last update.
+
+        >>> from .brick import Brick
+        >>> from .simulator import SimulatedBrickPi3
+        >>> bp = SimulatedBrickPi3()
+        >>> odometry = Odometry(Motor("A", bp=bp), Motor("D", bp=bp), wheel_radius=2, track_radius=5)
+        >>> _ = odometry.update()
+        >>> with Brick(bp).read_snapshot(ports="AD"):
+        ...     bp.offset_motor_encoder(bp.PORT_A, 90)
+        ...     bp.offset_motor_encoder(bp.PORT_D, 90)
+        ...     round(odometry.update().x, 6)  # not the encoders frozen in the snapshot
+        3.141593
+        """
+        # Read the bus directly, like MotionFuture: inside a SensorSnapshot the encoders
+        # would never change
+        try:
+            encoders = (self.left.brick.get_motor_encoder(self.left.port),
+                        self.right.brick.get_motor_encoder(self.right.port))
+        except (IOError, OSError):
+            return self.pose
+        if None in encoders:
+            return self.pose
+        with self._updated:
+            if self._encoders is not None:
+                scale = math.radians(self.wheel_radius)
+                left = (encoders[0] - self._encoders[0]) * scale
+                right = (encoders[1] - self._encoders[1]) * scale
+                self.pose = integrate_pose(self.pose, left, right, self.track_radius)
+                self.travelled += abs(left + right) / 2
+            self._encoders = encoders
+            self.timestamp = clock.monotonic()
+            self._updated.notify_all()
+        return self.pose
+
+    def wait_update(self, timeout: float = None) -> bool:
+        "Wait for the next update of the background thread. Returns False on timeout."
+        with self._updated:
+            return self._updated.wait(timeout)
+
+    def get_pose(self) -> Pose:
+        "Latest pose. Reads the encoders first unless the odometry is running."
+        if not self.is_running():
+            return self.update()
+        return self.pose
+
+    def reset(self, pose: Pose = Pose(0.0, 0.0, 0.0)):
+        """Set the current pose, for example after lining up on a known position. The next
+        update starts from the encoder values it reads, even if they were reset meanwhile."""
+        with self._updated:
+            self.pose = Pose(*pose)
+            self._encoders = None
+
+    def distance_trigger(self, distance: float) -> DistanceTrigger:
+        "Return a trigger that fires after travelling distance from the current position."
+        if not self.is_running():
+            self.update()
+        return DistanceTrigger(self, distance)
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,180 @@
+"""
+Module for building sensor processing pipelines out of small stages, such as
+sensor -> range limit -> median -> mean -> threshold.
+
+Stages are evaluated lazily when pulled with get_value(), and each stage runs at most
+once per tick no matter how many consumers read it. Every stage records how long
+it spends computing, so slow stages are easy to find.
+
+Example:
+
+    pipeline = Pipeline()
+    distance = (pipeline.source("us", ULTRASONIC_SENSOR.get_cm)
+                .range_limit("limit", 0, 255)
+                .window("median", MedianWindow(5))
+                .window("mean", MeanWindow(3)))
+    near_wall = distance.threshold("near", 20, above=False)
+
+    while True:
+        pipeline.tick()
+        if near_wall.get_value():      # runs us -> limit -> median -> mean -> near
+            print(distance.get_value())  # memoized, nothing runs again
+"""
+
+import time
+
+from .filters import AtomicActor, range_limit
+
+
+class StageTiming:
+    """Time spent in one stage: number of runs, total and worst seconds."""
+
+    def __init__(self):
+        self.calls = 0
+        self.total = 0.0
+        self.worst = 0.0
+
+    def add(self, seconds):
+        self.calls += 1
+        self.total += seconds
+        if seconds > self.worst:
+            self.worst = seconds
+
+    def mean(self):
+        return self.total / self.calls if self.calls else 0.0
+
+    def __repr__(self):
+        return f"StageTiming(calls={self.calls}, mean={self.mean() * 1e6:.1f}us, worst={self.worst * 1e6:.1f}us)"
+
+
+class Stage:
+    """A node of a Pipeline. Has a get_value() method, so it can be used anywhere a
+    filter source is expected (SimpleFunctionFilter, RangeLimitFilter, ...).
+
+    The then/range_limit/window/threshold methods add a new stage fed by this one,
+    and return it, so pipelines can be written as a chain.
+    """
+
+    def __init__(self, pipeline, name, func, inputs, skip_none=True):
+        self.pipeline = pipeline
+        self.name = name
+        self.func = func
+        self.inputs = inputs
+        self.skip_none = skip_none
+        self.timing = StageTiming()
+        self.tick = None
+        self.value = None
+
+    def get_value(self):
+        return self.pipeline.pull(self)
+
+    def then(self, name, func):
+        """Adds a stage computing func(value). None values are passed through."""
+        return self.pipeline.add(name, func, [self])
+
+    def range_limit(self, name, lower, upper):
+        return self.then(name, lambda x: range_limit(x, lower, upper))
+
+    def window(self, name, windowed_filter):
+        """Adds a stage that appends each tick's value to windowed_filter (MeanWindow,
+        MedianWindow, ...) and gives its output."""
+        def append(value):
+            windowed_filter.append(value)
+            return windowed_filter.get_value()
+        stage = self.then(name, append)
+        stage.filter = windowed_filter
+        return stage
+
+    def threshold(self, name, level, above=True):
+        """Adds a stage giving True when the value is above (or below) level."""
+        if above:
+            return self.then(name, lambda x: x > level)
+        return self.then(name, lambda x: x < level)
+
+    def __repr__(self):
+        return f"Stage({self.name!r})"
+
+
+class Pipeline(AtomicActor):
+    """A set of stages evaluated lazily, with results memoized for the current tick.
+
+    >>> from .filters import MeanWindow
+    >>> readings = iter([10, 300, 20, 40])
+    >>> p = Pipeline()
+    >>> mean = p.source("us", lambda: next(readings)).range_limit("limit", 0, 255).window("mean", MeanWindow(2))
+    >>> near = mean.threshold("near", 100, above=False)
+    >>> for _ in range(4):
+    ...     p.tick()
+    ...     print(mean.get_value(), near.get_value(), mean.get_value())
+    10.0 True 10.0
+    132.5 False 132.5
+    137.5 False 137.5
+    30.0 True 30.0
+    >>> p.timings()["us"].calls
+    4
+    """
+
+    def __init__(self):
+        super(Pipeline, self).__init__()
+        self.stages = {}
+        self.tick_count = 0
+
+    def add(self, name, func, inputs, skip_none=True):
+        """Adds a stage computing func(*input values). When skip_none is True, the stage
+        gives None without calling func if any input is None."""
+        if name in self.stages:
+            raise ValueError(f"a stage named {name} already exists")
+        stage = Stage(self, name, func, list(inputs), skip_none)
+        self.stages[name] = stage
+        return stage
+
+    def source(self, name, source):
+        """Adds a stage reading a sensor, filter or anything with get_value(), or a
+        function taking no arguments."""
+        if hasattr(source, 'get_value') and callable(getattr(source, 'get_value')):
+            source = source.get_value
+        if not callable(source):
+            raise RuntimeError("source must have a get_value function or be callable")
+        return self.add(name, source, [], skip_none=False)
+
+    def combine(self, name, inputs, func):
+        """Adds a stage computing func(value_1, value_2, ...) from several stages."""
+        return self.add(name, func, inputs)
+
+    def tick(self):
+        """Starts a new tick. Every stage will run again the next time it is pulled."""
+        self.tick_count += 1
+
+    @AtomicActor._atomic
+    def pull(self, stage):
+        """Returns the stage value for the current tick, computing it (and its inputs)
+        only if it has not run yet during this tick."""
+        if stage.tick == self.tick_count:
+            return stage.value
+        values = [self.pull(i) for i in stage.inputs]
+        if stage.skip_none and None in values:
+            value = None
+        else:
+            start = time.perf_counter()
+            value = stage.func(*values)
+            stage.timing.add(time.perf_counter() - start)
+        stage.value = value
+        stage.tick = self.tick_count
+        return value
+
+    def timings(self):
+        """Returns {stage name: StageTiming}."""
+        return {name: stage.timing for name, stage in self.stages.items()}
+
+    def report(self):
+        """Returns a table of per-stage timings, as a string."""
+        lines = [f"{'stage':<16}{'calls':>8}{'mean us':>10}{'worst us':>10}{'total ms':>10}"]
+        for name, t in self.timings().items():
+            lines.append(f"{name:<16}{t.calls:>8}{t.mean() * 1e6:>10.1f}"
+                         f"{t.worst * 1e6:>10.1f}{t.total * 1e3:>10.2f}")
+        return "\n".join(lines)
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,308 @@
+"""
+Module for replaying recorded traces (see utils.trace) through the dummy brick, to
+regression test control logic against real runs.
+
+A ReplayBrick is a dummy.BrickPi3 whose sensor values follow a recorded trace, on a
+clock.ReplayClock. replay() runs a control function (such as run_state) at a fixed rate
+against it, collects the marks it makes (such as state transitions), and compares them
+with the marks of the original run.
+
+Example:
+
+    bp = ReplayBrick()
+    restore_default_brick(bp)  # before the robot code creates its sensors and motors
+    import main
+
+    def reset_robot():
+        "Put the module-level state of main back to how it is after import."
+        main.current_state = main.State.FOLLOWING_LINE
+        main.previous_state = None
+        main.emergency_stopped = False
+        main.packages_delivered = 0
+        main.wall_target_distance = None
+        main.enter_room_started = False
+        main.COLOR_DEBOUNCER.clear()
+        main.WALL_FILTER.clear()
+        main.ODOMETRY.reset()
+
+    results = []
+    for path in glob.glob("runs/*.trace"):
+        bp.load(path)
+        reset_robot()
+        results.append(replay(main.run_state, bp, rate_hz=main.CONTROL_RATE_HZ))
+    print(regression_report(results))
+"""
+
+from __future__ import annotations
+
+from bisect import bisect_right
+from difflib import SequenceMatcher
+from typing import NamedTuple
+import os
+
+from . import brick, clock
+from .clock import ReplayClock, SimulatedClock
+from .dummy import BrickPi3, _MotorBank
+from .scheduler import Scheduler
+from .trace import Trace, read_trace
+
+# Margin added to the replay time when looking up samples, so that a sample recorded
+# at the same virtual time as a tick is not missed because of rounding
+_TIME_EPSILON = 1e-9
+
+
+class ReplayBrick(BrickPi3):
+    """
+    dummy.BrickPi3 whose sensor values come from a recorded trace.
+
+    Whenever its clock advances, each port gets the latest value recorded for the
+    sensor type it is configured as, through set_sensor, so the Brick and Sensor
+    objects made from it read the recorded values. The motors are fake motors stepped
+    on the same clock: they follow the commands of the code being replayed, not the
+    recorded ones.
+
+    Keyword arguments:
+    trace - Trace, or path of a trace file, to replay (see load)
+    speed - 1 to replay with the original timing, None to go as fast as possible
+    clock - The SimulatedClock to follow, a new ReplayClock by default
+    """
+
+    def __init__(self, trace: Trace | str = None, speed: float | None = None,
+                 clock: SimulatedClock = None):
+        super(ReplayBrick, self).__init__()
+        self.clock = ReplayClock(speed=speed) if clock is None else clock
+        self.clock.add_listener(self._advance)
+        self.trace = None
+        self.start = self.clock.monotonic()
+        self._streams = {}
+        if trace is not None:
+            self.load(trace)
+
+    def _create_motors(self):
+        self.motor_bank = _MotorBank()
+        return self.motor_bank.motors
+
+    def load(self, trace: Trace | str):
+        """
+        Start replaying trace from its beginning, with the motors stopped at 0 degrees.
+        Raises ValueError if a sensor channel does not say which sensor type recorded it
+        (traces before version 2).
+
+        >>> from .trace import ChannelInfo, Trace, TraceEvent
+        >>> old = ChannelInfo(0, "3.cm", "sensor", "3", "float", 1, 'd')
+        >>> ReplayBrick(Trace([old], [TraceEvent(0.0, old, 50.0)], [], version=1))
+        Traceback (most recent call last):
+        ValueError: sensor channel 3.cm of the trace has no sensor type (version 1 trace), it cannot be replayed
+        """
+        trace = read_trace(trace) if isinstance(trace, str) else trace
+        for info in trace.channels:
+            if info.kind == "sensor" and info.sensor_type is None:
+                raise ValueError(f"sensor channel {info.name} of {trace.path or 'the trace'} has no sensor "
+                                 f"type (version {trace.version} trace), it cannot be replayed")
+        self.trace = trace
+        self._streams = {}  # (port index, sensor type) -> ([times], [values])
+        for event in self.trace.events:
+            info = event.channel
+            if info.kind != "sensor":
+                continue
+            index = brick.SENSOR_PORT_NAMES.index(info.port)
+            times, values = self._streams.setdefault((index, info.sensor_type), ([], []))
+            times.append(event.time)
+            values.append(event.value)
+        for motor in self.Motors:
+            motor.stop()
+            motor.set_position(0)
+        # Motor objects still remember the commands of the previous run
+        brick.Motor._cache_epoch += 1
+        self.start = self.clock.monotonic()
+        self._update_sensors(0.0)
+
+    def time(self) -> float:
+        "Seconds since the start of the replayed trace."
+        return self.clock.monotonic() - self.start
+
+    def duration(self) -> float:
+        return self.trace.duration() if self.trace is not None else 0.0
+
+    def finished(self) -> bool:
+        "True once the replay went past the last recorded sample."
+        return self.time() > self.duration() + _TIME_EPSILON
+
+    def _advance(self, seconds: float):
+        "Clock listener: move the motors, then show the sensor values at the new time."
+        self.motor_bank.step(seconds)
+        self._update_sensors(self.time() + seconds)
+
+    def _update_sensors(self, t: float):
+        for i, sensor_type in enumerate(self.SensorType):
+            stream = self._streams.get((i, sensor_type))
+            if stream is None:
+                continue
+            times, values = stream
+            # Before its first sample, a sensor reads its first recorded value
+            k = max(bisect_right(times, t + _TIME_EPSILON) - 1, 0)
+            self.set_sensor(1 << i, values[k])
+
+
+class Transition(NamedTuple):
+    "A mark, such as a change of state, and when it happened (seconds since the start)."
+    time: float
+    name: str
+    value: object
+
+
+class _TransitionLog:
+    "Stands in for a TraceRecorder during a replay, to collect the marks."
+
+    def __init__(self, bp: ReplayBrick):
+        self.bp = bp
+        self.transitions = []
+        self._last_marks = {}
+
+    def record_sensor(self, sensor, value):
+        pass
+
+    def record_command(self, port: int, command: str, args: tuple):
+        pass
+
+    def mark(self, name: str, value=None, changes_only: bool = False):
+        if changes_only:
+            if self._last_marks.get(name, self) == value:
+                return
+            self._last_marks[name] = value
+        self.transitions.append(Transition(self.bp.time(), name, value))
+
+
+class ReplayResult:
+    """
+    Marks of the original run (expected) and of the replay (actual). The replay
+    matches when both have the same marks in the same order, each one within
+    tolerance seconds of the original.
+    """
+
+    def __init__(self, name: str, expected: list[Transition], actual: list[Transition],
+                 tolerance: float):
+        self.name = name
+        self.expected = expected
+        self.actual = actual
+        self.tolerance = tolerance
+
+    def diff(self) -> list[tuple[str, Transition | None, Transition | None]]:
+        """
+        Align the expected and actual marks. Returns [(tag, expected, actual), ...]
+        where tag is "=" (same mark, in time), "~" (same mark, moved by more than
+        tolerance), "-" (only in the original run) or "+" (only in the replay).
+        """
+        matcher = SequenceMatcher(a=[(t.name, t.value) for t in self.expected],
+                                  b=[(t.name, t.value) for t in self.actual], autojunk=False)
+        rows = []
+        for op, i1, i2, j1, j2 in matcher.get_opcodes():
+            if op == "equal":
+                for old, new in zip(self.expected[i1:i2], self.actual[j1:j2]):
+                    rows.append(("=" if abs(new.time - old.time) <= self.tolerance else "~", old, new))
+                continue
+            rows += [("-", old, None) for old in self.expected[i1:i2]]
+            rows += [("+", None, new) for new in self.actual[j1:j2]]
+        return rows
+
+    @property
+    def differences(self) -> int:
+        return sum(tag != "=" for tag, _, _ in self.diff())
+
+    @property
+    def matches(self) -> bool:
+        return self.differences == 0
+
+    def report(self) -> str:
+        "A line per mark, flagged with its diff() tag."
+        lines = [f"{self.name}: {len(self.expected)} marks recorded, {len(self.actual)} replayed, "
+                 f"{self.differences} differences"]
+        for tag, old, new in self.diff():
+            mark = old or new
+            line = f"  {tag} {mark.time:8.3f}s  {mark.name} {mark.value}"
+            if tag == "~":
+                line += f" (replayed at {new.time:.3f}s, {new.time - old.time:+.3f}s)"
+            lines.append(line)
+        return "\n".join(lines)
+
+    def __repr__(self):
+        return f"ReplayResult({self.name!r}, matches={self.matches})"
+
+
+def replay(tick, bp: ReplayBrick = None, rate_hz: float = 20, marks: list[str] = None,
+           tolerance: float = 0.5, until=None) -> ReplayResult:
+    """
+    Call tick rate_hz times per second of replay time until the trace of bp is over
+    (or until() returns True), and compare the marks it makes with the recorded ones.
+
+    Keyword arguments:
+    tick - The control function to test, such as run_state
+    bp - The ReplayBrick, brick.BP by default
+    marks - Names of the marks to compare, every recorded and replayed mark by default
+    tolerance - Seconds a mark may move from its recorded time and still match
+
+    >>> import os, tempfile
+    >>> from .brick import EV3UltrasonicSensor
+    >>> from .trace import TraceRecorder, mark
+    >>> path = os.path.join(tempfile.mkdtemp(), "wall.trace")
+    >>> us = EV3UltrasonicSensor(3)
+    >>> clock.set_clock(SimulatedClock())
+    >>> with TraceRecorder(path):
+    ...     for distance in [50, 40, 30, 20, 10, 20, 30, 40]:
+    ...         us.brick.set_sensor(us.port, distance)
+    ...         mark("state", "NEAR" if us.get_cm() < 25 else "FAR", changes_only=True)
+    ...         clock.sleep(0.1)
+    >>> clock.set_clock()
+    >>> bp = ReplayBrick(path)
+    >>> us = EV3UltrasonicSensor(3, bp=bp)
+    >>> replay(lambda: mark("state", "NEAR" if us.get_cm() < 25 else "FAR", changes_only=True), bp,
+    ...        rate_hz=10, tolerance=0.05).matches
+    True
+    >>> bp.load(path)
+    >>> result = replay(lambda: mark("state", "NEAR" if us.get_cm() < 35 else "FAR", changes_only=True),
+    ...                 bp, rate_hz=10, tolerance=0.05)
+    >>> print(result.report())
+    wall.trace: 3 marks recorded, 3 replayed, 2 differences
+      =    0.000s  state FAR
+      ~    0.300s  state NEAR (replayed at 0.200s, -0.100s)
+      ~    0.600s  state FAR (replayed at 0.700s, +0.100s)
+    """
+    if bp is None:
+        bp = brick.BP
+    log = _TransitionLog(bp)
+    previous_clock, previous_recorder = clock.get_clock(), brick._TRACE_RECORDER
+    clock.set_clock(bp.clock)
+    brick.set_trace_recorder(log)
+    try:
+        scheduler = Scheduler()
+        scheduler.add("tick", tick, rate_hz=rate_hz)
+        scheduler.run(until=lambda: bp.finished() or (until is not None and until()))
+    finally:
+        brick.set_trace_recorder(previous_recorder)
+        clock.set_clock(previous_clock)
+
+    expected = [Transition(event.time, event.channel.name[len("mark."):], event.value)
+                for event in bp.trace.events if event.channel.kind == "mark"]
+    if marks is not None:
+        expected = [t for t in expected if t.name in marks]
+        log.transitions = [t for t in log.transitions if t.name in marks]
+    name = os.path.basename(bp.trace.path) if bp.trace.path else "trace"
+    return ReplayResult(name, expected, log.transitions, tolerance)
+
+
+def regression_report(results: list[ReplayResult], verbose: bool = False) -> str:
+    "One line per replayed run, with the diff of the runs that do not match (or all, if verbose)."
+    lines = []
+    for result in results:
+        if result.matches and not verbose:
+            lines.append(f"PASS {result.name} ({len(result.expected)} marks)")
+        else:
+            lines.append(("PASS " if result.matches else "FAIL ") + result.report())
+    passed = sum(result.matches for result in results)
+    lines.append(f"{passed}/{len(results)} runs match")
+    return "\n".join(lines)
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
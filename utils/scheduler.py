@@ -0,0 +1,227 @@
+"""
+Module for running periodic tasks at fixed rates, instead of pacing loops with sleep().
+
+Deadlines are taken from the monotonic time of utils.clock and advance by exactly one
+period each run, so the time spent inside a task does not add up into drift. When a task runs longer
+than its period, the missed deadlines are skipped and counted as an overrun.
+
+Example:
+
+    scheduler = Scheduler()
+    scheduler.add("follow line", follow_line, rate_hz=20)
+    scheduler.add("telemetry", print_status, rate_hz=1)
+    scheduler.run(until=lambda: emergency_stopped)
+    print(scheduler.report())
+"""
+
+import math
+import threading
+
+from . import clock
+
+# Upper edges of the period jitter histogram bins, in milliseconds. The last bin
+# counts everything above the last edge.
+JITTER_BINS_MS = (0.5, 1, 2, 5, 10, 20, 50, 100)
+
+# Measured period of the task running on each thread, see task_dt
+_local = threading.local()
+
+
+def task_dt():
+    """Seconds between the start of the previous run and the start of the current run of
+    the task calling it, as measured by its Scheduler. None outside of a task, and on the
+    first run of a task.
+
+    >>> now = [0.0]
+    >>> s = Scheduler(time_func=lambda: now[0])
+    >>> dts = []
+    >>> _ = s.add("tick", lambda: dts.append(task_dt()), rate_hz=10)
+    >>> for _ in range(3):
+    ...     now[0] += s.run_pending() + 0.01  # woken up 10 ms late
+    >>> [dt if dt is None else round(dt, 6) for dt in dts], task_dt()
+    ([None, 0.11, 0.1], None)
+    """
+    return getattr(_local, "dt", None)
+
+
+class TaskStats:
+    """Run statistics of one task.
+
+    runs - number of times the task ran
+    overruns - number of runs that finished after the next deadline
+    skipped - number of deadlines dropped because of overruns
+    jitter_histogram - counts of |actual period - nominal period|, binned by JITTER_BINS_MS
+    """
+
+    def __init__(self):
+        self.runs = 0
+        self.overruns = 0
+        self.skipped = 0
+        self.total_runtime = 0.0
+        self.worst_runtime = 0.0
+        self.worst_lateness = 0.0
+        self.total_period = 0.0
+        self.periods = 0
+        self.jitter_histogram = [0] * (len(JITTER_BINS_MS) + 1)
+
+    def add_run(self, runtime, lateness):
+        self.runs += 1
+        self.total_runtime += runtime
+        if runtime > self.worst_runtime:
+            self.worst_runtime = runtime
+        if lateness > self.worst_lateness:
+            self.worst_lateness = lateness
+
+    def add_period(self, period, nominal):
+        self.periods += 1
+        self.total_period += period
+        jitter_ms = abs(period - nominal) * 1000
+        for i, edge in enumerate(JITTER_BINS_MS):
+            if jitter_ms <= edge:
+                self.jitter_histogram[i] += 1
+                return
+        self.jitter_histogram[-1] += 1
+
+    def mean_runtime(self):
+        return self.total_runtime / self.runs if self.runs else 0.0
+
+    def mean_period(self):
+        return self.total_period / self.periods if self.periods else 0.0
+
+    def histogram(self):
+        """Returns [(bin label, count), ...] for the period jitter histogram."""
+        labels = [f"<={edge}ms" for edge in JITTER_BINS_MS] + [f">{JITTER_BINS_MS[-1]}ms"]
+        return list(zip(labels, self.jitter_histogram))
+
+    def __repr__(self):
+        return (f"TaskStats(runs={self.runs}, overruns={self.overruns}, skipped={self.skipped}, "
+                f"mean_period={self.mean_period() * 1000:.1f}ms)")
+
+
+class Task:
+    """A function called every period seconds by a Scheduler."""
+
+    def __init__(self, name, func, rate_hz):
+        if rate_hz <= 0:
+            raise ValueError("rate_hz must be positive")
+        self.name = name
+        self.func = func
+        self.rate_hz = rate_hz
+        self.period = 1 / rate_hz
+        self.deadline = None
+        self.last_start = None
+        self.stats = TaskStats()
+
+    def __repr__(self):
+        return f"Task({self.name!r}, rate_hz={self.rate_hz})"
+
+
+class Scheduler:
+    """Runs registered tasks at their declared rates, from a single thread.
+
+    Tasks run in deadline order and never preempt each other, so a task that blocks
+    delays the others; that shows up as overruns in their stats.
+
+    >>> now = [0.0]
+    >>> s = Scheduler(time_func=lambda: now[0])
+    >>> fast = s.add("fast", lambda: None, rate_hz=10)
+    >>> slow = s.add("slow", lambda: now.__setitem__(0, now[0] + 0.25), rate_hz=2)
+    >>> for _ in range(6):
+    ...     delay = s.run_pending()
+    ...     now[0] += delay
+    >>> fast.stats.runs, fast.stats.overruns, fast.stats.skipped
+    (6, 2, 2)
+    >>> slow.stats.runs, slow.stats.overruns
+    (2, 0)
+    """
+
+    def __init__(self, time_func=None):
+        # clock.monotonic follows the current clock, so a simulation can drive the scheduler
+        self.time_func = clock.monotonic if time_func is None else time_func
+        self.tasks = {}
+        self._stop = threading.Event()
+
+    def add(self, name, func, rate_hz):
+        """Registers func to be called rate_hz times per second, and returns its Task.
+        The first run is due immediately."""
+        if name in self.tasks:
+            raise ValueError(f"a task named {name} already exists")
+        task = Task(name, func, rate_hz)
+        self.tasks[name] = task
+        return task
+
+    def remove(self, name):
+        del self.tasks[name]
+
+    def run_pending(self):
+        """Runs every task whose deadline has passed, earliest deadline first.
+        Returns the number of seconds until the next deadline."""
+        now = self.time_func()
+        for task in sorted(self.tasks.values(), key=lambda t: now if t.deadline is None else t.deadline):
+            if task.deadline is None:
+                task.deadline = now
+            if task.deadline > now:
+                continue
+            self._run(task, now)
+            now = self.time_func()
+        if not self.tasks:
+            return 0.0
+        return max(0.0, min(t.deadline for t in self.tasks.values()) - now)
+
+    def _run(self, task, now):
+        stats = task.stats
+        dt = None if task.last_start is None else now - task.last_start
+        if dt is not None:
+            stats.add_period(dt, task.period)
+        task.last_start = now
+        previous, _local.dt = task_dt(), dt
+        try:
+            task.func()
+        finally:
+            _local.dt = previous
+        end = self.time_func()
+        stats.add_run(end - now, now - task.deadline)
+
+        # Advance on the fixed grid of deadlines so that runtime does not cause drift
+        task.deadline += task.period
+        if end > task.deadline:
+            missed = math.floor((end - task.deadline) / task.period) + 1
+            stats.overruns += 1
+            stats.skipped += missed
+            task.deadline += missed * task.period
+
+    def run(self, until=None):
+        """Runs tasks until stop() is called, or until the until() function returns True
+        (checked before each round of tasks)."""
+        self._stop.clear()
+        while not self._stop.is_set():
+            if until is not None and until():
+                break
+            delay = self.run_pending()
+            if delay > 0:
+                clock.wait(self._stop, delay)
+
+    def stop(self):
+        """Makes run() return. Safe to call from any thread or from inside a task."""
+        self._stop.set()
+
+    def stats(self):
+        """Returns {task name: TaskStats}."""
+        return {name: task.stats for name, task in self.tasks.items()}
+
+    def report(self):
+        """Returns a table of per-task rates, overruns and jitter histograms, as a string."""
+        lines = [f"{'task':<16}{'rate Hz':>8}{'runs':>8}{'overruns':>9}{'skipped':>8}"
+                 f"{'period ms':>10}{'mean us':>10}{'worst us':>10}"]
+        for name, task in self.tasks.items():
+            s = task.stats
+            lines.append(f"{name:<16}{task.rate_hz:>8g}{s.runs:>8}{s.overruns:>9}{s.skipped:>8}"
+                         f"{s.mean_period() * 1000:>10.1f}{s.mean_runtime() * 1e6:>10.1f}"
+                         f"{s.worst_runtime * 1e6:>10.1f}")
+            lines.append("    jitter " + " ".join(f"{label}:{count}" for label, count in s.histogram() if count))
+        return "\n".join(lines)
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,265 @@
+"""
+Deterministic, single-threaded simulator for the dummy BrickPi3.
+
+A Simulator owns a SimulatedBrickPi3 (a dummy.BrickPi3 whose motors it steps itself),
+a WorldMap made of colored floor tiles and walls, and a clock.SimulatedClock. Time only
+moves when that clock advances, for example through Simulator.sleep(): the motors advance
+in small fixed steps, the robot pose follows the differential drive kinematics, and then
+the color and ultrasonic sensor values are computed from the new pose. A run gives the
+same readings every time, and goes as fast as the CPU allows.
+
+Coordinates are in cm, with x to the right and y downwards like a drawing of the map,
+so a growing heading turns the robot right, like turn() in the robot code.
+Walls only reflect the ultrasonic sensor, the robot drives through them.
+
+Example:
+
+    world = WorldMap(120, 120)
+    world.paint(0, 50, 120, 5, "black")
+    sim = Simulator(world, x=10, y=45, ultrasonic_angle=-math.pi / 2)
+    restore_default_brick(sim.bp)   # Motor and Sensor objects created after this use it
+    clock.set_clock(sim.clock)      # sleeping in the robot code now steps the simulation
+    ...
+    while sim.time() < 60:
+        follow_line()
+        clock.sleep(0.05)
+"""
+
+from __future__ import annotations
+
+import math
+import random
+
+from .clock import SimulatedClock
+from .dummy import BrickPi3, _MotorBank
+from .odometry import Pose, integrate_pose
+
+# Color name -> (color code of the EV3 color sensor, RGB components)
+TILE_COLORS = {
+    "black": (1, (8.53, 9.47, 3.47)),
+    "blue": (2, (22.0, 48.0, 64.0)),
+    "green": (3, (125.60, 177.80, 14.93)),
+    "yellow": (4, (277.53, 237.00, 22.20)),
+    "red": (5, (161.33, 17.47, 7.93)),
+    "white": (6, (250.00, 242.40, 108.80)),
+    "orange": (7, (214.40, 75.67, 13.60)),
+}
+_NO_TILE = (0, (0.0, 0.0, 0.0))
+ULTRASONIC_MAX = 255.0
+
+
+class SimulatedBrickPi3(BrickPi3):
+    """dummy.BrickPi3 whose motor bank is not registered with the motor engine, so the
+    motors only move when a Simulator steps them."""
+
+    def _create_motors(self):
+        self.motor_bank = _MotorBank()
+        return self.motor_bank.motors
+
+
+class WorldMap:
+    """
+    A rectangular floor of square colored tiles, with walls as line segments.
+
+    >>> world = WorldMap(100, 50, cell_size=10)
+    >>> world.paint(20, 0, 10, 50, "black")
+    >>> world.color_at(25, 10), world.color_at(5, 5), world.color_at(-1, 5)
+    ('black', 'white', None)
+    >>> world.raycast(10, 25, 0)  # towards the right border
+    90.0
+    >>> world.raycast(10, 25, math.pi / 2)  # downwards
+    25.0
+    """
+
+    def __init__(self, width: float, height: float, cell_size: float = 5, floor: str = "white",
+                 border: bool = True):
+        self.width = width
+        self.height = height
+        self.cell_size = cell_size
+        self.columns = math.ceil(width / cell_size)
+        self.rows = math.ceil(height / cell_size)
+        self.tiles = [[floor] * self.columns for _ in range(self.rows)]
+        self.walls: list[tuple[float, float, float, float]] = []
+        if border:
+            self.add_wall(0, 0, width, 0)
+            self.add_wall(width, 0, width, height)
+            self.add_wall(width, height, 0, height)
+            self.add_wall(0, height, 0, 0)
+
+    def paint(self, x: float, y: float, width: float, height: float, color: str):
+        "Set the color of every tile whose center is inside the rectangle."
+        if color not in TILE_COLORS:
+            raise ValueError(f"unknown tile color {color}")
+        for row in range(self.rows):
+            cy = (row + 0.5) * self.cell_size
+            if not y <= cy < y + height:
+                continue
+            for column in range(self.columns):
+                cx = (column + 0.5) * self.cell_size
+                if x <= cx < x + width:
+                    self.tiles[row][column] = color
+
+    def add_wall(self, x1: float, y1: float, x2: float, y2: float):
+        self.walls.append((x1, y1, x2, y2))
+
+    def color_at(self, x: float, y: float) -> str | None:
+        "Color of the tile under (x, y), or None outside the map."
+        if not (0 <= x < self.width and 0 <= y < self.height):
+            return None
+        return self.tiles[int(y // self.cell_size)][int(x // self.cell_size)]
+
+    def raycast(self, x: float, y: float, angle: float, max_range: float = ULTRASONIC_MAX) -> float:
+        "Distance from (x, y) to the nearest wall in the direction angle, at most max_range."
+        dx, dy = math.cos(angle), math.sin(angle)
+        nearest = max_range
+        for x1, y1, x2, y2 in self.walls:
+            ex, ey = x2 - x1, y2 - y1
+            denom = dx * ey - dy * ex
+            if denom == 0:
+                continue
+            t = ((x1 - x) * ey - (y1 - y) * ex) / denom
+            u = ((x1 - x) * dy - (y1 - y) * dx) / denom
+            if 0 <= t < nearest and 0 <= u <= 1:
+                nearest = t
+        return nearest
+
+
+class Simulator:
+    """
+    Steps a differential drive robot through a WorldMap, on virtual time.
+
+    The sensor values of the SimulatedBrickPi3 (bp) are updated after every advance:
+    color tile under the color sensor, distance to the nearest wall in front of the
+    ultrasonic sensor (the smallest of a few rays across its beam). The touch sensor
+    is left to set_touch.
+
+    >>> world = WorldMap(100, 100)
+    >>> sim = Simulator(world, x=20, y=50)
+    >>> bp = sim.bp
+    >>> bp.set_sensor_type(bp.PORT_3, bp.SENSOR_TYPE.EV3_ULTRASONIC_CM)
+    >>> bp.set_motor_dps(bp.PORT_A + bp.PORT_D, 180)
+    >>> sim.sleep(1)
+    >>> round(sim.x, 3), round(sim.y, 3), round(sim.time(), 3)
+    (26.283, 50.0, 1.0)
+    >>> round(bp.get_sensor(bp.PORT_3), 1)
+    73.7
+    """
+
+    def __init__(self, world: WorldMap, x: float = 0.0, y: float = 0.0, theta: float = 0.0,
+                 wheel_radius: float = 2, track_radius: float = 5,
+                 left_port: str = "A", right_port: str = "D",
+                 color_offset: tuple[float, float] = (0, 0),
+                 ultrasonic_offset: tuple[float, float] = (0, 0), ultrasonic_angle: float = 0.0,
+                 ultrasonic_beam: float = math.radians(20), ultrasonic_noise: float = 0.0,
+                 step: float = 0.002, seed: int = 0, clock: SimulatedClock = None):
+        """
+        Keyword arguments:
+        world - The map to drive in
+        x, y, theta - Starting pose of the robot, theta in radians (0 faces along x)
+        wheel_radius, track_radius - Robot geometry in cm (RW and RB)
+        left_port, right_port - Motor ports of the wheels
+        color_offset, ultrasonic_offset - (forward, right) position of the sensors on the robot
+        ultrasonic_angle - Direction of the ultrasonic sensor, relative to the robot heading
+        ultrasonic_beam - Width of the ultrasonic beam, in radians
+        ultrasonic_noise - Standard deviation of the ultrasonic readings, in cm
+        step - Length of one simulation step, in seconds
+        seed - Seed of the sensor noise
+        clock - The SimulatedClock to follow, a new one by default
+        """
+        self.world = world
+        self.bp = SimulatedBrickPi3()
+        self.x, self.y, self.theta = x, y, theta
+        self.wheel_radius = wheel_radius
+        self.track_radius = track_radius
+        self.left = self.bp.Motors["ABCD".index(left_port.upper())]
+        self.right = self.bp.Motors["ABCD".index(right_port.upper())]
+        self.color_offset = color_offset
+        self.ultrasonic_offset = ultrasonic_offset
+        self.ultrasonic_angle = ultrasonic_angle
+        self.ultrasonic_beam = ultrasonic_beam
+        self.ultrasonic_noise = ultrasonic_noise
+        self.step_length = step
+        self.random = random.Random(seed)
+        self.clock = SimulatedClock() if clock is None else clock
+        self.start = self.clock.monotonic()
+        self.steps = 0
+        self.clock.add_listener(self._run)
+        self._update_sensors()
+
+    def time(self) -> float:
+        "Virtual seconds since the start of the simulation."
+        return self.clock.monotonic() - self.start
+
+    def sleep(self, seconds: float):
+        "Advance the simulation by seconds of virtual time."
+        self.clock.advance(seconds)
+
+    def advance(self, seconds: float):
+        "Advance the clock, which steps the simulation through _run."
+        self.clock.advance(seconds)
+
+    def _run(self, seconds: float):
+        "Clock listener: step the motors and the robot for seconds, then update the sensors."
+        remaining = seconds
+        while remaining > 1e-12:
+            dt = min(self.step_length, remaining)
+            self.step(dt)
+            remaining -= dt
+        self._update_sensors()
+
+    def step(self, dt: float):
+        "Advance every motor, and the robot pose, by dt seconds."
+        position = self.bp.motor_bank.position
+        l, r = self.left.index, self.right.index
+        left_before, right_before = position[l], position[r]
+        self.bp.motor_bank.step(dt)
+        scale = math.radians(self.wheel_radius)
+        left = (position[l] - left_before) * scale
+        right = (position[r] - right_before) * scale
+        if left or right:
+            self.x, self.y, self.theta = integrate_pose(Pose(self.x, self.y, self.theta), left, right,
+                                                        self.track_radius)
+        self.steps += 1
+
+    def _mount(self, offset: tuple[float, float]) -> tuple[float, float]:
+        "World position of a point at (forward, right) on the robot."
+        forward, right = offset
+        cos, sin = math.cos(self.theta), math.sin(self.theta)
+        return self.x + forward * cos - right * sin, self.y + forward * sin + right * cos
+
+    def get_color(self) -> str | None:
+        "Name of the tile under the color sensor, None outside the map."
+        return self.world.color_at(*self._mount(self.color_offset))
+
+    def get_distance(self) -> float:
+        "Ultrasonic distance in cm, from the rays across the beam."
+        x, y = self._mount(self.ultrasonic_offset)
+        angle = self.theta + self.ultrasonic_angle
+        half = self.ultrasonic_beam / 2
+        distance = min(self.world.raycast(x, y, angle + a) for a in (-half, -half / 2, 0, half / 2, half))
+        if self.ultrasonic_noise and distance < ULTRASONIC_MAX:
+            distance = max(0.0, distance + self.random.gauss(0, self.ultrasonic_noise))
+        return round(min(distance, ULTRASONIC_MAX), 1)
+
+    def set_touch(self, pressed: bool):
+        self.bp._internal_data[BrickPi3.SENSOR_TYPE.TOUCH] = 1 if pressed else 0
+
+    def _update_sensors(self):
+        data = self.bp._internal_data
+        types = BrickPi3.SENSOR_TYPE
+        code, (r, g, b) = TILE_COLORS.get(self.get_color(), _NO_TILE)
+        data[types.EV3_COLOR_COLOR] = code
+        data[types.EV3_COLOR_COLOR_COMPONENTS] = (r, g, b, 0)
+        data[types.EV3_COLOR_REFLECTED] = min(100, round(r / 3))
+        distance = self.get_distance()
+        data[types.EV3_ULTRASONIC_CM] = distance
+        data[types.EV3_ULTRASONIC_INCHES] = round(distance / 2.54, 1)
+
+    def __repr__(self):
+        return (f"Simulator(t={self.time():.3f}s, x={self.x:.1f}, y={self.y:.1f}, "
+                f"theta={math.degrees(self.theta):.1f}deg, color={self.get_color()})")
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,441 @@
+"""
+Module for recording what the robot saw and did during a run, into a compact binary
+trace file that can be read back (or replayed) later.
+
+While a TraceRecorder is running, every value returned by Sensor.get_value, every
+motor command written by a Brick, and every mark() is timestamped with the current
+clock and appended to an in-memory column. A daemon thread writes the columns to the
+file in blocks, so the control loop never waits on the disk.
+
+File format (little-endian chunks, the file is only ever appended to):
+
+    b"BPTR" + version (u16)
+    chunk header: kind (1 byte), channel id (u16), payload length (u32)
+        H - session header, JSON: start time, epoch, byte order of the columns
+        C - channel declaration, JSON: name, kind, port, type, width, typecode and,
+            for sensors, sensor_type
+        S - string of the string table: id (u32) + UTF-8 text, for string values
+        D - block of samples of one channel: count (u32), count timestamps ('d'),
+            count * width values (the channel typecode)
+
+Each channel holds values of a single shape (for example 4 numbers for the color
+sensor in "component" mode), so every record of a block has the same width. A sensor
+whose values change shape gets one channel per shape, under the same name. Numbers
+in lists and tuples are stored as doubles, and read back as int when they are whole.
+
+Example:
+
+    with TraceRecorder("runs/run1.trace"):
+        state_machine()
+
+    trace = read_trace("runs/run1.trace")
+    for t, value in trace.samples("4.id"):
+        print(t, value)
+"""
+
+from __future__ import annotations
+
+from array import array
+from typing import NamedTuple
+import json
+import math
+import struct
+import sys
+import threading
+
+from . import brick, clock
+
+MAGIC = b"BPTR"
+# 2: sensor channels declare their sensor_type
+VERSION = 2
+_VERSION = struct.Struct("<H")
+_CHUNK = struct.Struct("<cHI")
+_COUNT = struct.Struct("<I")
+_INT_NONE = -2 ** 63  # None in the 'q' columns
+
+# Python type of a value -> name stored in the channel declaration
+_TYPE_NAMES = {bool: "bool", int: "int", float: "float", str: "str", list: "list", tuple: "tuple"}
+# Scalar types stored as 64-bit integers, the others are stored as doubles
+_INT_TYPES = ("bool", "int", "str")
+
+
+class ChannelInfo(NamedTuple):
+    """
+    Declaration of a channel.
+
+    id - Index of the channel in Trace.channels
+    name - "<port>.<mode>" for sensors ("3.cm"), "<ports>.<command>" for motor
+        commands ("AD.set_motor_dps"), and "mark.<name>" for marks
+    kind - "sensor", "command" or "mark"
+    port - Port name(s) of the sensor or motors, None for marks
+    type - Python type of the values: bool, int, float, str, list or tuple
+    width - Numbers per value (length of lists and tuples, 1 for other types)
+    typecode - array typecode of the values column: 'q' for bool, int and str (an
+        index in the string table), 'd' otherwise
+    sensor_type - BrickPi3.SENSOR_TYPE the sensor was configured as, for sensors
+    """
+    id: int
+    name: str
+    kind: str
+    port: str | None
+    type: str
+    width: int
+    typecode: str
+    sensor_type: int | None = None
+
+
+class _Channel:
+    "A channel being recorded: its declaration and the samples not written yet."
+
+    def __init__(self, info: ChannelInfo, pytype: type):
+        self.info = info
+        self.pytype = pytype
+        self.sequence = info.type in ("list", "tuple")
+        self.times = array('d')
+        self.values = array(info.typecode)
+
+    def fits(self, value) -> bool:
+        if value is None:
+            return True
+        if type(value) is not self.pytype:
+            return False
+        return not self.sequence or len(value) == self.info.width
+
+
+def _port_names(port: int) -> str:
+    "Name of a (possibly combined) motor port code, such as 'AD' for PORT_A + PORT_D."
+    return "".join(name for name in brick.MOTOR_PORT_NAMES if port & brick.PORTS[name]) or str(port)
+
+
+class TraceRecorder:
+    """
+    Records sensor values, motor commands and marks into a trace file, from the moment
+    it is started until it is stopped. Use it as a context manager, or call start() and
+    stop(). Only one recorder can be active at a time.
+
+    >>> import os, tempfile
+    >>> path = os.path.join(tempfile.mkdtemp(), "test.trace")
+    >>> sim = clock.SimulatedClock()
+    >>> clock.set_clock(sim)
+    >>> with TraceRecorder(path) as recorder:
+    ...     recorder.record("3.cm", "sensor", "3", 25.5)
+    ...     sim.sleep(0.5)
+    ...     recorder.record("3.cm", "sensor", "3", None)
+    ...     recorder.record("4.component", "sensor", "4", [10, 20, 30, 0])
+    ...     recorder.record("4.component", "sensor", "4", [12, None, 31, 0])
+    ...     mark("state", "FOLLOWING_LINE")
+    >>> clock.set_clock()
+    >>> trace = read_trace(path)
+    >>> trace.samples("3.cm")
+    [(0.0, 25.5), (0.5, None)]
+    >>> trace.samples("4.component"), trace.samples("mark.state")
+    ([(0.5, [10, 20, 30, 0]), (0.5, [12, None, 31, 0])], [(0.5, 'FOLLOWING_LINE')])
+    """
+
+    def __init__(self, path: str, append: bool = False, flush_interval: float = 0.5,
+                 block_size: int = 4096):
+        """
+        Keyword arguments:
+        path - The trace file
+        append - Add a new session to the end of the file, instead of replacing it
+        flush_interval - Seconds between two writes of the recorded samples to the file
+        block_size - Number of samples of a channel after which it is written out early
+        """
+        self.path = path
+        self.append = append
+        self.flush_interval = flush_interval
+        self.block_size = block_size
+        self.samples = 0
+        self._channels = []
+        self._current = {}  # name -> channel receiving the values of that name
+        self._names = {}  # (port, mode or command) -> (channel name, port name)
+        self._sensor_types = {}  # sensor channel name -> sensor type
+        self._strings = {}
+        self._chunks = []  # declarations and strings waiting to be written
+        self._last_marks = {}
+        self._lock = threading.Lock()
+        self._file_lock = threading.Lock()
+        self._file = None
+        self._stop = threading.Event()
+        self._wake = threading.Event()
+        self._thread = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def start(self):
+        "Open the file and start recording."
+        if brick._TRACE_RECORDER is not None:
+            raise RuntimeError("a trace is already being recorded")
+        self._file = open(self.path, "ab" if self.append else "wb")
+        if self._file.tell() == 0:
+            self._file.write(MAGIC + _VERSION.pack(VERSION))
+        header = {"version": VERSION, "start": clock.monotonic(), "epoch": clock.time() - clock.monotonic(),
+                  "byteorder": sys.byteorder}
+        self._write_chunk(b"H", 0, json.dumps(header).encode())
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        brick.set_trace_recorder(self)
+
+    def stop(self):
+        "Stop recording, write everything that is left and close the file."
+        if brick._TRACE_RECORDER is self:
+            brick.set_trace_recorder(None)
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join()
+        self._thread = None
+        if self._file is not None:
+            self.flush()
+            self._file.close()
+            self._file = None
+
+    def is_recording(self) -> bool:
+        return brick._TRACE_RECORDER is self
+
+    def _run(self):
+        # Paced on real time, like the other background threads
+        while not self._stop.is_set():
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            self.flush()
+
+    def record_sensor(self, sensor, value):
+        "Called by Sensor.get_value."
+        key = (sensor.port, getattr(sensor, 'mode', None))
+        names = self._names.get(key)
+        if names is None:
+            port = brick._port_name(sensor.port)
+            names = self._names[key] = (f"{port}.{key[1]}", port)
+            self._sensor_types[names[0]] = sensor.brick.SensorType[brick._SENSOR_PORT_INDEX[sensor.port]]
+        self.record(names[0], "sensor", names[1], value)
+
+    def record_command(self, port: int, command: str, args: tuple):
+        "Called by the Brick motor commands."
+        key = (port, command)
+        names = self._names.get(key)
+        if names is None:
+            ports = _port_names(port)
+            names = self._names[key] = (f"{ports}.{command}", ports)
+        self.record(names[0], "command", names[1], args)
+
+    def mark(self, name: str, value=None, changes_only: bool = False):
+        """
+        Record an event, such as a state transition. With changes_only, the mark is only
+        recorded when value differs from the last one recorded under that name.
+        """
+        if changes_only:
+            if self._last_marks.get(name, self) == value:
+                return
+            self._last_marks[name] = value
+        self.record(f"mark.{name}", "mark", None, value)
+
+    def record(self, name: str, kind: str, port: str | None, value):
+        "Append a timestamped value to the channel called name."
+        timestamp = clock.monotonic()
+        with self._lock:
+            channel = self._current.get(name)
+            if channel is None or not channel.fits(value):
+                channel = self._declare(name, kind, port, value)
+            channel.times.append(timestamp)
+            if not channel.sequence:
+                channel.values.append(self._encode(channel, value))
+            elif value is None:
+                channel.values.extend([math.nan] * channel.info.width)
+            else:
+                values = channel.values
+                size = len(values)
+                try:
+                    values.extend(value)
+                except TypeError:  # a None item, the items before it were added
+                    del values[size:]
+                    values.extend([math.nan if v is None else v for v in value])
+            self.samples += 1
+            if len(channel.times) >= self.block_size:
+                self._wake.set()  # the writer thread writes it out, not this thread
+
+    def _encode(self, channel: _Channel, value):
+        "Number stored for a scalar value. Call with _lock held."
+        if value is None:
+            return _INT_NONE if channel.info.typecode == 'q' else math.nan
+        if channel.pytype is str:
+            string_id = self._strings.get(value)
+            if string_id is None:
+                string_id = self._strings[value] = len(self._strings)
+                self._chunks.append((b"S", 0, _COUNT.pack(string_id) + value.encode()))
+            return string_id
+        return value
+
+    def _declare(self, name: str, kind: str, port: str | None, value) -> _Channel:
+        "Start a channel for values shaped like value. Call with _lock held."
+        pytype = float if value is None else type(value)
+        type_name = _TYPE_NAMES.get(pytype)
+        if type_name is None:
+            raise TypeError(f"cannot record {pytype.__name__} values ({name})")
+        width = len(value) if type_name in ("list", "tuple") else 1
+        info = ChannelInfo(len(self._channels), name, kind, port, type_name, width,
+                           'q' if type_name in _INT_TYPES else 'd', self._sensor_types.get(name))
+        channel = _Channel(info, pytype)
+        self._channels.append(channel)
+        self._current[name] = channel
+        self._chunks.append((b"C", info.id, json.dumps(info._asdict()).encode()))
+        return channel
+
+    def flush(self):
+        "Write the recorded samples to the file now."
+        with self._lock:
+            chunks, self._chunks = self._chunks, []
+            blocks = []
+            for channel in self._channels:
+                if channel.times:
+                    blocks.append((channel.info.id, channel.times, channel.values))
+                    channel.times = array('d')
+                    channel.values = array(channel.info.typecode)
+        with self._file_lock:
+            if self._file is None:
+                return
+            for kind, channel_id, payload in chunks:
+                self._write_chunk(kind, channel_id, payload)
+            for channel_id, times, values in blocks:
+                self._write_chunk(b"D", channel_id,
+                                  _COUNT.pack(len(times)) + times.tobytes() + values.tobytes())
+            self._file.flush()
+
+    def _write_chunk(self, kind: bytes, channel_id: int, payload: bytes):
+        self._file.write(_CHUNK.pack(kind, channel_id, len(payload)))
+        self._file.write(payload)
+
+
+def mark(name: str, value=None, changes_only: bool = False):
+    "Record a mark with the active TraceRecorder, if a trace is being recorded."
+    recorder = brick._TRACE_RECORDER
+    if recorder is not None:
+        recorder.mark(name, value, changes_only)
+
+
+class TraceEvent(NamedTuple):
+    "One recorded sample. time is in seconds since the start of the recording session."
+    time: float
+    channel: ChannelInfo
+    value: object
+
+
+class Trace:
+    """
+    The content of a trace file. Sessions appended to the same file follow each other:
+    their times are offset so that each session starts where the previous one ended.
+    """
+
+    def __init__(self, channels: list[ChannelInfo], events: list[TraceEvent], headers: list[dict],
+                 path: str = None, version: int = VERSION):
+        self.channels = channels
+        self.events = events  # in time order
+        self.headers = headers
+        self.path = path
+        self.version = version
+
+    def names(self) -> list[str]:
+        "Names of the recorded channels, in order of first appearance."
+        return list(dict.fromkeys(channel.name for channel in self.channels))
+
+    def samples(self, name: str) -> list[tuple[float, object]]:
+        "[(time, value), ...] of every channel called name."
+        return [(event.time, event.value) for event in self.events if event.channel.name == name]
+
+    def duration(self) -> float:
+        return self.events[-1].time if self.events else 0.0
+
+    def __repr__(self):
+        return f"Trace({len(self.channels)} channels, {len(self.events)} samples, {self.duration():.3f}s)"
+
+
+def _decode_scalar(info: ChannelInfo, number, strings: dict):
+    if info.typecode == 'q':
+        if number == _INT_NONE:
+            return None
+        if info.type == "str":
+            return strings.get(number)
+        return bool(number) if info.type == "bool" else number
+    return None if math.isnan(number) else number
+
+
+def _decode_sequence(info: ChannelInfo, numbers):
+    if all(math.isnan(n) for n in numbers):
+        return None
+    items = [None if math.isnan(n) else int(n) if n.is_integer() else n for n in numbers]
+    return tuple(items) if info.type == "tuple" else items
+
+
+def read_trace(path: str) -> Trace:
+    """
+    Read a trace file. A chunk cut short at the end of the file, as left by a recording
+    that crashed, is ignored.
+    """
+    with open(path, "rb") as f:
+        data = f.read()
+    if data[:len(MAGIC)] != MAGIC:
+        raise ValueError(f"{path} is not a trace file")
+    (version,) = _VERSION.unpack_from(data, len(MAGIC))
+    if version > VERSION:
+        raise ValueError(f"{path} is a version {version} trace, only versions up to {VERSION} can be read")
+    offset = len(MAGIC) + _VERSION.size
+
+    channels, events, headers = [], [], []
+    session_channels, strings = {}, {}
+    start = shift = end = 0.0
+    swap = False
+    while offset + _CHUNK.size <= len(data):
+        kind, channel_id, length = _CHUNK.unpack_from(data, offset)
+        offset += _CHUNK.size
+        payload = data[offset:offset + length]
+        if len(payload) < length:
+            break
+        offset += length
+        if kind == b"H":
+            header = json.loads(payload)
+            headers.append(header)
+            shift = end
+            start = header["start"]
+            swap = header["byteorder"] != sys.byteorder
+            session_channels, strings = {}, {}
+        elif kind == b"C":
+            info = ChannelInfo(**json.loads(payload))
+            info = info._replace(id=len(channels))
+            session_channels[channel_id] = info
+            channels.append(info)
+        elif kind == b"S":
+            (string_id,) = _COUNT.unpack_from(payload)
+            strings[string_id] = payload[_COUNT.size:].decode()
+        elif kind == b"D":
+            info = session_channels[channel_id]
+            (count,) = _COUNT.unpack_from(payload)
+            times = array('d')
+            times.frombytes(payload[_COUNT.size:_COUNT.size + count * 8])
+            values = array(info.typecode)
+            values.frombytes(payload[_COUNT.size + count * 8:])
+            if swap:
+                times.byteswap()
+                values.byteswap()
+            width = info.width
+            sequence = info.type in ("list", "tuple")
+            for i, t in enumerate(times):
+                if not sequence:
+                    value = _decode_scalar(info, values[i], strings)
+                else:
+                    value = _decode_sequence(info, values[i * width:(i + 1) * width])
+                events.append(TraceEvent(t - start + shift, info, value))
+            if count:
+                end = max(end, times[-1] - start + shift)
+    events.sort(key=lambda event: event.time)
+    return Trace(channels, events, headers, path, version)
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()